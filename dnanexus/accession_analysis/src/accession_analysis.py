@@ -460,15 +460,17 @@ def idr_quality_metric(step_run, stages, files):
 def get_rep_bams(experiment, assembly, keypair, server):
     logger.debug('in get_rep_bams with experiment[accession] %s'
                  % (experiment.get('accession')))
-    original_files = [common.encoded_get(
-        urlparse.urljoin(server, '%s' % (uri)), keypair)
-        for uri in experiment.get('original_files')]
+    original_files = common.encoded_get_many(
+        [urlparse.urljoin(server, '%s' % (uri))
+         for uri in experiment.get('original_files')], keypair)
 
     # resolve the biorep_n for each fastq
-    for fastq in [f for f in original_files
-                  if f.get('file_format') in ['fastq', 'fasta']]:
-        replicate = common.encoded_get(
-            urlparse.urljoin(server, '%s' % (fastq.get('replicate'))), keypair)
+    fastqs = [f for f in original_files
+              if f.get('file_format') in ['fastq', 'fasta']]
+    replicates = common.encoded_get_many(
+        [urlparse.urljoin(server, '%s' % (f.get('replicate')))
+         for f in fastqs], keypair)
+    for fastq, replicate in zip(fastqs, replicates):
         fastq.update(
             {'biorep_n': replicate.get('biological_replicate_number')})
 
@@ -531,9 +533,9 @@ def get_rep_fastqs(experiment, keypair, server, repn):
     logger.debug('in get_rep_fastqs with experiment[accession] %s rep %d'
                  % (experiment.get('accession'), repn))
 
-    original_files = \
-        [common.encoded_get(urlparse.urljoin(server, '%s' % (uri)), keypair)
-         for uri in experiment.get('original_files')]
+    original_files = common.encoded_get_many(
+        [urlparse.urljoin(server, '%s' % (uri))
+         for uri in experiment.get('original_files')], keypair)
 
     fastqs = \
         [f for f in original_files
@@ -541,13 +543,12 @@ def get_rep_fastqs(experiment, keypair, server, repn):
          f.get('status') in fastq_valid_status]
 
     # resolve the biorep_n for each fastq
+    replicates = common.encoded_get_many(
+        [urlparse.urljoin(server, '%s' % (f.get('replicate')))
+         for f in fastqs], keypair)
     rep_fastqs = \
-        [f for f in fastqs
-         if common.encoded_get(
-            urlparse.urljoin(
-                server, '%s'
-                % (f.get('replicate'))), keypair).get(
-                'biological_replicate_number') == repn]
+        [f for f, replicate in zip(fastqs, replicates)
+         if replicate.get('biological_replicate_number') == repn]
     logger.debug('get_rep_fastqs returning %s'
                  % ([f.get('accession') for f in rep_fastqs]))
     return rep_fastqs
@@ -682,13 +683,9 @@ def get_raw_mapping_stages(mapping_analysis, keypair, server, fqcheck, repn):
 
     logger.debug('reads1 and reads2 input_fastq_accessions %s' % (input_fastq_accessions))
 
-    fastqs = []
-    for acc in input_fastq_accessions:
-        fobj = common.encoded_get(
-            urlparse.urljoin(server, 'files/%s' % (acc)), keypair)
-        # logger.debug('fobj')
-        # logger.debug('%s' %(pprint.pprint(fobj)))
-        fastqs.append(fobj)
+    fastqs = common.encoded_get_many(
+        [urlparse.urljoin(server, 'files/%s' % (acc))
+         for acc in input_fastq_accessions], keypair)
 
     logger.info('Found input fastq objects with accessions %s'
                 % ([f.get('accession') for f in fastqs]))
@@ -826,13 +823,9 @@ def get_mapping_stages(mapping_analysis, keypair, server, fqcheck, repn):
 
     logger.debug('reads1 and reads2 input_fastq_accessions %s' % (input_fastq_accessions))
 
-    fastqs = []
-    for acc in input_fastq_accessions:
-        fobj = common.encoded_get(
-            urlparse.urljoin(server, 'files/%s' % (acc)), keypair)
-        # logger.debug('fobj')
-        # logger.debug('%s' %(pprint.pprint(fobj)))
-        fastqs.append(fobj)
+    fastqs = common.encoded_get_many(
+        [urlparse.urljoin(server, 'files/%s' % (acc))
+         for acc in input_fastq_accessions], keypair)
 
     logger.info('Found input fastq objects with accessions %s'
                 % ([f.get('accession') for f in fastqs]))
@@ -57,9 +57,8 @@ def main():
 			continue
 
 		print experiment.get('accession')
-		for uri in experiment['original_files']:
-			url = urlparse.urljoin(server,'%s' %(uri))
-			file_obj = common.encoded_get(url, keypair)
+		urls = [urlparse.urljoin(server,'%s' %(uri)) for uri in experiment['original_files']]
+		for url, file_obj in zip(urls, common.encoded_get_many(urls, keypair)):
 			print "%s, %s, %s, %s, %s, %s" %(file_obj.get('accession'),file_obj.get('file_type'),file_obj.get('file_format'),file_obj.get('file_format_type'),file_obj.get('output_type'),file_obj.get('status'))
 			if file_obj.get('file_format') in ['bed', 'bigBed', 'bigWig']:
 				if file_obj.get('status') != 'released' or args.force:
@@ -13,40 +13,10 @@
 
 import os, subprocess, shlex
 import dxpy
+import common
+from common import run_pipe
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
-
+common.instrument()
 
 @dxpy.entry_point('main')
 def main(input_bam, paired_end):
@@ -102,7 +72,8 @@ def main(input_bam, paired_end):
     # have used the output field name for the filename for each output, but you
     # can change that behavior to suit your needs.
 
-    tagAlign_file = dxpy.upload_local_file(final_TA_filename)
+    tagAlign_file = dxpy.upload_local_file(final_TA_filename,
+        properties=common.tag_count_properties(final_TA_filename))
     if paired_end:
         BEDPE_file = dxpy.upload_local_file(final_BEDPE_filename)
 
@@ -115,6 +86,8 @@ def main(input_bam, paired_end):
     if paired_end:
         output["BEDPE_file"] = dxpy.dxlink(BEDPE_file)
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
@@ -0,0 +1,1474 @@
+#!/usr/bin/env python
+
+import sys, os, subprocess, shlex, logging, re, urlparse, signal, threading, collections, time, resource, contextlib, json, zlib, bz2, gzip, math, array, random
+import multiprocessing, multiprocessing.pool, tempfile
+import dateutil.parser
+from subprocess import Popen, PIPE
+from time import sleep
+
+def test():
+    print "In common.test"
+
+
+def flat(l):
+    result = []
+    for el in l:
+        if hasattr(el, "__iter__") and not isinstance(el, basestring):
+            result.extend(flat(el))
+        else:
+            result.append(el)
+    return result
+
+def rstrips(string, substring):
+    if not string.endswith(substring):
+        return string
+    else:
+        return string[:len(string)-len(substring)]
+
+def touch(fname, times=None):
+    with open(fname, 'a'):
+        os.utime(fname, times)
+
+def block_on(command):
+    process = subprocess.Popen(shlex.split(command), stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(line)
+    process.wait()
+    return process.returncode
+
+# One record per timed step, in the order the steps finished; see
+# pipeline(), timed() and instrument().  write_timings() dumps them.
+TIMINGS = []
+
+def _io_bytes():
+    # storage bytes read and written by this process, from /proc/self/io
+    counters = {}
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except IOError:
+        pass
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+def _disk_used(path='.'):
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+def _usage():
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    children_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _io_bytes()
+    return {
+        'wall': time.time(),
+        'cpu_user': self_ru.ru_utime + children_ru.ru_utime,
+        'cpu_sys': self_ru.ru_stime + children_ru.ru_stime,
+        'read_bytes': read_bytes + children_ru.ru_inblock * 512,
+        'write_bytes': write_bytes + children_ru.ru_oublock * 512,
+        'maxrss_kb': max(self_ru.ru_maxrss, children_ru.ru_maxrss)
+    }
+
+@contextlib.contextmanager
+def timed(name, kind='block'):
+    # Record wall and CPU time (ours plus reaped children's), I/O bytes and
+    # disk use for the enclosed block.  maxrss_kb is a high-water mark: the
+    # largest RSS of this process or any child reaped so far.
+    start = _usage()
+    try:
+        yield
+    finally:
+        end = _usage()
+        timing = {'name': name, 'kind': kind, 'maxrss_kb': end['maxrss_kb'], 'disk_used_bytes': _disk_used()}
+        for key in ('wall', 'cpu_user', 'cpu_sys', 'read_bytes', 'write_bytes'):
+            timing[key] = end[key] - start[key]
+        TIMINGS.append(timing)
+        print "%s %s took %.1fs" %(kind, name, timing['wall'])
+
+def _timed_call(f, kind, describe):
+    if getattr(f, 'timed', False):
+        return f
+    def timed_f(*args, **kwargs):
+        with timed(describe(*args, **kwargs), kind):
+            return f(*args, **kwargs)
+    timed_f.timed = True
+    return timed_f
+
+def _describe_command(args, *rest, **kwargs):
+    if isinstance(args, basestring):
+        return args
+    return ' '.join(args)
+
+def instrument():
+    # Also time dxpy downloads/uploads and subprocess.check_call/check_output,
+    # so an applet gets a full picture without wrapping every call site.
+    # Safe to call more than once.
+    import dxpy
+    dxpy.download_dxfile = _timed_call(dxpy.download_dxfile, 'download',
+        lambda dxid, filename, *args, **kwargs: filename)
+    dxpy.upload_local_file = _timed_call(dxpy.upload_local_file, 'upload',
+        lambda filename=None, *args, **kwargs: filename)
+    subprocess.check_call = _timed_call(subprocess.check_call, 'call', _describe_command)
+    subprocess.check_output = _timed_call(subprocess.check_output, 'call', _describe_command)
+
+def write_timings(fname=None, subjob_timings=None):
+    # Write TIMINGS, plus what the worker looked like, as JSON, by default to
+    # <job id>.timings.json.  Timing files written by subjobs can be folded in
+    # with subjob_timings.
+    if not fname:
+        fname = '%s.timings.json' %(os.environ.get('DX_JOB_ID', 'local'))
+    mem_total_kb = None
+    with open('/proc/meminfo') as fh:
+        for line in fh:
+            if line.startswith('MemTotal:'):
+                mem_total_kb = int(line.split()[1])
+    st = os.statvfs('.')
+    report = {
+        'job': os.environ.get('DX_JOB_ID'),
+        'cpu_count': multiprocessing.cpu_count(),
+        'mem_total_kb': mem_total_kb,
+        'disk_total_bytes': st.f_blocks * st.f_frsize,
+        'steps': TIMINGS
+    }
+    if subjob_timings:
+        report['subjobs'] = []
+        for subjob_fname in subjob_timings:
+            with open(subjob_fname) as fh:
+                report['subjobs'].append(json.load(fh))
+    with open(fname, 'w') as fh:
+        json.dump(report, fh, indent=4, sort_keys=True)
+    return fname
+
+def _restore_sigpipe():
+    # Python ignores SIGPIPE and its children inherit that, so an upstream
+    # step would see EPIPE errors instead of exiting quietly when a
+    # downstream step (head, say) stops reading.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def _exit_status(status):
+    # a wait() status as a Popen-style returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _watch_step(p, stderr_lines, started, result, lock):
+    # Echo and keep the tail of the step's stderr, then reap it with wait4 so
+    # we get the step's own CPU time, peak RSS and block I/O.  This thread is
+    # the only one that reaps the step, and it does so holding lock, so
+    # pipeline can kill a step that hasn't been reaped without the pid being
+    # reused underneath it.
+    for line in iter(p.stderr.readline, ''):
+        sys.stderr.write(line)
+        stderr_lines.append(line)
+    p.stderr.close()
+    delay = 0.001
+    while True:
+        with lock:
+            pid, status, ru = os.wait4(p.pid, os.WNOHANG)
+            if pid:
+                result['returncode'] = _exit_status(status)
+                # so Popen never waits on (or signals) the pid again
+                p.returncode = result['returncode']
+                break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    result.update({
+        'cpu_user': ru.ru_utime,
+        'cpu_sys': ru.ru_stime,
+        'maxrss_kb': ru.ru_maxrss,
+        'read_bytes': ru.ru_inblock * 512,
+        'write_bytes': ru.ru_oublock * 512})
+    result['elapsed'] = time.time() - started
+    result['stderr'] = ''.join(stderr_lines)
+
+class Pipeline(object):
+    """pipeline() for callers that stream through the steps themselves.
+
+    Used as a context manager.  With stdin, the first step's stdin is open
+    for writing as .stdin; unless outfile is given, the last step's stdout
+    is open for reading as .stdout.  Every step's stderr is echoed and kept
+    as pipeline() does.  Leaving the block closes both, waits for every
+    step, records the timings and sets .result to what pipeline() returns,
+    less 'out', raising for the first failed step with check.  Leaving it
+    on an exception kills the steps still running instead.
+    """
+
+    def __init__(self, steps, outfile=None, stdin=False, check=True, stderr_tail=1000):
+        self.steps = steps
+        self.outfile = outfile
+        self.check = check
+        self.stderr_tail = stderr_tail
+        self.stdin = PIPE if stdin else None
+        self.stdout = None
+        self.result = None
+
+    def __enter__(self):
+        self._procs = []
+        self._results = []
+        self._watchers = []
+        self._locks = []
+        self._fh = open(self.outfile, 'w') if self.outfile else None
+        try:
+            for n, step in enumerate(self.steps, start=1):
+                print "step %d: %s" %(n, step)
+                if n == len(self.steps):
+                    stdout = self._fh or PIPE
+                else:
+                    stdout = PIPE
+                p = Popen(shlex.split(step),
+                          stdin=self._procs[-1].stdout if self._procs else self.stdin,
+                          stdout=stdout, stderr=PIPE,
+                          close_fds=True, preexec_fn=_restore_sigpipe)
+                if self._procs:
+                    # only the next step should hold the read end of the pipe
+                    self._procs[-1].stdout.close()
+                self._procs.append(p)
+                result = {'command': step}
+                self._results.append(result)
+                lock = threading.Lock()
+                self._locks.append(lock)
+                watcher = threading.Thread(
+                    target=_watch_step,
+                    args=(p, collections.deque(maxlen=self.stderr_tail), time.time(), result, lock))
+                watcher.daemon = True
+                watcher.start()
+                self._watchers.append(watcher)
+        except:
+            self.stdin = None
+            self._abort()
+            raise
+        if self.stdin:
+            self.stdin = self._procs[0].stdin
+        if not self._fh:
+            self.stdout = self._procs[-1].stdout
+        return self
+
+    def _abort(self):
+        # the watchers reap; only signal steps they haven't reaped yet
+        for p, result, lock in zip(self._procs, self._results, self._locks):
+            with lock:
+                if 'returncode' not in result:
+                    p.kill()
+        for stream in (self.stdin, self.stdout):
+            if stream:
+                try:
+                    stream.close()
+                except IOError: # data still buffered for a step we killed
+                    pass
+        for watcher in self._watchers:
+            watcher.join()
+        if self._fh:
+            self._fh.close()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self._abort()
+            return False
+        try:
+            for stream in (self.stdin, self.stdout):
+                if stream:
+                    stream.close()
+            for watcher in self._watchers:
+                watcher.join()
+        except:
+            self._abort()
+            raise
+        if self._fh:
+            self._fh.close()
+        self.result = self._finish()
+        return False
+
+    def _finish(self):
+        disk_used = _disk_used()
+        for n, result in enumerate(self._results, start=1):
+            print "step %d exited %d after %.1fs: %s" %(n, result['returncode'], result['elapsed'], result['command'])
+            timing = {'name': result['command'], 'kind': 'pipe', 'wall': result['elapsed'],
+                      'returncode': result['returncode'], 'disk_used_bytes': disk_used}
+            for key in ('cpu_user', 'cpu_sys', 'maxrss_kb', 'read_bytes', 'write_bytes'):
+                if key in result:
+                    timing[key] = result[key]
+            TIMINGS.append(timing)
+        if self.check:
+            for n, result in enumerate(self._results, start=1):
+                if result['returncode'] == 0:
+                    continue
+                if n < len(self._results) and result['returncode'] == -signal.SIGPIPE:
+                    continue
+                raise subprocess.CalledProcessError(result['returncode'], result['command'], output=result['stderr'])
+        return {
+            'err': ''.join(result['stderr'] for result in self._results),
+            'steps': self._results
+        }
+
+def pipeline(steps, outfile=None, stdout_callback=None, check=True, stderr_tail=1000):
+    # Run steps (shlex-split, no shell) with each step's stdout piped into the
+    # next step's stdin.  The last step's stdout goes to outfile, or line by
+    # line to stdout_callback, or is returned as 'out'.  Every step's stderr
+    # is echoed as it comes and its last stderr_tail lines are kept.
+    # Returns a dict with 'out', 'err' (all the kept stderr) and 'steps', a
+    # list of per-step dicts with 'command', 'returncode', 'elapsed' (seconds)
+    # and 'stderr'.  With check, the first step that failed raises
+    # CalledProcessError carrying that step's stderr; an intermediate step
+    # killed by SIGPIPE only means a later step stopped reading early.
+    out = None
+    with Pipeline(steps, outfile=outfile, check=check, stderr_tail=stderr_tail) as p:
+        if p.stdout:
+            if stdout_callback:
+                for line in iter(p.stdout.readline, ''):
+                    stdout_callback(line)
+            else:
+                out = p.stdout.read()
+    p.result['out'] = out
+    return p.result
+
+@contextlib.contextmanager
+def open_lines(fname):
+    # A file to read the lines of a plain or gzipped file from, inflated by
+    # gzip in a Pipeline so a failed or truncated inflate raises.
+    if fname.endswith('.gz'):
+        with Pipeline(['gzip -dc %s' %(fname)]) as p:
+            yield p.stdout
+    else:
+        with open(fname, 'r') as fh:
+            yield fh
+
+def run_pipe(steps, outfile=None, stdout_callback=None, check=True):
+    # pipeline() for callers that only want (stdout, stderr)
+    result = pipeline(steps, outfile=outfile, stdout_callback=stdout_callback, check=check)
+    return result['out'], result['err']
+
+def uncompress(filename):
+    #leaves compressed file intact
+    m = re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename)
+    if m:
+        basename = m.group(1)
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(filename))))
+        logging.info("Decompressing %s" %(filename))
+        #logging.info(subprocess.check_output(shlex.split('gzip -dc %s' %(filename))))
+        out,err = run_pipe([
+            'gzip -dc %s' %(filename)],
+            basename)
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(basename))))
+        return basename
+    else:
+        return filename
+
+def compress(filename):
+    #leaves uncompressed file intact
+    if re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename):
+        return filename
+    else:
+        logging.info(subprocess.check_output(shlex.split('cp %s tmp' %(filename))))
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(filename))))
+        logging.info("Compressing %s" %(filename))
+        logging.info(subprocess.check_output(shlex.split('gzip %s' %(filename))))
+        new_filename = filename + '.gz'
+        logging.info(subprocess.check_output(shlex.split('cp tmp %s' %(filename))))
+        logging.info(subprocess.check_output(shlex.split('ls -l %s' %(new_filename))))
+        return new_filename
+
+def _remote_md5_and_size(dxfile):
+    # The platform's md5 for a file, or an md5 property if whoever uploaded
+    # it recorded one (None if neither is known), and its size.
+    desc = dxfile.describe(incl_properties=True)
+    return desc.get('md5') or desc.get('properties', {}).get('md5'), desc.get('size')
+
+def _have_local_copy(dxfile, filename):
+    if not os.path.isfile(filename):
+        return False
+    remote_md5, remote_size = _remote_md5_and_size(dxfile)
+    return remote_md5 is not None and os.path.getsize(filename) == remote_size and md5(filename) == remote_md5
+
+def _download_uncompressed(dxfile, filename, bufsize=16*1024*1024):
+    # Inflate a .gz (or multi-member .gz) file while it downloads, so the
+    # compressed copy never touches the disk.
+    import dxpy
+    with timed(filename, 'download'):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        src = dxpy.open_dxfile(dxfile.get_id())
+        with contextlib.closing(src), open(filename, 'wb') as out:
+            for data in iter(lambda: src.read(bufsize), ''):
+                while data:
+                    out.write(d.decompress(data))
+                    data = d.unused_data
+                    if data: # next gzip member
+                        out.write(d.flush())
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.write(d.flush())
+
+def download(dxfile, filename, uncompress=False):
+    # dxpy.download_dxfile, but skipped when filename is already a copy of
+    # the file (same size and md5).  With uncompress, a filename ending in
+    # .gz is inflated on the way down to filename without the .gz, like
+    # uncompress() would leave it.  Returns the local filename.
+    import dxpy
+    dxfile = dxpy.DXFile(dxfile)
+    if uncompress and filename.endswith('.gz'):
+        filename = rstrips(filename, '.gz')
+        _download_uncompressed(dxfile, filename)
+    elif _have_local_copy(dxfile, filename):
+        print "%s is already a copy of %s, not downloading" %(filename, dxfile.get_id())
+    else:
+        dxpy.download_dxfile(dxfile.get_id(), filename)
+    return filename
+
+def download_many(files, threads=None):
+    # download for several files at once.  files is a list of
+    # (dxfile, filename) or (dxfile, filename, uncompress) tuples.  Returns
+    # the local filenames in the order of files.
+    if not files:
+        return []
+    pool = multiprocessing.pool.ThreadPool(threads or min(len(files), 8))
+    try:
+        return pool.map(lambda f: download(*f), files)
+    finally:
+        pool.close()
+        pool.join()
+
+def upload_many(filenames, threads=None):
+    # dxpy.upload_local_file for several files at once.  Returns the DXFiles
+    # in the order of filenames, with None for any filename that is None (a
+    # bed2bb that failed, say).
+    import dxpy
+    todo = list(collections.OrderedDict.fromkeys(fn for fn in filenames if fn is not None))
+    if not todo:
+        return [None for fn in filenames]
+    pool = multiprocessing.pool.ThreadPool(threads or min(len(todo), 8))
+    try:
+        uploaded = dict(zip(todo, pool.map(dxpy.upload_local_file, todo)))
+    finally:
+        pool.close()
+        pool.join()
+    return [uploaded.get(fn) if fn is not None else None for fn in filenames]
+
+# Line counts already taken, keyed by (path, inode, size, mtime), and
+# mirrored to LINE_COUNT_CACHE, outside the working directory and its
+# outputs, so other scripts run by the same job reuse them.
+LINE_COUNT_CACHE = os.path.join(tempfile.gettempdir(), 'line_counts.json')
+_line_counts = None
+_line_counts_lock = threading.Lock()
+
+def _line_count_key(fname):
+    # the full float mtime and the inode, so a file rewritten to the same
+    # size within the same second (or replaced by a rename) gets a new key
+    st = os.stat(fname)
+    return '%s:%d:%d:%r' %(os.path.realpath(fname), st.st_ino, st.st_size, st.st_mtime)
+
+def _load_line_counts():
+    global _line_counts
+    if _line_counts is None:
+        try:
+            with open(LINE_COUNT_CACHE) as fh:
+                _line_counts = json.load(fh)
+        except (IOError, ValueError):
+            _line_counts = {}
+    return _line_counts
+
+def _count_newlines(fname, bufsize=16*1024*1024):
+    # wc -l, but in-process.  gzip files (including concatenated members)
+    # are inflated with zlib in bufsize chunks, or by pigz when it is
+    # installed; .bz2 with bz2; .Z goes through gzip -dc.
+    n = 0
+    if fname.endswith('.gz') and not _which('pigz'):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with open(fname, 'rb') as fh:
+            while True:
+                data = fh.read(bufsize)
+                if not data:
+                    break
+                while data:
+                    n += d.decompress(data).count('\n')
+                    data = d.unused_data
+                    if data: # next gzip member
+                        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        n += d.flush().count('\n')
+    elif fname.endswith(('.bz', '.bz2')):
+        d = bz2.BZ2Decompressor()
+        with open(fname, 'rb') as fh:
+            while True:
+                data = fh.read(bufsize)
+                if not data:
+                    break
+                while data:
+                    n += d.decompress(data).count('\n')
+                    data = d.unused_data
+                    if data:
+                        d = bz2.BZ2Decompressor()
+    elif fname.endswith(('.gz', '.Z')):
+        command = 'pigz -dc %s' %(fname) if fname.endswith('.gz') else 'gzip -dc %s' %(fname)
+        p = Popen(shlex.split(command), stdout=PIPE, bufsize=bufsize)
+        for data in iter(lambda: p.stdout.read(bufsize), ''):
+            n += data.count('\n')
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, command)
+    else:
+        with open(fname, 'rb') as fh:
+            for data in iter(lambda: fh.read(bufsize), ''):
+                n += data.count('\n')
+    return n
+
+def _which(program):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, program), os.X_OK):
+            return os.path.join(path, program)
+    return None
+
+def count_lines(fname):
+    # Number of lines in a plain or compressed file, cached by path, inode,
+    # size and mtime so the same file is only ever read once.
+    key = _line_count_key(fname)
+    with _line_counts_lock:
+        line_counts = _load_line_counts()
+        if key in line_counts:
+            return line_counts[key]
+    n = _count_newlines(fname)
+    with _line_counts_lock:
+        line_counts[key] = n
+        try:
+            partial = '%s.%d' %(LINE_COUNT_CACHE, os.getpid())
+            with open(partial, 'w') as fh:
+                json.dump(line_counts, fh)
+            os.rename(partial, LINE_COUNT_CACHE)
+        except (IOError, OSError):
+            pass
+    return n
+
+def count_lines_many(fnames, threads=None):
+    # count_lines for several files at once.  zlib and bz2 let go of the GIL
+    # while inflating, so threads are enough to decompress in parallel.
+    # Returns the counts in the order of fnames; repeated names are counted
+    # once.
+    unique = list(collections.OrderedDict.fromkeys(fnames))
+    pool = multiprocessing.pool.ThreadPool(threads or min(len(unique), multiprocessing.cpu_count()) or 1)
+    try:
+        counts = dict(zip(unique, pool.map(count_lines, unique)))
+    finally:
+        pool.close()
+        pool.join()
+    return [counts[fname] for fname in fnames]
+
+# File property on tagAligns (and pooled/pseudoreplicated ones) holding the
+# number of tags, so orchestrators can read it instead of downloading.
+TAG_COUNT_PROPERTY = 'tag_count'
+
+# File property pool sets on the pools it makes with sort: they are in
+# LC_ALL=C sort -k1,1 -k2,2n order.  pool reads it on its inputs, so a
+# sorted pool that is pooled again is merged without being sorted again.
+SORTED_PROPERTY = 'sorted'
+BED_SORT_ORDER = 'chrom,start'
+
+def tag_count_properties(fname, n=None):
+    # properties to upload a tagAlign with; counts it unless n is given
+    if n is None:
+        n = count_lines(fname)
+    return {TAG_COUNT_PROPERTY: str(n)}
+
+def count_tags(dxfile):
+    # Number of tags in a tagAlign on the platform, from its tag_count
+    # property, or by downloading and counting it if it has none.
+    import dxpy
+    dxfile = dxpy.DXFile(dxfile)
+    properties = dxfile.get_properties()
+    if TAG_COUNT_PROPERTY in properties:
+        return int(properties[TAG_COUNT_PROPERTY])
+    logging.warning("%s has no %s property, downloading it to count" %(dxfile.get_id(), TAG_COUNT_PROPERTY))
+    # named by ID too, as count_tags_many counts files of the same name at once
+    fname = '%s-%s' %(dxfile.get_id(), dxfile.name)
+    dxpy.download_dxfile(dxfile.get_id(), fname)
+    try:
+        return count_lines(fname)
+    finally:
+        os.remove(fname)
+
+def count_tags_many(dxfiles, threads=None):
+    # count_tags for several files, any downloads running in parallel.
+    # The same file listed twice is only looked up once.
+    import dxpy
+    ids = [dxpy.DXFile(dxfile).get_id() for dxfile in dxfiles]
+    unique = list(collections.OrderedDict.fromkeys(ids))
+    if not unique:
+        return []
+    pool = multiprocessing.pool.ThreadPool(threads or min(len(unique), 8))
+    try:
+        counts = dict(zip(unique, pool.map(count_tags, unique)))
+    finally:
+        pool.close()
+        pool.join()
+    return [counts[dxid] for dxid in ids]
+
+def _bed_is_sorted(bed_filename):
+    # True if the file is already in the order bedToBigBed wants (chromosomes
+    # in strcmp order, starts ascending within each), so the sort can be skipped.
+    # Blank, comment, track and browser lines are skipped, as read_bed does;
+    # anything else that doesn't parse is left for sort and bedToBigBed.
+    last_chrom, last_start = None, None
+    with open(bed_filename) as fh:
+        for line in fh:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t', 2)
+            if len(fields) < 2:
+                continue
+            try:
+                chrom, start = fields[0], int(fields[1])
+            except ValueError:
+                return False
+            if chrom == last_chrom:
+                if start < last_start:
+                    return False
+            elif last_chrom is not None and chrom < last_chrom:
+                return False
+            last_chrom, last_start = chrom, start
+    return True
+
+# chrom.sizes and .as files already shown in the log by bed2bb
+_bb_inputs_logged = set()
+_bb_inputs_lock = threading.Lock()
+
+def bed2bb(bed_filename, chrom_sizes, as_file, bed_type='bed6+4'):
+    if bed_filename.endswith('.bed'):
+        bb_filename = bed_filename[:-4] + '.bb'
+    else:
+        bb_filename = bed_filename + '.bb'
+
+    logging.debug("In bed2bb with bed_filename=%s, chrom_sizes=%s, as_file=%s" %(bed_filename, chrom_sizes, as_file))
+    log = []
+
+    if _bed_is_sorted(bed_filename):
+        log.append("%s is already sorted\n" %(bed_filename))
+        bed_filename_sorted = bed_filename
+    else:
+        log.append("Sorting %s\n" %(bed_filename))
+        bed_filename_sorted = bed_filename + ".sorted"
+        log.append(subprocess.check_output(shlex.split("sort -k1,1 -k2,2n -o %s %s" %(bed_filename_sorted, bed_filename)), shell=False, stderr=subprocess.STDOUT))
+
+    with _bb_inputs_lock:
+        shared_inputs = [fn for fn in [chrom_sizes, as_file] if fn not in _bb_inputs_logged]
+        _bb_inputs_logged.update(shared_inputs)
+    for fn in [bed_filename_sorted] + shared_inputs:
+        log.append("head %s\n" %(fn))
+        log.append(subprocess.check_output('head %s' %(fn), shell=True, stderr=subprocess.STDOUT))
+
+    command = "bedToBigBed -type=%s -as=%s %s %s %s" %(bed_type, as_file, bed_filename_sorted, chrom_sizes, bb_filename)
+    log.append(command + '\n')
+    try:
+        process = subprocess.Popen(shlex.split(command), stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        log.append(process.communicate()[0])
+        returncode = process.returncode
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+    except:
+        e = sys.exc_info()[0]
+        sys.stdout.write(''.join(log))
+        sys.stderr.write('%s: bedToBigBed failed. Skipping bb creation.' %(e))
+        return None
+    finally:
+        if bed_filename_sorted != bed_filename:
+            try:
+                os.remove(bed_filename_sorted)
+            except:
+                pass
+
+    #this is necessary in case bedToBegBed failes to create the bb file but doesn't return a non-zero returncode
+    if not os.path.isfile(bb_filename):
+        bb_filename = None
+
+    log.append("Returning bb file %s\n" %(bb_filename))
+    # one write per file so concurrent conversions don't interleave their logs
+    sys.stdout.write(''.join(log))
+    return bb_filename
+
+def bed2bb_many(beds, threads=None):
+    # bed2bb for several files at once.  beds is a list of
+    # (bed_filename, chrom_sizes, as_file, bed_type) tuples; bedToBigBed and
+    # sort run as separate processes, so threads are enough.  Returns the bb
+    # filenames (or None) in the order of beds; repeated entries are converted
+    # once.
+    unique = list(collections.OrderedDict.fromkeys(tuple(bed) for bed in beds))
+    pool = multiprocessing.pool.ThreadPool(threads or min(len(unique), multiprocessing.cpu_count()) or 1)
+    try:
+        bb_filenames = dict(zip(unique, pool.map(lambda bed: bed2bb(*bed), unique)))
+    finally:
+        pool.close()
+        pool.join()
+    return [bb_filenames[tuple(bed)] for bed in beds]
+
+def rescale_scores(fn, scores_col, new_min=10, new_max=1000, sort_col=None, rename_peaks=False, out_fn=None):
+    """Rescale the scores in column scores_col (1-based) of fn to lie
+    between new_min and new_max and write the result sorted by descending
+    score, like sort -k <col>gr | awk used to.  As before, the min and max
+    scores are truncated to integers and the new scores are truncated too.
+
+    With sort_col, sort the rescaled lines by that column instead and with
+    rename_peaks, replace column 4 with Peak_<rank>, which is what
+    macs2 used to do to the rescaled file with sort | awk.
+    """
+    import numpy
+
+    if out_fn is None:
+        out_fn = '%s-rescaled' %(fn)
+    with open(fn) as fh:
+        in_lines = [line.rstrip('\n') for line in fh if line.strip()]
+    rows = [line.split('\t') for line in in_lines]
+    if not rows:
+        open(out_fn, 'w').close()
+        return out_fn
+
+    scores = numpy.array([float(row[scores_col-1]) for row in rows])
+    min_score = int(scores.min())
+    max_score = int(scores.max())
+    if max_score == min_score:
+        new_scores = numpy.empty(len(rows), dtype=int)
+        new_scores.fill(new_max)
+    else:
+        new_scores = numpy.trunc(
+            ((scores - min_score) * (new_max - new_min) / float(max_score - min_score)) + new_min).astype(int)
+    for row, new_score in zip(rows, new_scores):
+        row[scores_col-1] = str(new_score)
+
+    lines = ['\t'.join(row) for row in rows]
+    if sort_col is None:
+        order = sorted(range(len(rows)), key=lambda i: (-scores[i], in_lines[i]))
+    else:
+        order = sorted(range(len(rows)), key=lambda i: (-float(rows[i][sort_col-1]), lines[i]))
+
+    with open(out_fn, 'w') as fh:
+        for rank, i in enumerate(order, 1):
+            if rename_peaks:
+                rows[i][3] = 'Peak_%d' %(rank)
+                fh.write('\t'.join(rows[i]) + '\n')
+            else:
+                fh.write(lines[i] + '\n')
+    return out_fn
+
+
+def threshold_idr_peaks(idr_output_filename, thresholds, column, prefix, minus_log10=False):
+    """Filter the output of IDR at each of thresholds in one pass.
+
+    Keeps the first ten columns of the peaks whose IDR in column (1-based)
+    is at most the threshold or, with minus_log10, whose -log10 IDR is at
+    least -log10 of it, ordered as sort -k7n,7n would, and writes them
+    gzipped to <prefix>.IDR<threshold>.narrowPeak.gz.  The first threshold
+    is the main one: its cutoff and filename are rounded to two decimals,
+    as the awk filters this replaces did.  The others are applied and named
+    exactly, and a threshold that would overwrite another's file is a
+    ValueError.  Returns (filename, number of peaks) for each threshold, in
+    order.
+    """
+    import numpy
+
+    cutoffs = []
+    filenames = []
+    for n, threshold in enumerate(thresholds):
+        if n == 0:
+            cutoff = float('%2.2f' %(-math.log10(threshold) if minus_log10 else threshold))
+            filename = '%s.IDR%2.2f.narrowPeak.gz' %(prefix, threshold)
+        else:
+            cutoff = -math.log10(threshold) if minus_log10 else threshold
+            filename = '%s.IDR%r.narrowPeak.gz' %(prefix, threshold)
+        if filename in filenames:
+            raise ValueError("IDR thresholds %r and %r would both be written to %s"
+                %(thresholds[filenames.index(filename)], threshold, filename))
+        cutoffs.append(cutoff)
+        filenames.append(filename)
+
+    rows = read_bed(idr_output_filename)
+    idr = numpy.array([float(row[column-1]) for row in rows])
+    lines = ['\t'.join(row[:10]) for row in rows]
+    order = numpy.array(sorted(range(len(rows)), key=lambda i: (float(rows[i][6]), lines[i])), dtype=numpy.int64)
+    results = []
+    for cutoff, filename in zip(cutoffs, filenames):
+        if minus_log10:
+            passed = idr >= cutoff
+        else:
+            passed = idr <= cutoff
+        with contextlib.closing(gzip.open(filename, 'wb')) as fh:
+            fh.writelines(lines[i] + '\n' for i in order[passed[order]])
+        results.append((filename, int(passed.sum())))
+    return results
+
+
+def slop_clip(filename, chrom_sizes):
+    clipped_fn = '%s-clipped' % (filename)
+    # Remove coordinates outside chromosome sizes
+    pipe = ['slopBed -i %s -g %s -b 0' % (filename, chrom_sizes),
+            'bedClip stdin %s %s' % (chrom_sizes, clipped_fn)]
+    print pipe
+    out, err = run_pipe(pipe)
+    return clipped_fn
+
+
+def read_bed(fname):
+    """Return the lines of a BED-like file (plain, gzipped or bzip2ed, told
+    apart by their magic bytes whatever the file is called) split on tabs,
+    skipping blank, comment, track and browser lines as bedtools does.
+    """
+    with open(fname, 'rb') as fh:
+        magic = fh.read(3)
+    if magic[:2] == '\x1f\x8b':
+        fh = gzip.open(fname, 'rb')
+    elif magic == 'BZh':
+        fh = bz2.BZ2File(fname, 'rb')
+    else:
+        fh = open(fname, 'rb')
+    with contextlib.closing(fh):
+        return [line.rstrip('\r\n').split('\t') for line in fh
+                if line.strip() and not line.startswith(('#', 'track', 'browser'))]
+
+
+class IntervalIndex(object):
+    """Half-open intervals, as bedtools treats BED, held in numpy arrays
+    sorted by start per chromosome so that overlap queries are a binary
+    search plus a short scan.
+    """
+
+    # changes whenever save() writes something load() of an older version
+    # can't read
+    FORMAT_VERSION = '1'
+
+    def __init__(self, rows):
+        import numpy
+        by_chrom = collections.defaultdict(list)
+        for i, row in enumerate(rows):
+            by_chrom[row[0]].append((int(row[1]), int(row[2]), i))
+        self.chroms = {}
+        for chrom, intervals in by_chrom.iteritems():
+            a = numpy.array(intervals, dtype=numpy.int64)
+            a = a[numpy.argsort(a[:, 0], kind='mergesort')]
+            starts, ends, ids = a[:, 0].copy(), a[:, 1].copy(), a[:, 2].copy()
+            self.chroms[chrom] = (starts, ends, int((ends - starts).max()), ids)
+
+    def save(self, fname):
+        """Write the index to fname in numpy's .npz format."""
+        import numpy
+        chroms = sorted(self.chroms)
+        arrays = {'chroms': numpy.array(chroms, dtype=str),
+                  'lengths': numpy.array([len(self.chroms[c][0]) for c in chroms], dtype=numpy.int64),
+                  'max_lens': numpy.array([self.chroms[c][2] for c in chroms], dtype=numpy.int64)}
+        for name, i in (('starts', 0), ('ends', 1), ('ids', 3)):
+            arrays[name] = numpy.concatenate([self.chroms[c][i] for c in chroms] or [numpy.zeros(0, dtype=numpy.int64)])
+        with open(fname, 'wb') as fh:
+            numpy.savez(fh, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """An index written by save()."""
+        import numpy
+        with contextlib.closing(numpy.load(fname)) as npz:
+            arrays = dict((name, npz[name]) for name in npz.files)
+        index = cls.__new__(cls)
+        index.chroms = {}
+        offsets = numpy.concatenate([[0], numpy.cumsum(arrays['lengths'])])
+        for i, chrom in enumerate(arrays['chroms']):
+            chunk = slice(offsets[i], offsets[i+1])
+            index.chroms[str(chrom)] = (arrays['starts'][chunk], arrays['ends'][chunk],
+                                        int(arrays['max_lens'][i]), arrays['ids'][chunk])
+        return index
+
+    def _overlaps(self, rows, max_pairs):
+        # Yield (query, indexed, overlap, query length, indexed length)
+        # arrays for every (row, indexed interval) pair that share a
+        # chromosome and might overlap, about max_pairs pairs at a time.
+        # query and indexed are indices into rows and the rows indexed.
+        import numpy
+        by_chrom = collections.defaultdict(list)
+        for i, row in enumerate(rows):
+            by_chrom[row[0]].append((i, int(row[1]), int(row[2])))
+        for chrom, queries in by_chrom.iteritems():
+            if chrom not in self.chroms:
+                continue
+            starts, ends, max_len, ids = self.chroms[chrom]
+            q = numpy.array(queries, dtype=numpy.int64)
+            # candidates start before the query ends and no earlier than
+            # the longest indexed interval before the query starts
+            lo = numpy.searchsorted(starts, q[:, 1] - max_len, 'right')
+            hi = numpy.searchsorted(starts, q[:, 2], 'left')
+            counts = numpy.maximum(hi - lo, 0)
+            # expand (query, candidate) pairs
+            cum = numpy.cumsum(counts)
+            first = 0
+            while first < len(q):
+                done = cum[first-1] if first else 0
+                last = max(numpy.searchsorted(cum, done + max_pairs, 'right'), first + 1)
+                c = counts[first:last]
+                qi = numpy.repeat(numpy.arange(first, last), c)
+                offsets = numpy.arange(c.sum()) - numpy.repeat(numpy.cumsum(c) - c, c)
+                ci = lo[qi] + offsets
+                q_start, q_end = q[qi, 1], q[qi, 2]
+                overlap = numpy.minimum(q_end, ends[ci]) - numpy.maximum(q_start, starts[ci])
+                yield q[qi, 0], ids[ci], overlap, q_end - q_start, ends[ci] - starts[ci]
+                first = last
+
+    def overlaps_any(self, rows, min_fraction=None, max_pairs=10**7):
+        """For each BED row return True if it overlaps an indexed interval
+        by at least 1 bp or, with min_fraction, by at least that fraction
+        of the length of either the row or the indexed interval.
+        """
+        import numpy
+        found = numpy.zeros(len(rows), dtype=bool)
+        for query, indexed, overlap, q_len, c_len in self._overlaps(rows, max_pairs):
+            hit = overlap > 0
+            if min_fraction is not None:
+                q_len = q_len.astype(float)
+                c_len = c_len.astype(float)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    hit &= ((q_len > 0) & (overlap / q_len >= min_fraction)) | \
+                           ((c_len > 0) & (overlap / c_len >= min_fraction))
+            found[query[hit]] = True
+        return found
+
+    def overlap_pairs(self, rows, max_pairs=10**7):
+        """Return two arrays, the indices into rows and into the rows
+        indexed, of every pair that overlaps by at least 1 bp, as
+        intersectBed -wa -wb would list them.
+        """
+        import numpy
+        queries, indexed = [numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.int64)]
+        for query, candidate, overlap, q_len, c_len in self._overlaps(rows, max_pairs):
+            hit = overlap > 0
+            queries.append(query[hit])
+            indexed.append(candidate[hit])
+        return numpy.concatenate(queries), numpy.concatenate(indexed)
+
+
+def subsample_tagAlign(tagAlign_filename, subsampled_filename, nreads, exclude_chroms=['chrM'], seed=0, paired_end=False):
+    # Reservoir-sample (algorithm R) nreads lines of a gzipped or plain tagAlign
+    # in one pass and O(nreads) memory, skipping reads on exclude_chroms.
+    # The same seed always draws the same sample from the same file.
+    rng = random.Random(seed)
+    exclude_chroms = set(exclude_chroms or [])
+    reservoir = []
+    n = 0
+    with open_lines(tagAlign_filename) as tags:
+        for line in tags:
+            if line.split('\t', 1)[0] in exclude_chroms:
+                continue
+            n += 1
+            if len(reservoir) < nreads:
+                reservoir.append(line)
+            else:
+                i = int(rng.random() * n)
+                if i < nreads:
+                    reservoir[i] = line
+
+    with Pipeline(['gzip -c'], outfile=subsampled_filename, stdin=True) as p:
+        for line in reservoir:
+            if paired_end:
+                fields = line.split('\t')
+                fields[3:5] = ['N', '1000']
+                line = '\t'.join(fields)
+            p.stdin.write(line)
+    print "Sampled %d of %d reads from %s" %(len(reservoir), n, tagAlign_filename)
+    return subsampled_filename
+
+def read_tag_ends(tagAlign_filename, chrom_filter=None):
+    # Load a tagAlign the way spp's read.tagalign.tags does: one vector of
+    # signed 5' ends per chromosome, + strand as start and - strand as -end.
+    # chrom_filter is a regex; matching chromosomes are dropped (-filtchr=).
+    # The read length is the rounded median over the first 500 tags.
+    import numpy
+    if chrom_filter:
+        chrom_filter = re.compile(chrom_filter)
+    ends = {}
+    lengths = []
+    with open_lines(tagAlign_filename) as tags:
+        for line in tags:
+            fields = line.split('\t')
+            chrom, start, end, strand = fields[0], int(fields[1]), int(fields[2]), fields[5][0]
+            if len(lengths) < 500:
+                lengths.append(end - start)
+            if chrom_filter and chrom_filter.search(chrom):
+                continue
+            if chrom not in ends:
+                ends[chrom] = array.array('l')
+            if strand == '+':
+                ends[chrom].append(start)
+            else:
+                ends[chrom].append(-end)
+    ends = dict((chrom, numpy.frombuffer(ends[chrom], dtype=numpy.int_)) for chrom in ends)
+    # numpy rounds halves to even, as R does
+    read_length = int(numpy.round(numpy.median(lengths)))
+    return ends, read_length
+
+def tag_scc(args):
+    # Strand cross-correlation of one chromosome's signed 5' ends, a port of
+    # spp's tag.scc: tags are binned, bins holding llim or more times the mean
+    # count are dropped, and the + and - bin vectors are correlated at each
+    # shift (in bins).  Returns None where spp would return NA.
+    import numpy
+    tags, shifts, bin_size, llim = args
+    bins = numpy.sign(tags) * numpy.floor(numpy.abs(tags) / float(bin_size) + 0.5).astype(numpy.int_)
+    # unique(return_counts=) is numpy >= 1.9; bincount of the inverse works on 1.6
+    tc, inverse = numpy.unique(bins, return_inverse=True)
+    tt = numpy.bincount(inverse)
+    if llim:
+        keep = tt < llim * tt.mean()
+        tc, tt = tc[keep], tt[keep]
+    tt = tt.astype(float)
+    ptc, ptv = tc[tc > 0], tt[tc > 0]
+    ntc, ntv = -tc[tc < 0][::-1], tt[tc < 0][::-1]
+    if not len(ptc) or not len(ntc):
+        return None
+    l = max(ptc[-1], ntc[-1]) - min(ptc[0], ntc[0]) + 1
+    mp = ptv.sum() * bin_size / l
+    mn = ntv.sum() * bin_size / l
+    ptv = ptv - mp
+    ntv = ntv - mn
+    ss = math.sqrt((numpy.dot(ptv, ptv) + (l - len(ptv)) * mp**2) * (numpy.dot(ntv, ntv) + (l - len(ntv)) * mn**2))
+    ptv_sum = ptv.sum()
+    ntv_sum = ntv.sum()
+    scc = numpy.empty(len(shifts))
+    for i, s in enumerate(shifts):
+        target = ptc + s
+        idx = numpy.minimum(numpy.searchsorted(ntc, target), len(ntc) - 1)
+        hit = ntc[idx] == target
+        nhit = int(hit.sum())
+        matched_p = ptv[hit]
+        matched_n = ntv[idx[hit]]
+        # spp's ntv[-na.omit(smi)] is empty, not all of ntv, when nothing matches
+        unmatched_n = ntv_sum - matched_n.sum() if nhit else 0.0
+        scc[i] = (numpy.dot(matched_p, matched_n)
+                  - mn * (ptv_sum - matched_p.sum())
+                  - mp * unmatched_n
+                  + mp * mn * (l - len(ptv) - len(ntv) + nhit)) / ss
+    return scc
+
+def strand_cross_correlation(ends, srange=(-500, 1500), bin_size=5, llim=10, processes=None):
+    # Chromosome-averaged strand cross-correlation, as spp's
+    # get.binding.characteristics(accept.all.tags=T, remove.tag.anomalies=F).
+    # Chromosomes are correlated in parallel and averaged weighted by their
+    # tag counts; chromosomes with no + or - tags are left out of the sum.
+    import numpy
+    shifts = numpy.floor(numpy.arange(srange[0], srange[1] + bin_size, bin_size) / float(bin_size) + 0.5).astype(numpy.int_)
+    chroms = sorted((chrom for chrom in ends if len(ends[chrom])), key=lambda chrom: -len(ends[chrom]))
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+    try:
+        cc = pool.map(tag_scc, [(ends[chrom], shifts, bin_size, llim) for chrom in chroms], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if not any(chrom_cc is not None and not numpy.isnan(chrom_cc).any() for chrom_cc in cc):
+        raise ValueError('No chromosome has tags on both strands')
+    if len(chroms) == 1:
+        y = cc[0]
+    else:
+        ntags = float(sum(len(ends[chrom]) for chrom in chroms))
+        y = numpy.zeros(len(shifts))
+        for chrom, chrom_cc in zip(chroms, cc):
+            if chrom_cc is not None and not numpy.isnan(chrom_cc).any():
+                y += chrom_cc * (len(ends[chrom]) / ntags)
+    return shifts * bin_size, y
+
+def runmean(y, k):
+    # caTools runmean with endrule="mean": a centered k-wide moving average,
+    # shrinking the window at the ends.
+    import numpy
+    if k <= 1:
+        return y.copy()
+    h = k // 2
+    csum = numpy.concatenate(([0.0], numpy.cumsum(y)))
+    i = numpy.arange(len(y))
+    lo = numpy.maximum(i - h, 0)
+    hi = numpy.minimum(i + h + 1, len(y))
+    return (csum[hi] - csum[lo]) / (hi - lo)
+
+def xcor_scores(x, y, read_length, bin_size=5, exclusion=None):
+    # The peak, phantom peak and NSC/RSC calls of run_spp_nodups.R.
+    # Returns a dict of the values that go in the .cc.qc file.
+    import numpy
+    if exclusion is None:
+        exclusion = (10, read_length + 10)
+    min_x, min_y = x[-1], y[-1]
+
+    sbw = 2 * int(math.ceil(5.0 / bin_size) // 2) + 1
+    sy = runmean(y, sbw)
+    bw = int(math.ceil(2.0 / bin_size))
+    rising = (sy[bw:] - sy[:-bw] >= 0).astype(numpy.int_)
+    peakidx = numpy.where(rising[bw:] - rising[:-bw] == -1)[0] + bw
+    px = x[peakidx]
+    peakidx = peakidx[(px < exclusion[0]) | (px > exclusion[1]) | (px < 0)]
+    px, py = x[peakidx], sy[peakidx]
+    maxpeak = numpy.argmax(py)
+    keep = (py >= 0.9 * py[maxpeak]) & (px >= px[maxpeak])
+    px, py = px[keep], py[keep]
+    top = numpy.argsort(-py, kind='mergesort')[:3]
+    peak_x, peak_y = px[top], py[top]
+
+    # Python 2 round() takes halves away from zero; R rounds 1.5*5 to 8 too
+    window = (x >= read_length - round(2 * bin_size)) & (x <= read_length + round(1.5 * bin_size))
+    ph = numpy.where(window)[0]
+    ph = ph[numpy.argmax(y[ph])]
+    phantom_x, phantom_y = x[ph], y[ph]
+
+    nsc = peak_y[0] / min_y
+    rsc = (peak_y[0] - min_y) / (phantom_y - min_y)
+    if 0 <= rsc < 0.25:
+        qtag = -2
+    elif 0.25 <= rsc < 0.5:
+        qtag = -1
+    elif 0.5 <= rsc < 1:
+        qtag = 0
+    elif 1 <= rsc < 1.5:
+        qtag = 1
+    elif rsc >= 1.5:
+        qtag = 2
+    else:
+        qtag = None
+    return {
+        'peak_x': peak_x, 'peak_y': peak_y,
+        'phantom_x': phantom_x, 'phantom_y': phantom_y,
+        'min_x': min_x, 'min_y': min_y,
+        'NSC': nsc, 'RSC': rsc, 'QualityTag': qtag
+    }
+
+def r_format(value):
+    # Numbers as R's cat() prints them, to 7 significant digits.
+    import numpy
+    if value is None:
+        return 'NA'
+    if isinstance(value, (int, long, numpy.integer)):
+        return '%d' %(value)
+    if numpy.isnan(value):
+        return 'NaN'
+    if numpy.isinf(value):
+        return 'Inf' if value > 0 else '-Inf'
+    return '%.7g' %(value)
+
+def native_xcor(tagAlign_filename, CC_scores_filename, CC_plot_filename, exclude_chroms=['chrM'], processes=None):
+    # Cross-correlation QC without R.  Writes the .cc.qc line
+    # run_spp_nodups.R would write after the sed that keeps only the top
+    # estFragLen/corr, and the cross-correlation plot.
+    chrom_filter = '|'.join(exclude_chroms) if exclude_chroms else None
+    ends, read_length = read_tag_ends(tagAlign_filename, chrom_filter)
+    num_tags = sum(len(chrom_ends) for chrom_ends in ends.values())
+    print "Read %d tags of length %d from %s" %(num_tags, read_length, tagAlign_filename)
+    x, y = strand_cross_correlation(ends, processes=processes)
+    scores = xcor_scores(x, y, read_length)
+
+    fields = [os.path.basename(tagAlign_filename),
+              num_tags,
+              scores['peak_x'][0],
+              scores['peak_y'][0],
+              scores['phantom_x'],
+              scores['phantom_y'],
+              scores['min_x'],
+              scores['min_y'],
+              scores['NSC'],
+              scores['RSC'],
+              scores['QualityTag']]
+    with open(CC_scores_filename, 'w') as fh:
+        fh.write('\t'.join(field if isinstance(field, str) else r_format(field) for field in fields) + '\n')
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(5, 5))
+    ax = fig.add_subplot(111)
+    ax.plot(x, y, color='black')
+    for peak_x in scores['peak_x']:
+        ax.axvline(peak_x, linestyle='--', color='red')
+    ax.axvline(scores['phantom_x'], linestyle='--', color='blue')
+    ax.set_xlabel('strand-shift (%s)\nNSC=%g,RSC=%g,Qtag=%s' %(
+        ','.join(r_format(peak_x) for peak_x in scores['peak_x']),
+        scores['NSC'], scores['RSC'], r_format(scores['QualityTag'])))
+    ax.set_ylabel('cross-correlation')
+    ax.set_title(os.path.basename(tagAlign_filename))
+    fig.tight_layout()
+    fig.savefig(CC_plot_filename)
+    plt.close(fig)
+    return CC_scores_filename
+
+
+def processkey(key=None, keyfile=None):
+
+    import json
+
+    if not (key or keyfile) and os.getenv('ENCODE_AUTHID',None) and os.getenv('ENCODE_AUTHPW',None) and os.getenv('ENCODE_SERVER',None):
+        authid = os.getenv('ENCODE_AUTHID',None)
+        authpw = os.getenv('ENCODE_AUTHPW',None)
+        server = os.getenv('ENCODE_SERVER',None)
+    else:
+        if not keyfile:
+            if 'KEYFILE' in globals(): #this is to support scripts where KEYFILE is a global
+                keyfile = KEYFILE
+            else:
+                logging.error("Keyfile must be specified or in global KEYFILE.")
+                return None
+        if key:
+            try:
+                keysf = open(keyfile,'r')
+            except IOError as e:
+                logging.error("Failed to open keyfile %s" %(keyfile))
+                logging.error("e.")
+                return None
+            except:
+                raise
+            keys_json_string = keysf.read()
+            keysf.close()
+            try:
+                keys = json.loads(keys_json_string)
+            except ValueError as e:
+                logging.error(e.message)
+                logging.error("Keyfile %s not in parseable JSON" %(keyfile))
+                return None
+            except:
+                raise
+            try:
+                key_dict = keys[key]
+            except ValueError:
+                logging.error(e.message)
+                logging.error("Keyfile %s has no key named %s" %(keyfile,key))
+                return None
+            except:
+                raise
+        else:
+            key_dict = {}
+
+        if key_dict:
+            authid = key_dict.get('key')
+            authpw = key_dict.get('secret')
+            server = key_dict.get('server')
+        else:
+            return None
+
+    if not server.endswith("/"):
+        server += "/"
+
+    return (authid,authpw,server)
+
+# One keep-alive session for every portal request, with a connection pool
+# big enough for encoded_get_many's threads
+PORTAL_THREADS = 8
+PORTAL_MAX_RETRIES = 10
+PORTAL_MAX_SLEEP = 30
+PORTAL_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_portal_session = None
+_portal_session_lock = threading.Lock()
+
+def portal_session():
+    global _portal_session
+    import requests
+    with _portal_session_lock:
+        if _portal_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=PORTAL_THREADS, pool_maxsize=PORTAL_THREADS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _portal_session = session
+    return _portal_session
+
+def _portal_backoff(attempt):
+    # exponential backoff with full jitter: up to 2**attempt seconds, capped
+    import random
+    sleep(random.uniform(0, min(PORTAL_MAX_SLEEP, 2 ** attempt)))
+
+def encoded_get(url, keypair=None, frame='object', return_response=False):
+    import urlparse, urllib, requests
+    #it is not strictly necessary to include both the accept header, and format=json, but we do
+    #so as to get exactly the same URL as one would use in a web browser
+    HEADERS = {'accept': 'application/json'}
+    url_obj = urlparse.urlsplit(url)
+    new_url_list = list(url_obj)
+    query = urlparse.parse_qs(url_obj.query)
+    if 'format' not in query:
+        new_url_list[3] += "&format=json"
+    if 'frame' not in query:
+        new_url_list[3] += "&frame=%s" %(frame)
+    if 'limit' not in query:
+        new_url_list[3] += "&limit=all"
+    if new_url_list[3].startswith('&'):
+        new_url_list[3] = new_url_list[3].replace('&','',1)
+    get_url = urlparse.urlunsplit(new_url_list)
+    logging.debug('encoded_get: %s' %(get_url))
+    session = portal_session()
+    response = None
+    for attempt in range(PORTAL_MAX_RETRIES):
+        try:
+            if keypair:
+                response = session.get(get_url, auth=keypair, headers=HEADERS)
+            else:
+                response = session.get(get_url, headers=HEADERS)
+        except (requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
+            print >> sys.stderr, e
+            if attempt < PORTAL_MAX_RETRIES - 1:
+                _portal_backoff(attempt)
+            continue
+        except Exception as e:
+            print >> sys.stderr, e
+            return None
+        if response.status_code in PORTAL_RETRY_STATUSES and attempt < PORTAL_MAX_RETRIES - 1:
+            logging.warning("%s returned %d, retrying" %(get_url, response.status_code))
+            _portal_backoff(attempt)
+            continue
+        if return_response:
+            return response
+        else:
+            return response.json()
+    logging.error("Giving up on %s after %d attempts" %(get_url, PORTAL_MAX_RETRIES))
+    return None
+
+def encoded_get_many(urls, keypair=None, frame='object', return_response=False, threads=None):
+    # encoded_get for several URLs at once over the shared session, at most
+    # threads (PORTAL_THREADS) in flight.  Returns the results in the order
+    # of urls; a URL listed twice is only fetched once.  Raises IOError naming
+    # the URLs that could not be fetched, where encoded_get returned None.
+    unique = list(collections.OrderedDict.fromkeys(urls))
+    if not unique:
+        return []
+    pool = multiprocessing.pool.ThreadPool(min(threads or PORTAL_THREADS, len(unique)))
+    try:
+        results = dict(zip(unique, pool.map(
+            lambda url: encoded_get(url, keypair, frame=frame, return_response=return_response), unique)))
+    finally:
+        pool.close()
+        pool.join()
+    failed = [url for url in unique if results[url] is None]
+    if failed:
+        raise IOError("Could not fetch %d of %d URLs: %s" %(len(failed), len(unique), ', '.join(failed)))
+    return [results[url] for url in urls]
+
+def encoded_update(method, url, keypair, payload, return_response):
+    import urlparse, urllib, requests, json
+    session = portal_session()
+    if method == 'patch':
+        request_method = session.patch
+    elif method == 'post':
+        request_method = session.post
+    elif method == 'put':
+        request_method = session.put
+    else:
+        logging.error('Invalid HTTP method: %s' %(method))
+        return
+
+    HEADERS = {'accept': 'application/json', 'content-type': 'application/json'}
+    for attempt in range(PORTAL_MAX_RETRIES):
+        try:
+            response = request_method(url, auth=keypair, headers=HEADERS, data=json.dumps(payload))
+        except (requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
+            logging.warning("%s ... %d retries left." %(e, PORTAL_MAX_RETRIES - attempt - 1))
+            if attempt < PORTAL_MAX_RETRIES - 1:
+                _portal_backoff(attempt)
+            continue
+        else:
+            if return_response:
+                return response
+            else:
+                return response.json()
+    logging.error("Giving up on %s %s after %d attempts" %(method, url, PORTAL_MAX_RETRIES))
+    return None
+
+def encoded_patch(url, keypair, payload, return_response=False):
+    return encoded_update('patch', url, keypair, payload, return_response)
+
+def encoded_post(url, keypair, payload, return_response=False):
+    return encoded_update('post', url, keypair, payload, return_response)
+
+def encoded_put(url, keypair, payload, return_response=False):
+    return encoded_update('put', url, keypair, payload, return_response)
+
+def pprint_json(JSON_obj):
+    import json
+    print json.dumps(JSON_obj, sort_keys=True, indent=4, separators=(',', ': '))
+
+def merge_dicts(*dict_args):
+    '''
+    Given any number of dicts, shallow copy and merge into a new dict,
+    precedence goes to key value pairs in latter dicts.
+    '''
+    result = {}
+    for dictionary in dict_args:
+        result.update(dictionary)
+    return result
+
+def md5(fn):
+    if 'md5_command' not in globals():
+        global md5_command
+        try:
+            subprocess.check_call('which md5', shell=True)
+        except:
+            try:
+                subprocess.check_call('which md5sum', shell=True)
+            except:
+                md5_command = None
+            else:
+                md5_command = 'md5sum'
+        else:
+            md5_command = 'md5 -q'
+
+    md5_output = subprocess.check_output(' '.join([md5_command, fn]), shell=True)
+    return md5_output.partition(' ')[0].rstrip()
+
+def after(date1, date2):
+    try:
+        result = dateutil.parser.parse(date1) > dateutil.parser.parse(date2)
+    except TypeError:
+        if not re.search('\+.*$', date1):
+            date1 += 'T00:00:00-07:00'
+        if not re.search('\+.*$', date2):
+            date1 += 'T00:00:00-07:00'
+    try:
+        result = dateutil.parser.parse(date1) > dateutil.parser.parse(date2)
+    except Exception as e:
+        logger.error("%s Cannot compare %s with %s" %(e, date1, date2))
+        raise
+    else:
+        return result
+
+
+def biorep_ns_generator(f, server, keypair):
+    if isinstance(f, dict):
+        acc = f.get('accession')
+    else:
+        m = re.match('^/?(files)?/?(\w*)', f)
+        if m:
+            acc = m.group(2)
+        else:
+            acc = re.search('ENCFF[0-9]{3}[A-Z]{3}', f).group(0)
+    if not acc:
+        return
+    url = urlparse.urljoin(server, '/files/%s' % (acc))
+    file_object = encoded_get(url, keypair)
+    if file_object.get('derived_from'):
+        for derived_from in file_object.get('derived_from'):
+            for repnum in biorep_ns_generator(derived_from, server, keypair):
+                yield repnum
+    else:
+        url = urlparse.urljoin(server, '%s' % (file_object.get('replicate')))
+        replicate_object = encoded_get(url, keypair)
+        yield replicate_object.get('biological_replicate_number')
+
+
+def biorep_ns(f, server, keypair):
+    return [n for n in set(biorep_ns_generator(f, server, keypair)) if n is not None]
+
+
+def derived_from_references_generator(f, server, keypair):
+    if isinstance(f, dict):
+        acc = f.get('accession')
+    else:
+        m = re.match('^/?(files)?/?(\w*)', f)
+        if m:
+            acc = m.group(2)
+        else:
+            acc = re.search('ENCFF[0-9]{3}[A-Z]{3}', f).group(0)
+    if not acc:
+        return
+    url = urlparse.urljoin(server, '/files/%s' % (acc))
+    file_object = encoded_get(url, keypair)
+
+    if not file_object.get('derived_from'):
+        return
+    else:
+        for derived_from_uri in file_object.get('derived_from', []):
+            derived_from_url = urlparse.urljoin(server, derived_from_uri)
+            derived_from_file = encoded_get(derived_from_url, keypair)
+            if derived_from_file.get('output_category') == "reference":
+                yield derived_from_file.get('@id')
+            else:
+                for derived_from_reference in derived_from_references_generator(derived_from_file, server, keypair):
+                    yield derived_from_reference
+
+
+def derived_from_references(f, server, keypair):
+    return [n for n in set(derived_from_references_generator(f, server, keypair)) if n is not None]
+
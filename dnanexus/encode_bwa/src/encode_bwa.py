@@ -6,9 +6,14 @@ import subprocess
 import shlex
 import time
 import re
+import logging
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE  # debug only this should only need to be imported into run_pipe
 import dxpy
+import common
+from common import run_pipe
+
+common.instrument()
 
 logger = logging.getLogger(__name__)
 
@@ -48,56 +53,155 @@ def flagstat_parse(fname):
     return qc_dict
 
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
-
-
 def resolve_reference():
     # assume the reference file is the only .fa or .fna file
     return next((f for f in os.listdir(".") if f.endswith('.fa') or f.endswith('.fna') or f.endswith('.fa.gz') or f.endswith('.fna.gz')), None)
 
 
-@dxpy.entry_point("postprocess")
-def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samtools_version):
+def stage_reference(reference_tar, bufsize=16*1024*1024):
+    # Stream reference_tar from the platform straight into tar -x in the
+    # working directory, so the tarball itself never touches the disk, and
+    # return the path of the reference in it.
+    reference_tar = dxpy.DXFile(reference_tar)
+    desc = reference_tar.describe()
+    if desc['name'].endswith('.gz') or desc['name'].endswith('.tgz'):
+        tar_command = 'tar -xz --no-same-owner --no-same-permissions -f -'
+    else:
+        tar_command = 'tar -x --no-same-owner --no-same-permissions -f -'
+    print "Unpacking %s (%s)" %(desc['name'], reference_tar.get_id())
+    print tar_command
+    with common.timed(desc['name'], 'download'):
+        tar = Popen(shlex.split(tar_command), stdin=PIPE)
+        n_bytes = 0
+        with dxpy.open_dxfile(reference_tar.get_id()) as src:
+            for data in iter(lambda: src.read(bufsize), ''):
+                tar.stdin.write(data)
+                n_bytes += len(data)
+        tar.stdin.close()
+        if tar.wait() != 0:
+            raise subprocess.CalledProcessError(tar.returncode, tar_command)
+    if n_bytes != desc['size']:
+        raise IOError("Read %d bytes of %s, expected %d" %(n_bytes, reference_tar.get_id(), desc['size']))
+    return resolve_reference()
+
+
+def samtools_path(samtools_version):
+    if samtools_version == "0.1.19":
+        return "/usr/local/bin/samtools-0.1.19/samtools"
+    elif samtools_version == "1.0":
+        return "/usr/local/bin/samtools-1.0/bin/samtools"
+    else:
+        return "/usr/local/bin/samtools-0.1.19/samtools"
 
-    print "In postprocess with:"
 
-    if samtools_version == "0.1.19":
-        samtools = "/usr/local/bin/samtools-0.1.19/samtools"
+def reads_basename_of(unmapped_reads_filenames):
+    if len(unmapped_reads_filenames) == 2:
+        r1_basename = unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+        r2_basename = unmapped_reads_filenames[1].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+        return r1_basename + r2_basename
+    else:
+        return unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+
+
+# split -d -a 3 numbers shards 000 to 999
+MAX_SHARDS = 1000
+
+
+@dxpy.entry_point("split")
+def split(reads, n_shards, reference_tar, bwa_aln_params, bwa_version, samtools_version):
+    # Cut each FASTQ into at most n_shards runs of consecutive reads, map
+    # each shard with its own process and postprocess jobs, and merge their
+    # BAMs.  Every end is cut at the same read numbers, taken from reads1, so
+    # shard i of reads1 and shard i of reads2 still hold the same pairs in
+    # the same order.  With fewer reads than shards there are fewer shards;
+    # empty ones are never mapped.  Returns the merge job's outputs.
+
+    reads_filenames = common.download_many([(r, 'reads%d-%s' %(i+1, dxpy.describe(r)['name'])) for i, r in enumerate(reads)])
+    n_reads = common.count_lines(reads_filenames[0]) / 4
+    lines_per_shard = 4 * max((n_reads + n_shards - 1) / n_shards, 1)
+    n_shards = (n_reads * 4 + lines_per_shard - 1) / lines_per_shard
+    print "%d reads, %d lines per shard, %d shards" %(n_reads, lines_per_shard, n_shards)
+
+    shard_links = []
+    for i, reads_filename in enumerate(reads_filenames):
+        prefix = '%s.shard' %(reads_filename.rstrip('.gz').rstrip('.fq').rstrip('.fastq'))
+        cat = 'gzip -dc' if reads_filename.endswith('.gz') else 'cat'
+        run_pipe(['%s %s' %(cat, reads_filename),
+                  "split -l %d -d -a 3 --filter='gzip -c > $FILE.fq.gz' - %s" %(lines_per_shard, prefix)])
+        shard_filenames = ['%s%03d.fq.gz' %(prefix, n) for n in range(n_shards)]
+        missing = [fn for fn in shard_filenames if not os.path.isfile(fn)]
+        if missing:
+            raise ValueError("%s has fewer reads than %s, no %s" %(reads_filename, reads_filenames[0], ', '.join(missing)))
+        shard_links.append([dxpy.dxlink(f) for f in common.upload_many(shard_filenames)])
+
+    timings = dxpy.upload_local_file(common.write_timings())
+    if n_shards:
+        shards = zip(*shard_links)
+    else: # no reads at all: map the empty input as it is
+        shards = [reads]
+    postprocess_jobs = [map_reads(list(shard_reads), reference_tar, bwa_aln_params, bwa_version, samtools_version)
+                        for shard_reads in shards]
+    merge_job = dxpy.new_dxjob(fn_input={ "mapped_reads": [job.get_output_ref("mapped_reads") for job in postprocess_jobs],
+                                          "unmapped_reads": reads,
+                                          "samtools_version": samtools_version,
+                                          "shard_timings": [dxpy.dxlink(timings)] + [job.get_output_ref("timings") for job in postprocess_jobs] },
+                               fn_name="merge",
+                               depends_on=postprocess_jobs)
+
+    output = {}
+    for name in ["mapped_reads", "mapping_statistics", "n_mapped_reads", "timings"]:
+        output[name] = merge_job.get_output_ref(name)
+    return output
+
+
+@dxpy.entry_point("merge")
+def merge(mapped_reads, unmapped_reads, samtools_version, shard_timings=None):
+    # Merge the sorted BAMs of the shards into one, named as postprocess
+    # would have named it for the whole FASTQs, and flagstat it.
+
+    samtools = samtools_path(samtools_version)
+    reads_basename = reads_basename_of([dxpy.describe(reads)['name'] for reads in unmapped_reads])
+    raw_bam_filename = '%s.raw.srt.bam' %(reads_basename)
+    raw_bam_mapstats_filename = '%s.raw.srt.bam.flagstat.qc' %(reads_basename)
+
+    shard_bam_filenames = common.download_many([(bam, 'shard%03d.bam' %(i)) for i, bam in enumerate(mapped_reads)])
+    if len(shard_bam_filenames) == 1:
+        merge_command = "mv %s %s" %(shard_bam_filenames[0], raw_bam_filename)
     elif samtools_version == "1.0":
-        samtools = "/usr/local/bin/samtools-1.0/bin/samtools"
+        merge_command = "%s merge -@%d %s %s" %(samtools, cpu_count(), raw_bam_filename, ' '.join(shard_bam_filenames))
     else:
-        samtools = "/usr/local/bin/samtools-0.1.19/samtools"
+        merge_command = "%s merge %s %s" %(samtools, raw_bam_filename, ' '.join(shard_bam_filenames))
+    print merge_command
+    subprocess.check_call(shlex.split(merge_command))
+    for fn in shard_bam_filenames:
+        if os.path.isfile(fn):
+            os.remove(fn)
+
+    with open(raw_bam_mapstats_filename, 'w') as fh:
+        subprocess.check_call(shlex.split("%s flagstat %s" \
+            %(samtools, raw_bam_filename)), stdout=fh)
+
+    mapped_reads, mapping_statistics = common.upload_many([raw_bam_filename, raw_bam_mapstats_filename])
+    flagstat_qc = flagstat_parse(raw_bam_mapstats_filename)
+
+    shard_timings_filenames = common.download_many([(t, 'shard%03d.timings.json' %(i)) for i, t in enumerate(shard_timings or [])])
+    timings = dxpy.upload_local_file(common.write_timings(subjob_timings=shard_timings_filenames))
+
+    output = {'mapped_reads': dxpy.dxlink(mapped_reads),
+              'mapping_statistics': dxpy.dxlink(mapping_statistics),
+              'n_mapped_reads': flagstat_qc.get('mapped')[0],  # 0 is index for hi-q reads
+              'timings': dxpy.dxlink(timings)
+              }
+    print "Returning from merge with output: %s" %(output)
+    return output
+
+
+@dxpy.entry_point("postprocess")
+def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samtools_version, process_timings=None):
+
+    print "In postprocess with:"
+
+    samtools = samtools_path(samtools_version)
 
     if bwa_version == "0.7.7":
         bwa = "bwa0.7.7"
@@ -126,27 +230,11 @@ def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samto
         unmapped_reads_filenames.append(fn)
         dxpy.download_dxfile(unmapped,fn)
 
-    reference_tar_filename = dxpy.describe(reference_tar)['name']
-    print "reference_tar: %s" %(reference_tar_filename)
-    dxpy.download_dxfile(reference_tar, reference_tar_filename)
-    # extract the reference files from the tar
-    if reference_tar_filename.endswith('.gz') or reference_tar_filename.endswith('.tgz'):
-        tar_command = 'tar -xzv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    else:
-        tar_command = 'tar -xv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    print "Unpacking %s" %(reference_tar_filename)
-    print tar_command
-    print subprocess.check_output(shlex.split(tar_command))
-    reference_filename = resolve_reference()
+    reference_filename = stage_reference(reference_tar)
 
     paired_end = len(indexed_reads) == 2
 
-    if paired_end:
-        r1_basename = unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
-        r2_basename = unmapped_reads_filenames[1].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
-        reads_basename = r1_basename + r2_basename
-    else:
-        reads_basename = unmapped_reads_filenames[0].rstrip('.gz').rstrip('.fq').rstrip('.fastq')
+    reads_basename = reads_basename_of(unmapped_reads_filenames)
     raw_bam_filename = '%s.raw.srt.bam' %(reads_basename)
     raw_bam_mapstats_filename = '%s.raw.srt.bam.flagstat.qc' %(reads_basename)
 
@@ -155,19 +243,11 @@ def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samto
         reads2_filename = indexed_reads_filenames[1]
         unmapped_reads1_filename = unmapped_reads_filenames[0]
         unmapped_reads2_filename = unmapped_reads_filenames[1]
-        raw_sam_filename = reads_basename + ".raw.sam"
-        badcigar_filename = "badreads.tmp"
+        # Drop both mates of any pair where the CIGAR does not account for
+        # the sequence length.  sampe writes the two mates of a pair one
+        # after the other, so only the current pair needs to be held.
         steps = [ "%s sampe -P %s %s %s %s %s" %(bwa, reference_filename, reads1_filename, reads2_filename, unmapped_reads1_filename, unmapped_reads2_filename),
-                  "tee %s" %(raw_sam_filename),
-                  r"""awk 'BEGIN {FS="\t" ; OFS="\t"} ! /^@/ && $6!="*" { cigar=$6; gsub("[0-9]+D","",cigar); n = split(cigar,vals,"[A-Z]"); s = 0; for (i=1;i<=n;i++) s=s+vals[i]; seqlen=length($10) ; if (s!=seqlen) print $1"\t" ; }'""",
-                  "sort",
-                  "uniq" ]
-        out,err = run_pipe(steps,badcigar_filename)
-        if err:
-            print "sampe error: %s" %(err)
-
-        steps = [ "cat %s" %(raw_sam_filename),
-                  "grep -v -F -f %s" %(badcigar_filename)]
+                  r"""awk 'BEGIN {FS="\t" ; OFS="\t"} /^@/ { print ; next } $1!=qname { if (!bad) printf "%s", pair ; pair="" ; bad=0 ; qname=$1 } { pair=pair $0 "\n" } $6!="*" { cigar=$6; gsub("[0-9]+D","",cigar); n = split(cigar,vals,"[A-Z]"); s = 0; for (i=1;i<=n;i++) s=s+vals[i]; seqlen=length($10) ; if (s!=seqlen) bad=1 } END { if (!bad) printf "%s", pair }'""" ]
     else: #single end
         reads_filename = indexed_reads_filenames[0]
         unmapped_reads_filename = unmapped_reads_filenames[0]
@@ -196,9 +276,18 @@ def postprocess(indexed_reads, unmapped_reads, reference_tar, bwa_version, samto
     mapping_statistics = dxpy.upload_local_file(raw_bam_mapstats_filename)
     flagstat_qc = flagstat_parse(raw_bam_mapstats_filename)
 
+    # fold the bwa aln subjobs' timings into this job's
+    process_timings_filenames = []
+    for timings in process_timings or []:
+        fn = dxpy.describe(timings)['name']
+        dxpy.download_dxfile(timings, fn)
+        process_timings_filenames.append(fn)
+    timings = dxpy.upload_local_file(common.write_timings(subjob_timings=process_timings_filenames))
+
     output = {'mapped_reads': dxpy.dxlink(mapped_reads),
               'mapping_statistics': dxpy.dxlink(mapping_statistics),
-              'n_mapped_reads': flagstat_qc.get('mapped')[0]  # 0 is index for hi-q reads
+              'n_mapped_reads': flagstat_qc.get('mapped')[0],  # 0 is index for hi-q reads
+              'timings': dxpy.dxlink(timings)
               }
     print "Returning from post with output: %s" %(output)
     return output
@@ -229,17 +318,7 @@ def process(reads_file, reference_tar, bwa_aln_params, bwa_version):
         reads_basename = reads_basename.rstrip(extension)
     reads_file = dxpy.download_dxfile(reads_file,reads_filename)
 
-    reference_tar_filename = dxpy.describe(reference_tar)['name']
-    reference_tar_file = dxpy.download_dxfile(reference_tar,reference_tar_filename)
-    # extract the reference files from the tar
-    if reference_tar_filename.endswith('.gz') or reference_tar_filename.endswith('.tgz'):
-        tar_command = 'tar -xzv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    else:
-        tar_command = 'tar -xv --no-same-owner --no-same-permissions -f %s' %(reference_tar_filename)
-    print "Unpacking %s" %(reference_tar_filename)
-    print tar_command
-    print subprocess.check_output(shlex.split(tar_command))
-    reference_filename = resolve_reference()
+    reference_filename = stage_reference(reference_tar)
     print "Using reference file: %s" %(reference_filename)
 
     print subprocess.check_output('ls -l', shell=True)
@@ -258,14 +337,41 @@ def process(reads_file, reference_tar, bwa_aln_params, bwa_version):
     # Upload the output to the DNAnexus project
     print "Uploading %s" %(sai_filename)
     sai_dxfile = dxpy.upload_local_file(sai_filename)
-    process_output = { "output": dxpy.dxlink(sai_dxfile) }
+    timings = dxpy.upload_local_file(common.write_timings())
+    process_output = { "output": dxpy.dxlink(sai_dxfile),
+                       "timings": dxpy.dxlink(timings) }
     print "Returning from process:"
     print process_output
     return process_output
 
 
+def map_reads(unmapped_reads, reference_tar, bwa_aln_params, bwa_version, samtools_version):
+    # Launch bwa aln for each end and the postprocess job that pairs
+    # (or samse's) and sorts them; returns the postprocess job.
+    subjobs = []
+    for reads in unmapped_reads:
+        subjob_input = {"reads_file": reads,
+                        "reference_tar": reference_tar,
+                        "bwa_aln_params": bwa_aln_params,
+                        "bwa_version": bwa_version}
+        print "Submitting:"
+        print subjob_input
+        subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
+
+    # Create the job that will perform the "postprocess" step.  depends_on=subjobs, so blocks on all subjobs
+
+    return dxpy.new_dxjob(fn_input={ "indexed_reads": [subjob.get_output_ref("output") for subjob in subjobs],
+                                     "unmapped_reads": unmapped_reads,
+                                     "reference_tar": reference_tar,
+                                     "bwa_version": bwa_version,
+                                     "samtools_version": samtools_version,
+                                     "process_timings": [subjob.get_output_ref("timings") for subjob in subjobs] },
+                          fn_name="postprocess",
+                          depends_on=subjobs)
+
+
 @dxpy.entry_point("main")
-def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None, samtools_version=None, reads2=None, input_JSON=None, debug=False):
+def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None, samtools_version=None, reads2=None, input_JSON=None, debug=False, n_shards=1):
 
     # Main entry-point.  Parameter defaults assumed to come from dxapp.json.
     # reads1, reference_tar, reads2 are links to DNAnexus files or None
@@ -290,14 +396,22 @@ def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None,
             bwa_version = input_JSON['bwa_version']
         if 'samtools_version' in input_JSON:
             samtools_version = input_JSON['samtools_version']
+        if 'n_shards' in input_JSON:
+            n_shards = input_JSON['n_shards']
 
     if not reads1:
         logger.error('reads1 is required, explicitly or in input_JSON')
         raise Exception
 
-    # This spawns only one or two subjobs for single- or paired-end,
-    # respectively.  It could also download the files, chunk the reads,
-    # and spawn multiple subjobs.
+    if not 1 <= n_shards <= MAX_SHARDS:
+        logger.error('n_shards must be between 1 and %d, not %d' %(MAX_SHARDS, n_shards))
+        raise ValueError(n_shards)
+
+    # This spawns one or two subjobs for single- or paired-end,
+    # respectively, and a postprocess job to pair and sort them.  With
+    # n_shards > 1, a split job instead cuts the reads into up to n_shards
+    # pieces, gives each piece its own process and postprocess jobs, and
+    # has a merge job merge their sorted BAMs.
 
     # Files are downloaded later by subjobs into their own filesystems
     # and uploaded to the project.
@@ -307,35 +421,27 @@ def main(reads1=None, reference_tar=None, bwa_aln_params=None, bwa_version=None,
     paired_end = reads2 is not None
     unmapped_reads = [r for r in [reads1, reads2] if r]
 
-    subjobs = []
-    for reads in unmapped_reads:
-        subjob_input = {"reads_file": reads,
-                        "reference_tar": reference_tar,
-                        "bwa_aln_params": bwa_aln_params,
-                        "bwa_version": bwa_version}
-        print "Submitting:"
-        print subjob_input
-        subjobs.append(dxpy.new_dxjob(subjob_input, "process"))
-
-    # Create the job that will perform the "postprocess" step.  depends_on=subjobs, so blocks on all subjobs
-
-    postprocess_job = dxpy.new_dxjob(fn_input={ "indexed_reads": [subjob.get_output_ref("output") for subjob in subjobs],
-                                                "unmapped_reads": unmapped_reads,
-                                                "reference_tar": reference_tar,
-                                                "bwa_version": bwa_version,
-                                                "samtools_version": samtools_version },
-                                     fn_name="postprocess",
-                                     depends_on=subjobs)
+    if n_shards > 1:
+        postprocess_job = dxpy.new_dxjob({"reads": unmapped_reads,
+                                          "n_shards": n_shards,
+                                          "reference_tar": reference_tar,
+                                          "bwa_aln_params": bwa_aln_params,
+                                          "bwa_version": bwa_version,
+                                          "samtools_version": samtools_version}, "split")
+    else:
+        postprocess_job = map_reads(unmapped_reads, reference_tar, bwa_aln_params, bwa_version, samtools_version)
 
     mapped_reads = postprocess_job.get_output_ref("mapped_reads")
     mapping_statistics = postprocess_job.get_output_ref("mapping_statistics")
     n_mapped_reads = postprocess_job.get_output_ref("n_mapped_reads")
+    timings = postprocess_job.get_output_ref("timings")
 
     output = {
         "mapped_reads": mapped_reads,
         "mapping_statistics": mapping_statistics,
         "paired_end": paired_end,
-        "n_mapped_reads": n_mapped_reads
+        "n_mapped_reads": n_mapped_reads,
+        "timings": timings
     }
     output.update({'output_JSON': output.copy()})
 
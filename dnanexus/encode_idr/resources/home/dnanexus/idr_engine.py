@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""IDR (irreproducible discovery rate) without R or the idr package.
+
+Peaks from two replicates are matched to an oracle peak list (the pooled
+peaks) the way idr 2.0.3 --peak-list does, and the Gaussian copula mixture
+of Li et al. (2011) is fit to their ranks by EM with numpy: each iteration
+turns the ranks into pseudo-values under the current marginal mixture,
+then takes one EM step for the two-component bivariate normal mixture on
+them.  The local IDR of a peak is its posterior probability of belonging
+to the irreproducible component, and its global IDR is the mean local IDR
+of all the peaks at least as reproducible.
+
+run_comparisons() runs several comparisons at once in a process pool.
+"""
+
+import math, logging, multiprocessing
+import common
+
+# 0-based narrowPeak columns that can be used to rank peaks
+RANK_COLUMNS = {'signal.value': 6, 'p.value': 7, 'q.value': 8, 'score': 4}
+
+# starting point and stopping rule, as idr 2.0.3
+DEFAULT_MU = 0.1
+DEFAULT_SIGMA = 1.0
+DEFAULT_RHO = 0.2
+DEFAULT_MIX_PARAM = 0.5
+MAX_ITER = 3000
+CONVERGENCE_EPS = 1e-6
+
+_normal_cdf_table = None
+
+def _normal_cdf(x):
+    # Standard normal CDF by interpolation in a table built once with
+    # math.erf, so numpy is all that is needed.
+    global _normal_cdf_table
+    import numpy
+    if _normal_cdf_table is None:
+        grid = numpy.linspace(-40, 40, 160001)
+        _normal_cdf_table = (grid, numpy.array([0.5 * math.erfc(-v / math.sqrt(2)) for v in grid]))
+    return numpy.interp(x, *_normal_cdf_table)
+
+def _log_normal_pdf(x):
+    return -0.5 * x * x - 0.5 * math.log(2 * math.pi)
+
+def average_ranks(x):
+    """Ranks of x from 1 (smallest) to len(x), ties sharing their mean rank."""
+    import numpy
+    order = numpy.argsort(x, kind='mergesort')
+    sorted_x = x[order]
+    first = numpy.ones(len(x), dtype=bool)
+    first[1:] = sorted_x[1:] != sorted_x[:-1]
+    group = numpy.cumsum(first) - 1
+    starts = numpy.flatnonzero(first)
+    ends = numpy.append(starts[1:], len(x))
+    ranks = numpy.empty(len(x))
+    ranks[order] = ((starts + 1 + ends) / 2.0)[group]
+    return ranks
+
+def _pseudo_values(u, mu, sigma, p, n_grid=10000):
+    # Invert the marginal mixture CDF p * Phi((z-mu)/sigma) + (1-p) * Phi(z)
+    # at u by interpolation on a grid spanning both components.
+    import numpy
+    grid = numpy.linspace(min(-6.0, mu - 6 * sigma), max(6.0, mu + 6 * sigma), n_grid)
+    cdf = p * _normal_cdf((grid - mu) / sigma) + (1 - p) * _normal_cdf(grid)
+    return numpy.interp(u, cdf, grid)
+
+def _component_log_densities(z1, z2, mu, sigma, rho):
+    a = (z1 - mu) / sigma
+    b = (z2 - mu) / sigma
+    reproducible = (-math.log(2 * math.pi) - 2 * math.log(sigma) - 0.5 * math.log(1 - rho * rho)
+                    - (a * a - 2 * rho * a * b + b * b) / (2 * (1 - rho * rho)))
+    irreproducible = _log_normal_pdf(z1) + _log_normal_pdf(z2)
+    return reproducible, irreproducible
+
+def _copula_log_likelihood(z1, z2, mu, sigma, rho, p):
+    import numpy
+    reproducible, irreproducible = _component_log_densities(z1, z2, mu, sigma, rho)
+    joint = numpy.logaddexp(math.log(p) + reproducible, math.log(1 - p) + irreproducible)
+    marginals = [numpy.logaddexp(math.log(p) + _log_normal_pdf((z - mu) / sigma) - math.log(sigma),
+                                 math.log(1 - p) + _log_normal_pdf(z)) for z in (z1, z2)]
+    return float(joint.sum() - marginals[0].sum() - marginals[1].sum())
+
+def fit_idr(x1, x2, max_iter=MAX_ITER, convergence_eps=CONVERGENCE_EPS):
+    """Fit the copula mixture to paired scores x1, x2 (higher is better).
+
+    Returns (params, local_idr), where params is a dict with mu, sigma,
+    rho, p (the reproducible fraction), the log likelihood and the
+    number of iterations.
+    """
+    import numpy
+    n = len(x1)
+    u1 = average_ranks(numpy.asarray(x1, dtype=float)) / (n + 1)
+    u2 = average_ranks(numpy.asarray(x2, dtype=float)) / (n + 1)
+    mu, sigma, rho, p = DEFAULT_MU, DEFAULT_SIGMA, DEFAULT_RHO, DEFAULT_MIX_PARAM
+    log_likelihood = None
+    for iteration in range(1, max_iter + 1):
+        z1 = _pseudo_values(u1, mu, sigma, p)
+        z2 = _pseudo_values(u2, mu, sigma, p)
+        # E step: posterior of the reproducible component
+        reproducible, irreproducible = _component_log_densities(z1, z2, mu, sigma, rho)
+        log_w = math.log(p) + reproducible
+        w = numpy.exp(log_w - numpy.logaddexp(log_w, math.log(1 - p) + irreproducible))
+        # M step
+        w_sum = w.sum()
+        if w_sum <= 0:
+            logging.warning("No peaks left in the reproducible component after %d iterations" %(iteration))
+            break
+        p = min(max(w_sum / n, 1e-6), 1 - 1e-6)
+        mu = float((w * (z1 + z2)).sum() / (2 * w_sum))
+        d1, d2 = z1 - mu, z2 - mu
+        ss = float((w * (d1 * d1 + d2 * d2)).sum())
+        if ss <= 0: # every peak has the same rank
+            logging.warning("The ranks do not vary, stopping after %d iterations" %(iteration))
+            break
+        sigma = max(math.sqrt(ss / (2 * w_sum)), 1e-3)
+        rho = min(max(2 * float((w * d1 * d2).sum()) / ss, -0.999), 0.999)
+
+        new_log_likelihood = _copula_log_likelihood(z1, z2, mu, sigma, rho, p)
+        converged = log_likelihood is not None and \
+            abs(new_log_likelihood - log_likelihood) < convergence_eps * max(abs(log_likelihood), 1)
+        log_likelihood = new_log_likelihood
+        if converged:
+            break
+
+    z1 = _pseudo_values(u1, mu, sigma, p)
+    z2 = _pseudo_values(u2, mu, sigma, p)
+    reproducible, irreproducible = _component_log_densities(z1, z2, mu, sigma, rho)
+    log_idr = math.log(1 - p) + irreproducible
+    local_idr = numpy.exp(log_idr - numpy.logaddexp(log_idr, math.log(p) + reproducible))
+    params = {'mu': mu, 'sigma': sigma, 'rho': rho, 'p': p,
+              'log_likelihood': log_likelihood, 'iterations': iteration}
+    return params, local_idr
+
+def global_idr(local_idr):
+    """The mean local IDR of the peaks with local IDR no more than each
+    peak's own."""
+    import numpy
+    order = numpy.argsort(local_idr, kind='mergesort')
+    cumulative = numpy.cumsum(local_idr[order]) / numpy.arange(1, len(local_idr) + 1)
+    # peaks with the same local IDR get the same global IDR
+    sorted_idr = local_idr[order]
+    last = numpy.append(sorted_idr[1:] != sorted_idr[:-1], True)
+    group_ends = numpy.flatnonzero(last)
+    group = numpy.searchsorted(group_ends, numpy.arange(len(order)))
+    result = numpy.empty(len(local_idr))
+    result[order] = cumulative[group_ends][group]
+    return result
+
+def _reduce_at(ufunc, out, index, values):
+    # ufunc.at(out, index, values) for numpy older than 1.8, which lacks it:
+    # sort by index and reduce each run of equal indices with reduceat
+    import numpy
+    if not len(index):
+        return
+    order = numpy.argsort(index, kind='mergesort')
+    index, values = index[order], values[order]
+    starts = numpy.flatnonzero(numpy.append(True, index[1:] != index[:-1]))
+    out[index[starts]] = ufunc(out[index[starts]], ufunc.reduceat(values, starts))
+
+def match_to_oracle(oracle, reps, rank='signal.value'):
+    """For each oracle peak and replicate, merge the replicate peaks that
+    overlap it: their rank column is summed (p and q values take the max),
+    and the start, end and summit are those of the overlapping peak that
+    ranks highest.  Returns the indices of the oracle peaks found in every
+    replicate and, for each replicate, a list of (start, end, value,
+    summit) arrays over those peaks.
+    """
+    import numpy
+    column = RANK_COLUMNS[rank]
+    found = numpy.ones(len(oracle), dtype=bool)
+    merged = []
+    for rep in reps:
+        values = numpy.array([float(row[column]) for row in rep])
+        query, matched = common.IntervalIndex(rep).overlap_pairs(oracle)
+        if rank in ('p.value', 'q.value'):
+            value = numpy.empty(len(oracle))
+            value.fill(-numpy.inf)
+            _reduce_at(numpy.maximum, value, query, values[matched])
+        else:
+            value = numpy.zeros(len(oracle))
+            _reduce_at(numpy.add, value, query, values[matched])
+        # the best overlapping peak supplies the coordinates
+        order = numpy.lexsort((matched, -values[matched], query))
+        query, matched = query[order], matched[order]
+        best = numpy.ones(len(query), dtype=bool)
+        best[1:] = query[1:] != query[:-1]
+        in_rep = numpy.zeros(len(oracle), dtype=bool)
+        in_rep[query] = True
+        found &= in_rep
+        best_peak = numpy.zeros(len(oracle), dtype=numpy.int64)
+        best_peak[query[best]] = matched[best]
+        merged.append((best_peak, value))
+    keep = numpy.flatnonzero(found)
+    matches = []
+    for rep, (best_peak, value) in zip(reps, merged):
+        peaks = [rep[i] for i in best_peak[keep]]
+        matches.append((numpy.array([int(row[1]) for row in peaks]),
+                        numpy.array([int(row[2]) for row in peaks]),
+                        value[keep],
+                        numpy.array([int(row[9]) for row in peaks])))
+    return keep, matches
+
+def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, output_filename, rank='signal.value'):
+    """IDR of two replicates' peaks matched to the pooled peaks, written in
+    idr 2.0.3's output format: the pooled peak's ten narrowPeak columns
+    (with score min(int(-125 log2(global IDR)), 1000)), -log10 local and
+    global IDR, then start, end, merged value and summit for each
+    replicate.  Pooled peaks with the same coordinates (several summits)
+    all get the best IDR among them.  Returns output_filename and the
+    fitted parameters.
+    """
+    import numpy
+    oracle = common.read_bed(pooled_peaks_filename)
+    reps = [common.read_bed(fn) for fn in (rep1_peaks_filename, rep2_peaks_filename)]
+    keep, matches = match_to_oracle(oracle, reps, rank)
+    if len(keep) < 2:
+        logging.warning("%d pooled peaks are in both replicates, not fitting" %(len(keep)))
+        open(output_filename, 'w').close()
+        return output_filename, None
+    params, local_idr = fit_idr(matches[0][2], matches[1][2])
+    params['n_peaks'] = len(keep)
+    logging.info("%s: %s" %(output_filename, params))
+    global_ = global_idr(local_idr)
+
+    # use-best-multisummit: one IDR per set of coordinates
+    peaks = [oracle[i] for i in keep]
+    coordinates = {}
+    group = numpy.array([coordinates.setdefault(tuple(row[:3]), len(coordinates)) for row in peaks])
+    for idr in (local_idr, global_):
+        best = numpy.ones(len(coordinates))
+        _reduce_at(numpy.minimum, best, group, idr)
+        idr[:] = best[group]
+
+    tiny = numpy.finfo(float).tiny
+    scores = numpy.minimum((-125 * numpy.log2(numpy.maximum(global_, tiny))).astype(int), 1000)
+    minus_log10_local = -numpy.log10(numpy.maximum(local_idr, tiny))
+    minus_log10_global = -numpy.log10(numpy.maximum(global_, tiny))
+    with open(output_filename, 'w') as fh:
+        for i in numpy.argsort(global_, kind='mergesort'):
+            row = peaks[i]
+            fields = row[:4] + [str(scores[i])] + row[5:10] + \
+                ['%.5f' %(minus_log10_local[i]), '%.5f' %(minus_log10_global[i])]
+            for start, end, value, summit in matches:
+                fields.extend([str(start[i]), str(end[i]), '%g' %(value[i]), str(summit[i])])
+            fh.write('\t'.join(fields) + '\n')
+    return output_filename, params
+
+def _run_comparison(comparison):
+    output_filename, params = run_idr(
+        comparison['rep1_peaks'], comparison['rep2_peaks'], comparison['pooled_peaks'],
+        comparison['output'], comparison.get('rank', 'signal.value'))
+    # column 12 is -log10 global IDR, as in idr2's IDR_peaks
+    thresholded = common.threshold_idr_peaks(
+        output_filename, comparison['idr_thresholds'], 12, comparison['prefix'], minus_log10=True)
+    return {'output': output_filename, 'thresholded': thresholded, 'params': params}
+
+def run_comparisons(comparisons, processes=None):
+    """Run each comparison (a dict with rep1_peaks, rep2_peaks, pooled_peaks,
+    output, prefix, idr_thresholds and optionally rank) in its own process,
+    thresholding its output with common.threshold_idr_peaks.  Returns a dict
+    per comparison with the output filename, the (filename, number of
+    peaks) of each threshold and the fitted parameters."""
+    pool = multiprocessing.Pool(processes or min(len(comparisons), multiprocessing.cpu_count()) or 1)
+    try:
+        return pool.map(_run_comparison, comparisons)
+    finally:
+        pool.close()
+        pool.join()
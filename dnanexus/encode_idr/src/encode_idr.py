@@ -16,78 +16,180 @@
 import os, subprocess, logging, re, shlex, sys
 import dxpy
 import common
+import idr_engine
 
+common.instrument()
 
-def blacklist_filter(input_fname, output_fname, input_blacklist_fname):
-    
-    with open(input_fname, 'rb') as fh:
-        gzipped = fh.read(2) == b'\x1f\x8b'
-    if gzipped:
-        peaks_fname = 'peaks.bed'
-        out,err = common.run_pipe(['gzip -dc %s' %(input_fname)], peaks_fname)
-    else:
-        peaks_fname = input_fname
+# The four IDR comparisons of an experiment: each is the rep1 and rep2
+# peaks matched against the pooled peaks given as the third input.
+IDR_COMPARISONS = [
+    ('true', 'rep1_peaks', 'rep2_peaks', 'pooled_peaks'),
+    ('r1pr', 'rep1pr1_peaks', 'rep1pr2_peaks', 'rep1_peaks'),
+    ('r2pr', 'rep2pr1_peaks', 'rep2pr2_peaks', 'rep2_peaks'),
+    ('pooledpr', 'pooledpr1_peaks', 'pooledpr2_peaks', 'pooled_peaks')]
 
-    with open(input_blacklist_fname, 'rb') as fh:
-        gzipped = fh.read(2) == b'\x1f\x8b'
-    if gzipped:
-        blacklist_fname = 'blacklist.bed'
-        out, err = common.run_pipe(['gzip -dc %s' %(input_blacklist_fname)], blacklist_fname)
-    else:
-        blacklist_fname = input_blacklist_fname
 
-    out, err = common.run_pipe([
-        'subtractBed -A -a %s -b %s' %(peaks_fname, blacklist_fname)
-        ], output_fname)
-    #subprocess.check_call(shlex.split('cp %s %s' %(peaks_fname, output_fname)))
+# Blacklist indexes are kept as platform files carrying this property, set
+# to the ID of the blacklist they index, so each blacklist is read and
+# indexed once however many experiments are filtered against it.  They
+# also carry the blacklist's size and md5 and the IntervalIndex format they
+# were saved in, and only an index whose properties all still match is used.
+BLACKLIST_INDEX_PROPERTY = 'blacklist_index_of'
+BLACKLIST_INDEX_FOLDER = '/blacklist_indexes'
+
+
+def blacklist_index_properties(blacklist_file, desc):
+    # The properties a usable index of blacklist_file (described as desc)
+    # carries.  The md5 is left out if neither the platform nor an md5
+    # property knows it.
+    properties = {
+        BLACKLIST_INDEX_PROPERTY: blacklist_file.get_id(),
+        'blacklist_size': str(desc['size']),
+        'blacklist_index_format': common.IntervalIndex.FORMAT_VERSION}
+    md5 = desc.get('md5') or desc.get('properties', {}).get('md5')
+    if md5:
+        properties['blacklist_md5'] = md5
+    return properties
+
+
+def find_blacklist_index(projects, properties):
+    # A saved blacklist index with all of properties, looked for in each of
+    # projects in turn, or None.
+    for project in sorted(set(projects), key=projects.index):
+        try:
+            index_file = dxpy.find_one_data_object(
+                classname='file', state='closed', project=project, properties=properties,
+                zero_ok=True, more_ok=True, return_handler=True)
+        except dxpy.exceptions.DXAPIError as e:
+            logging.warning("Could not search %s for a blacklist index: %s" %(project, e))
+            continue
+        if index_file is not None:
+            return index_file
+    return None
+
+
+def blacklist_index(blacklist):
+    # common.IntervalIndex of the blacklist file, from its saved index if
+    # there is one that matches it, and otherwise built from the blacklist
+    # and saved to the project for the next job.
+    blacklist_file = dxpy.DXFile(blacklist)
+    desc = blacklist_file.describe(incl_properties=True)
+    properties = blacklist_index_properties(blacklist_file, desc)
+    # next to the blacklist, then in the project the job runs in
+    index_file = find_blacklist_index([desc['project'], dxpy.PROJECT_CONTEXT_ID], properties)
+    if index_file is not None:
+        print "Using blacklist index %s" %(index_file.get_id())
+        try:
+            return common.IntervalIndex.load(common.download(index_file, 'blacklist_index.npz'))
+        except (IOError, KeyError, ValueError) as e:
+            logging.warning("Could not load blacklist index %s, rebuilding it: %s" %(index_file.get_id(), e))
+    blacklist_filename = common.download(blacklist_file, 'blacklist_%s' %(blacklist_file.name))
+    index = common.IntervalIndex(common.read_bed(blacklist_filename))
+    index_filename = '%s.index.npz' %(blacklist_file.get_id())
+    index.save(index_filename)
+    try:
+        dxpy.upload_local_file(
+            index_filename, project=dxpy.PROJECT_CONTEXT_ID, folder=BLACKLIST_INDEX_FOLDER, parents=True,
+            properties=properties)
+    except dxpy.exceptions.DXAPIError as e:
+        logging.warning("Could not save the blacklist index: %s" %(e))
+    return index
+
+
+def blacklist_filter(input_fname, output_fname, index):
+    # Write the peaks (plain or gzipped) that overlap no blacklisted
+    # interval, as subtractBed -A would, and return how many were removed.
+    peaks = common.read_bed(input_fname)
+    blacklisted = index.overlaps_any(peaks)
+    with open(output_fname, 'w') as fh:
+        fh.writelines('\t'.join(row) + '\n' for row, hit in zip(peaks, blacklisted) if not hit)
+    return int(blacklisted.sum())
+
+
+def run_idr(experiment, peaks, idr_threshold, rank, extra_idr_thresholds=None):
+    # Download the nine peak files of IDR_COMPARISONS and run the four
+    # comparisons at once with idr_engine.  Returns the thresholded peak
+    # filenames and the full IDR output filenames, in IDR_COMPARISONS order,
+    # and the (gzipped filename, number of peaks) of each comparison at each
+    # of extra_idr_thresholds, threshold by threshold.
+    names = sorted(peaks)
+    peaks_filenames = dict(zip(names, common.download_many([
+        (peaks[name], '%s_%s' %(name, dxpy.DXFile(peaks[name]).name), True) for name in names])))
+    comparisons = [{
+        'rep1_peaks': peaks_filenames[rep1],
+        'rep2_peaks': peaks_filenames[rep2],
+        'pooled_peaks': peaks_filenames[pooled],
+        'output': '%s_%s.IDR.txt' %(experiment, prefix),
+        'prefix': '%s_%s' %(experiment, prefix),
+        'idr_thresholds': [idr_threshold] + (extra_idr_thresholds or []),
+        'rank': rank} for prefix, rep1, rep2, pooled in IDR_COMPARISONS]
+    with common.timed('%d IDR comparisons' %(len(comparisons)), 'idr'):
+        results = idr_engine.run_comparisons(comparisons)
+    thresholded_filenames = []
+    for (prefix, rep1, rep2, pooled), result in zip(IDR_COMPARISONS, results):
+        thresholded_filename, n_peaks = result['thresholded'][0]
+        print "IDR %s: %d peaks pass, %s" %(prefix, n_peaks, result['params'])
+        # the peaks are used, and compressed again for upload, as plain BED
+        thresholded_filenames.append(common.uncompress(thresholded_filename))
+        os.remove(thresholded_filename)
+    extra_thresholded = [result['thresholded'][n] for n in range(1, len(extra_idr_thresholds or []) + 1)
+                         for result in results]
+    return thresholded_filenames, [result['output'] for result in results], extra_thresholded
 
 
 @dxpy.entry_point("main")
-def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
-         chrom_sizes, as_file, blacklist=None,
-         rep1_signal=None, rep2_signal=None, pooled_signal=None):
+def main(experiment, chrom_sizes, as_file,
+         reps_peaks=None, r1pr_peaks=None, r2pr_peaks=None, pooledpr_peaks=None,
+         blacklist=None,
+         rep1_signal=None, rep2_signal=None, pooled_signal=None,
+         rep1_peaks=None, rep2_peaks=None, pooled_peaks=None,
+         rep1pr1_peaks=None, rep1pr2_peaks=None, rep2pr1_peaks=None, rep2pr2_peaks=None,
+         pooledpr1_peaks=None, pooledpr2_peaks=None,
+         idr_threshold=0.05, rank='signal.value', extra_idr_thresholds=None):
 
-    #TODO for now just taking the peak files.  This applet should actually call IDR instead of 
-    #putting that in the workflow populator script
+    # Either the four IDR-thresholded peak sets are given, or the peaks of
+    # the replicates and pseudoreplicates are and IDR is run here.
+    idr_peaks = [reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks]
+    peaks = dict((name, value) for name, value in [
+        ('rep1_peaks', rep1_peaks), ('rep2_peaks', rep2_peaks), ('pooled_peaks', pooled_peaks),
+        ('rep1pr1_peaks', rep1pr1_peaks), ('rep1pr2_peaks', rep1pr2_peaks),
+        ('rep2pr1_peaks', rep2pr1_peaks), ('rep2pr2_peaks', rep2pr2_peaks),
+        ('pooledpr1_peaks', pooledpr1_peaks), ('pooledpr2_peaks', pooledpr2_peaks)] if value)
+    run_idr_here = None in idr_peaks
+    if run_idr_here and len(peaks) < 9:
+        raise ValueError("Need either reps_peaks, r1pr_peaks, r2pr_peaks and pooledpr_peaks, or all nine replicate and pseudoreplicate peak files")
+    if extra_idr_thresholds and not run_idr_here:
+        logging.warning("IDR is not run here, so extra_idr_thresholds are ignored")
 
     # Initialize the data object inputs on the platform into
     # dxpy.DXDataObject instances.
 
-    reps_peaks_file = dxpy.DXFile(reps_peaks)
-    r1pr_peaks_file = dxpy.DXFile(r1pr_peaks)
-    r2pr_peaks_file = dxpy.DXFile(r2pr_peaks)
-    pooledpr_peaks_file = dxpy.DXFile(pooledpr_peaks)
     chrom_sizes_file = dxpy.DXFile(chrom_sizes)
     as_file_file = dxpy.DXFile(as_file)
-    if blacklist is not None:
-        blacklist_file = dxpy.DXFile(blacklist)
-        blacklist_filename = 'blacklist_%s' %(blacklist_file.name)
-        dxpy.download_dxfile(blacklist_file.get_id(), blacklist_filename)
-        blacklist_filename = common.uncompress(blacklist_filename)
 
     # Download the file inputs to the local file system.
 
-    #Need to prepend something to ensure the local filenames will be unique
-    reps_peaks_filename = 'true_%s' %(reps_peaks_file.name)
-    r1pr_peaks_filename = 'r1pr_%s' %(r1pr_peaks_file.name)
-    r2pr_peaks_filename = 'r2pr_%s' %(r2pr_peaks_file.name)
-    pooledpr_peaks_filename = 'pooledpr_%s' %(pooledpr_peaks_file.name)
     chrom_sizes_filename = chrom_sizes_file.name
     as_file_filename = as_file_file.name
 
-    dxpy.download_dxfile(reps_peaks_file.get_id(), reps_peaks_filename)
-    dxpy.download_dxfile(r1pr_peaks_file.get_id(), r1pr_peaks_filename)
-    dxpy.download_dxfile(r2pr_peaks_file.get_id(), r2pr_peaks_filename)
-    dxpy.download_dxfile(pooledpr_peaks_file.get_id(), pooledpr_peaks_filename)
-    dxpy.download_dxfile(chrom_sizes_file.get_id(), chrom_sizes_filename)
-    dxpy.download_dxfile(as_file_file.get_id(), as_file_filename)
+    # The peaks are inflated as they download
+    downloads = [
+        (chrom_sizes_file, chrom_sizes_filename),
+        (as_file_file, as_file_filename)]
+    if not run_idr_here:
+        #Need to prepend something to ensure the local filenames will be unique
+        for prefix, peaks_file in zip(['true', 'r1pr', 'r2pr', 'pooledpr'], [dxpy.DXFile(f) for f in idr_peaks]):
+            downloads.append((peaks_file, '%s_%s' %(prefix, peaks_file.name), True))
+    local_filenames = common.download_many(downloads)
 
-    print subprocess.check_output('ls -l', shell=True)
+    if run_idr_here:
+        idr_peaks_filenames, idr_output_filenames, extra_thresholded = \
+            run_idr(experiment, peaks, idr_threshold, rank, extra_idr_thresholds)
+    else:
+        idr_peaks_filenames, idr_output_filenames, extra_thresholded = local_filenames[2:6], [], []
+    reps_peaks_filename, r1pr_peaks_filename, r2pr_peaks_filename, pooledpr_peaks_filename = idr_peaks_filenames
 
-    reps_peaks_filename = common.uncompress(reps_peaks_filename)
-    r1pr_peaks_filename = common.uncompress(r1pr_peaks_filename)
-    r2pr_peaks_filename = common.uncompress(r2pr_peaks_filename)
-    pooledpr_peaks_filename = common.uncompress(pooledpr_peaks_filename)
+    print subprocess.check_output('ls -l', shell=True)
 
     Nt = common.count_lines(reps_peaks_filename)
     print "%d peaks from true replicates" %(Nt)
@@ -98,13 +200,17 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
     Np = common.count_lines(pooledpr_peaks_filename)
     print "%d peaks from pooled pseudoreplicates" %(Np)
 
+    if blacklist is not None:
+        blacklist = blacklist_index(blacklist)
+
     conservative_set_filename = '%s_final_conservative.narrowPeak' %(experiment)
     if blacklist is not None:
-        blacklist_filter(reps_peaks_filename, conservative_set_filename, blacklist_filename)
+        Nc_blacklisted = blacklist_filter(reps_peaks_filename, conservative_set_filename, blacklist)
     else:
         conservative_set_filename = reps_peaks_filename
+        Nc_blacklisted = 0
     Ncb = common.count_lines(conservative_set_filename)
-    print "%d peaks blacklisted from the conservative set" %(Nt-Ncb)
+    print "%d peaks blacklisted from the conservative set" %(Nc_blacklisted)
 
     if Nt >= Np:
         peaks_to_filter_filename = reps_peaks_filename
@@ -115,11 +221,12 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
 
     optimal_set_filename = '%s_final_optimal.narrowPeak' %(experiment)
     if blacklist is not None:
-        blacklist_filter(peaks_to_filter_filename, optimal_set_filename, blacklist_filename)
+        No_blacklisted = blacklist_filter(peaks_to_filter_filename, optimal_set_filename, blacklist)
     else:
         optimal_set_filename = peaks_to_filter_filename
+        No_blacklisted = 0
     Nob = common.count_lines(optimal_set_filename)
-    print "%d peaks blacklisted from the optimal set" %(No-Nob)
+    print "%d peaks blacklisted from the optimal set" %(No_blacklisted)
 
     rescue_ratio            = float(max(Np,Nt)) / float(min(Np,Nt))
     self_consistency_ratio  = float(max(N1,N2)) / float(min(N1,N2))
@@ -134,13 +241,22 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
     output = {}
 
     #bedtobigbed often fails, so skip creating the bb if it does
-    conservative_set_bb_filename = common.bed2bb(conservative_set_filename, chrom_sizes_filename, as_file_filename)
-    optimal_set_bb_filename = common.bed2bb(optimal_set_filename, chrom_sizes_filename, as_file_filename)
-    if conservative_set_bb_filename:
-        conservative_set_bb_output = dxpy.upload_local_file(conservative_set_bb_filename)
+    conservative_set_bb_filename, optimal_set_bb_filename = common.bed2bb_many([
+        (conservative_set_filename, chrom_sizes_filename, as_file_filename, 'bed6+4'),
+        (optimal_set_filename,      chrom_sizes_filename, as_file_filename, 'bed6+4')])
+    conservative_set_output, optimal_set_output, conservative_set_bb_output, optimal_set_bb_output = \
+        common.upload_many([common.compress(conservative_set_filename), common.compress(optimal_set_filename),
+                            conservative_set_bb_filename, optimal_set_bb_filename])
+    if idr_output_filenames:
+        idr_outputs = common.upload_many([common.compress(fn) for fn in idr_output_filenames])
+        output.update({"idr_outputs": [dxpy.dxlink(f) for f in idr_outputs]})
+    if extra_thresholded:
+        extra_IDR_peaks = common.upload_many([filename for filename, n in extra_thresholded])
+        output.update({"extra_IDR_peaks": [dxpy.dxlink(f) for f in extra_IDR_peaks],
+                       "extra_N": [n for filename, n in extra_thresholded]})
+    if conservative_set_bb_output:
         output.update({"conservative_set_bb": dxpy.dxlink(conservative_set_bb_output)})
-    if optimal_set_bb_filename:
-        optimal_set_bb_output = dxpy.upload_local_file(optimal_set_bb_filename)
+    if optimal_set_bb_output:
         output.update({"optimal_set_bb": dxpy.dxlink(optimal_set_bb_output)})
 
     output.update({
@@ -148,13 +264,15 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
         "N1": N1,
         "N2": N2,
         "Np": Np,
-        "conservative_set": dxpy.dxlink(dxpy.upload_local_file(common.compress(conservative_set_filename))),
-        "optimal_set": dxpy.dxlink(dxpy.upload_local_file(common.compress(optimal_set_filename))),
+        "conservative_set": dxpy.dxlink(conservative_set_output),
+        "optimal_set": dxpy.dxlink(optimal_set_output),
         "rescue_ratio": rescue_ratio,
         "self_consistency_ratio": self_consistency_ratio,
         "reproducibility_test": reproducibility,
         "No": Nob,
-        "Nc": Ncb
+        "Nc": Ncb,
+        "No_blacklisted": No_blacklisted,
+        "Nc_blacklisted": Nc_blacklisted
     })
 
     # These are just passed through for convenience so that signals and tracks
@@ -166,6 +284,8 @@ def main(experiment, reps_peaks, r1pr_peaks, r2pr_peaks, pooledpr_peaks,
     if pooled_signal:
         output.update({"pooled_signal": pooled_signal})
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     logging.info("Exiting with output: %s", output)
     return output
 
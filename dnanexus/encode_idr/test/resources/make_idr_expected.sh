@@ -0,0 +1,15 @@
+#!/bin/sh
+# Regenerate idr_2.0.3.regionPeak and idr_2.0.3.log, the idr 2.0.3 output that
+# TestIDREngine.test_matches_idr_2_0_3 compares idr_engine with.  Needs the idr
+# 2.0.3 release (https://github.com/nboley/idr, tag 2.0.3) on the PATH; the
+# flags are those the idr2 applet runs it with, less --plot.
+set -e
+cd "$(dirname "$0")"
+idr --version 2>&1 | grep -q '2\.0\.3' || { echo "idr 2.0.3 is needed" >&2; exit 1; }
+idr --use-best-multisummit-IDR \
+    --soft-idr-threshold 0.05 \
+    --rank signal.value \
+    --output-file idr_2.0.3.regionPeak \
+    --log-output-file idr_2.0.3.log \
+    --peak-list idr_pooled.narrowPeak \
+    --samples idr_rep1.narrowPeak idr_rep2.narrowPeak
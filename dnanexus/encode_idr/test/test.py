@@ -2,7 +2,7 @@
 # encode_idr 0.0.1 test suite
 # Generated by dx-app-wizard.
 
-import json, os, time, unittest
+import json, os, sys, tempfile, shutil, time, unittest
 
 import dxpy
 import dxpy.app_builder
@@ -11,6 +11,7 @@ from dxpy.exceptions import DXAPIError
 
 src_dir = os.path.join(os.path.dirname(__file__), "..")
 test_resources_dir = os.path.join(src_dir, "test", "resources")
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
 
 def makeInputs():
     # Please fill in this method to generate default inputs for your app.
@@ -53,5 +54,152 @@ class Testencode_idr(unittest.TestCase):
         job.wait_on_done()
         print json.dumps(job.describe()["output"])
 
+def narrowpeak(chrom, start, end, name, signal, p=-1, q=-1, summit=0):
+    return [chrom, str(start), str(end), name, '0', '.', str(signal), str(p), str(q), str(summit)]
+
+class TestIDREngine(unittest.TestCase):
+    # Runs locally against idr_engine; no platform needed.
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fit_idr_recovers_parameters(self):
+        import numpy, idr_engine
+        rs = numpy.random.RandomState(0)
+        n, n_reproducible = 4000, 2400
+        reproducible = rs.multivariate_normal([2.5, 2.5], [[1, 0.8], [0.8, 1]], n_reproducible)
+        noise = rs.normal(size=(n - n_reproducible, 2))
+        x = numpy.vstack([reproducible, noise])
+        params, local_idr = idr_engine.fit_idr(x[:, 0], x[:, 1])
+        # EM stops before sigma has fully converged at this sample size
+        self.assertAlmostEqual(params['mu'], 2.5, delta=0.3)
+        self.assertAlmostEqual(params['sigma'], 1.0, delta=0.25)
+        self.assertAlmostEqual(params['rho'], 0.8, delta=0.05)
+        self.assertAlmostEqual(params['p'], 0.6, delta=0.05)
+        # the global IDR controls the fraction of noise peaks called
+        called = numpy.flatnonzero(idr_engine.global_idr(local_idr) <= 0.05)
+        self.assertGreater(len(called), n_reproducible / 2)
+        self.assertLess((called >= n_reproducible).mean(), 0.08)
+
+    def test_fit_idr_constant_ranks(self):
+        import numpy, idr_engine
+        params, local_idr = idr_engine.fit_idr(numpy.ones(10), numpy.ones(10))
+        self.assertEqual(len(local_idr), 10)
+        self.assertFalse(numpy.isnan(local_idr).any())
+
+    def test_global_idr(self):
+        import numpy, idr_engine
+        result = idr_engine.global_idr(numpy.array([0.3, 0.1, 0.2, 0.1]))
+        numpy.testing.assert_allclose(result, [0.175, 0.1, 0.4 / 3, 0.1])
+
+    def test_match_to_oracle(self):
+        import idr_engine
+        oracle = [narrowpeak('chr1', 100, 200, 'a', 1),
+                  narrowpeak('chr1', 300, 400, 'b', 1),
+                  narrowpeak('chr2', 100, 200, 'c', 1)]
+        rep1 = [narrowpeak('chr1', 150, 180, 'r1a', 5, p=9, summit=3),
+                narrowpeak('chr1', 110, 190, 'r1b', 7, p=4, summit=8),
+                narrowpeak('chr1', 350, 450, 'r1c', 2, p=6, summit=1),
+                narrowpeak('chr2', 50, 99, 'r1d', 3, p=2, summit=1)]
+        rep2 = [narrowpeak('chr1', 90, 120, 'r2a', 4, p=5, summit=2),
+                narrowpeak('chr1', 390, 410, 'r2b', 6, p=3, summit=4),
+                narrowpeak('chr2', 150, 160, 'r2c', 1, p=1, summit=5)]
+        keep, matches = idr_engine.match_to_oracle(oracle, [rep1, rep2])
+        # c has no rep1 peak (r1d ends where it starts)
+        self.assertEqual(list(keep), [0, 1])
+        (start, end, value, summit), (start2, end2, value2, summit2) = matches
+        # signal values add; the strongest peak supplies the coordinates
+        self.assertEqual(list(start), [110, 350])
+        self.assertEqual(list(end), [190, 450])
+        self.assertEqual(list(value), [12, 2])
+        self.assertEqual(list(summit), [8, 1])
+        self.assertEqual(list(value2), [4, 6])
+        # p-values take the max, and the best p-value supplies the coordinates
+        keep, matches = idr_engine.match_to_oracle(oracle, [rep1, rep2], rank='p.value')
+        self.assertEqual(list(matches[0][0]), [150, 350])
+        self.assertEqual(list(matches[0][2]), [9, 6])
+
+    @unittest.skipUnless(os.path.exists(os.path.join(test_resources_dir, 'idr_2.0.3.regionPeak')),
+                         "no idr 2.0.3 output; run test/resources/make_idr_expected.sh")
+    def test_matches_idr_2_0_3(self):
+        # Compares with what idr 2.0.3 itself writes for the same inputs:
+        # the fitted mu, sigma, rho and mixing fraction (to 0.1, 0.1, 0.05
+        # and 0.05, as idr logs them to two decimals and the two stop EM at
+        # different points), the peaks reported and their coordinate
+        # columns exactly, and each peak's global IDR to 0.02.
+        import re, idr_engine
+        resource = lambda fn: os.path.join(test_resources_dir, fn)
+        output = os.path.join(self.tmpdir, 'idr.regionPeak')
+        _, params = idr_engine.run_idr(resource('idr_rep1.narrowPeak'), resource('idr_rep2.narrowPeak'),
+                                       resource('idr_pooled.narrowPeak'), output)
+        with open(resource('idr_2.0.3.log')) as fh:
+            expected_params = re.findall(r'Final parameter values: \[([^\]]*)\]', fh.read())[-1].split()
+        for name, expected, delta in zip(['mu', 'sigma', 'rho', 'p'], expected_params, [0.1, 0.1, 0.05, 0.05]):
+            self.assertAlmostEqual(params[name], float(expected), delta=delta, msg=name)
+        with open(output) as fh:
+            got = dict((tuple(row[:4] + [row[9]]), row) for row in (line.rstrip('\n').split('\t') for line in fh))
+        with open(resource('idr_2.0.3.regionPeak')) as fh:
+            expected = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual(sorted(got), sorted(tuple(row[:4] + [row[9]]) for row in expected))
+        for row in expected:
+            mine = got[tuple(row[:4] + [row[9]])]
+            self.assertEqual(mine[5:10], row[5:10])
+            # each replicate's start, end, merged value and summit
+            for n in range(12, len(row), 4):
+                self.assertEqual([mine[n], mine[n+1], mine[n+3]], [row[n], row[n+1], row[n+3]])
+                self.assertAlmostEqual(float(mine[n+2]), float(row[n+2]), places=4)
+            self.assertAlmostEqual(10 ** -float(mine[11]), 10 ** -float(row[11]), delta=0.02)
+
+    def test_run_comparisons_thresholds_as_idr2(self):
+        import gzip, idr_engine
+        resource = lambda fn: os.path.join(test_resources_dir, fn)
+        prefix = os.path.join(self.tmpdir, 'true')
+        result, = idr_engine.run_comparisons([{
+            'rep1_peaks': resource('idr_rep1.narrowPeak'), 'rep2_peaks': resource('idr_rep2.narrowPeak'),
+            'pooled_peaks': resource('idr_pooled.narrowPeak'), 'output': prefix + '.IDR.txt',
+            'prefix': prefix, 'idr_thresholds': [0.5, 0.25]}])
+        with open(result['output']) as fh:
+            # column 12 is -log10 global IDR, cut at %2.2f of -log10 0.5 as idr2's awk does
+            expected = [row[:10] for row in (line.rstrip('\n').split('\t') for line in fh) if float(row[11]) >= 0.30]
+        (filename, n), (extra_filename, extra_n) = result['thresholded']
+        self.assertEqual(filename, prefix + '.IDR0.50.narrowPeak.gz')
+        self.assertEqual(extra_filename, prefix + '.IDR0.25.narrowPeak.gz')
+        self.assertLessEqual(extra_n, n)
+        with gzip.open(filename) as fh:
+            rows = [line.rstrip('\n').split('\t') for line in fh]
+        self.assertEqual(n, len(expected))
+        self.assertEqual(sorted(rows), sorted(expected))
+        self.assertEqual([float(row[6]) for row in rows], sorted(float(row[6]) for row in rows))
+
+    def test_threshold_rounds_the_main_cutoff(self):
+        import common, gzip
+        idr_output = os.path.join(self.tmpdir, 'idr.txt')
+        with open(idr_output, 'w') as fh:
+            for name, minus_log10_idr in [('a', '2.00000'), ('b', '1.30050'), ('c', '1.29000')]:
+                fh.write('\t'.join(narrowpeak('chr1', 100, 200, name, 1) + ['3.00000', minus_log10_idr]) + '\n')
+        prefix = os.path.join(self.tmpdir, 'x')
+        (main, n_main), (extra, n_extra) = common.threshold_idr_peaks(idr_output, [0.05, 0.051], 12, prefix, minus_log10=True)
+        # 1.30050 passes the two-decimal 1.30 cutoff that idr2 uses for the main threshold
+        self.assertEqual((main, n_main), (prefix + '.IDR0.05.narrowPeak.gz', 2))
+        self.assertEqual((extra, n_extra), (prefix + '.IDR0.051.narrowPeak.gz', 2))
+        with gzip.open(main) as fh:
+            self.assertEqual([line.split('\t')[3] for line in fh], ['a', 'b'])
+        self.assertRaises(ValueError, common.threshold_idr_peaks, idr_output, [0.05, 0.05], 12, prefix, True)
+
+    def test_read_bed_sniffs_compression(self):
+        import bz2, gzip, common
+        rows = [narrowpeak('chr1', 100, 200, 'a', 1), narrowpeak('chr2', 5, 10, 'b', 2)]
+        text = 'track name=blacklist\n' + ''.join('\t'.join(row) + '\n' for row in rows)
+        # compressed files named as if they were plain, and the other way round
+        for name, opener in [('gzipped.bed', gzip.open), ('bzipped.bed', bz2.BZ2File), ('plain.bed.gz', open)]:
+            fname = os.path.join(self.tmpdir, name)
+            fh = opener(fname, 'wb')
+            fh.write(text)
+            fh.close()
+            self.assertEqual(common.read_bed(fname), rows, name)
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,17 +15,6 @@ import os, subprocess, shlex, time, re
 import dxpy
 import common
 
-def count_lines(filename):
-        if filename.endswith(('.Z','.gz','.bz','.bz2')):
-                catcommand = 'gzip -dc'
-        else:
-                catcommand = 'cat'
-        out,err = common.run_pipe([
-                '%s %s' %(catcommand, filename),
-                'wc -l'
-        ])
-        return int(out)
-
 def macs2(experiment, control, xcor_scores, chrom_sizes, narrowpeak_as, gappedpeak_as, broadpeak_as, genomesize, prefix=None):
         macs2_applet = dxpy.find_one_data_object(
                 classname='applet', name='macs2', project=dxpy.PROJECT_CONTEXT_ID,
@@ -64,35 +53,16 @@ def main(rep1_ta, rep2_ta, ctl1_ta, ctl2_ta, rep1_xcor, rep2_xcor, rep1_paired_e
     rep1_xcor_file = dxpy.DXFile(rep1_xcor)
     rep2_xcor_file = dxpy.DXFile(rep2_xcor)
 
-    # The following line(s) download your file inputs to the local file system
-    # using variable names for the filenames.
-
-    dxpy.download_dxfile(rep1_ta_file.get_id(), rep1_ta_file.name)
-    dxpy.download_dxfile(rep2_ta_file.get_id(), rep2_ta_file.name)
-    dxpy.download_dxfile(ctl1_ta_file.get_id(), ctl1_ta_file.name)
-    dxpy.download_dxfile(ctl2_ta_file.get_id(), ctl2_ta_file.name)
-    dxpy.download_dxfile(rep1_xcor_file.get_id(), rep1_xcor_file.name)
-    dxpy.download_dxfile(rep2_xcor_file.get_id(), rep2_xcor_file.name)
-
-    rep1_ta_filename = rep1_ta_file.name
-    rep2_ta_filename = rep2_ta_file.name
-    ctl1_ta_filename = ctl1_ta_file.name
-    ctl2_ta_filename = ctl2_ta_file.name
-    rep1_xcor_filename = rep1_xcor_file.name
-    rep2_xcor_filename = rep2_xcor_file.name
-
-    ntags_rep1 = count_lines(rep1_ta_filename)
-    ntags_rep2 = count_lines(rep2_ta_filename)
-    ntags_ctl1 = count_lines(ctl1_ta_filename)
-    ntags_ctl2 = count_lines(ctl2_ta_filename)
-
-    for n,name,filename in [(ntags_rep1, 'replicate 1', rep1_ta_filename),
-                            (ntags_rep2, 'replicate 2', rep2_ta_filename),
-                            (ntags_ctl1, 'control 1', ctl1_ta_filename),
-                            (ntags_ctl2, 'control 2', ctl2_ta_filename)]:
-        print "Found %d tags in %s file %s" %(n,name,filename)
+    # Tag counts come from the tag_count property the producing applet set,
+    # so the tagAligns themselves stay where they are.
+    ntags_rep1, ntags_rep2, ntags_ctl1, ntags_ctl2 = common.count_tags_many(
+        [rep1_ta, rep2_ta, ctl1_ta, ctl2_ta])
 
-    print subprocess.check_output('ls -l', shell=True, stderr=subprocess.STDOUT)
+    for n,name,filename in [(ntags_rep1, 'replicate 1', rep1_ta_file.name),
+                            (ntags_rep2, 'replicate 2', rep2_ta_file.name),
+                            (ntags_ctl1, 'control 1', ctl1_ta_file.name),
+                            (ntags_ctl2, 'control 2', ctl2_ta_file.name)]:
+        print "Found %d tags in %s file %s" %(n,name,filename)
 
     pool_applet = dxpy.find_one_data_object(
         classname='applet', name='pool', zero_ok=False, more_ok=False, return_handler=True)
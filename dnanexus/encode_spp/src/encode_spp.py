@@ -15,50 +15,8 @@ import os, subprocess, shlex, time, re
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
-
-def run_pipe(steps, outfile=None):
-        #break this out into a recursive function
-        #TODO:  capture stderr
-        from subprocess import Popen, PIPE
-        p = None
-        p_next = None
-        first_step_n = 1
-        last_step_n = len(steps)
-        for n,step in enumerate(steps, start=first_step_n):
-                print "step %d: %s" %(n,step)
-                if n == first_step_n:
-                        if n == last_step_n and outfile: #one-step pipeline with outfile
-                                with open(outfile, 'w') as fh:
-                                        print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                                        p = Popen(shlex.split(step), stdout=fh)
-                                break
-                        print "first step shlex to stdout: %s" %(shlex.split(step))
-                        p = Popen(shlex.split(step), stdout=PIPE)
-                        #need to close p.stdout here?
-                elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-                        with open(outfile, 'w') as fh:
-                                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                                p.stdout.close()
-                                p = p_last
-                else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-                        print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-                        p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-                        p.stdout.close()
-                        p = p_next
-        out,err = p.communicate()
-        return out,err
-
-def count_lines(filename):
-        if filename.endswith(('.Z','.gz','.bz','.bz2')):
-                catcommand = 'gzip -dc'
-        else:
-                catcommand = 'cat'
-        out,err = run_pipe([
-                '%s %s' %(catcommand, filename),
-                'wc -l'
-        ])
-        return int(out)
+import common
+from common import run_pipe
 
 def spp(experiment, control, xcor_scores, chrom_sizes, bigbed=False, as_file=None, name='spp', prefix=None):
         spp_applet = dxpy.find_one_data_object(
@@ -99,35 +57,16 @@ def main(rep1_ta, rep2_ta, ctl1_ta, ctl2_ta, rep1_xcor, rep2_xcor, npeaks, nodup
         rep1_xcor_file = dxpy.DXFile(rep1_xcor)
         rep2_xcor_file = dxpy.DXFile(rep2_xcor)
 
-        # The following line(s) download your file inputs to the local file system
-        # using variable names for the filenames.
-
-        dxpy.download_dxfile(rep1_ta_file.get_id(), rep1_ta_file.name)
-        dxpy.download_dxfile(rep2_ta_file.get_id(), rep2_ta_file.name)
-        dxpy.download_dxfile(ctl1_ta_file.get_id(), ctl1_ta_file.name)
-        dxpy.download_dxfile(ctl2_ta_file.get_id(), ctl2_ta_file.name)
-        dxpy.download_dxfile(rep1_xcor_file.get_id(), rep1_xcor_file.name)
-        dxpy.download_dxfile(rep2_xcor_file.get_id(), rep2_xcor_file.name)
-
-        rep1_ta_filename = rep1_ta_file.name
-        rep2_ta_filename = rep2_ta_file.name
-        ctl1_ta_filename = ctl1_ta_file.name
-        ctl2_ta_filename = ctl2_ta_file.name
-        rep1_xcor_filename = rep1_xcor_file.name
-        rep2_xcor_filename = rep2_xcor_file.name
-
-        ntags_rep1 = count_lines(rep1_ta_filename)
-        ntags_rep2 = count_lines(rep2_ta_filename)
-        ntags_ctl1 = count_lines(ctl1_ta_filename)
-        ntags_ctl2 = count_lines(ctl2_ta_filename)
-
-        for n,name,filename in [(ntags_rep1, 'replicate 1', rep1_ta_filename),
-                                                        (ntags_rep2, 'replicate 2', rep2_ta_filename),
-                                                        (ntags_ctl1, 'control 1', ctl1_ta_filename),
-                                                        (ntags_ctl2, 'control 2', ctl2_ta_filename)]:
-                print "Found %d tags in %s file %s" %(n,name,filename)
+        # Tag counts come from the tag_count property the producing applet set,
+        # so the tagAligns themselves stay where they are.
+        ntags_rep1, ntags_rep2, ntags_ctl1, ntags_ctl2 = common.count_tags_many(
+            [rep1_ta, rep2_ta, ctl1_ta, ctl2_ta])
 
-        print subprocess.check_output('ls -l', shell=True, stderr=subprocess.STDOUT)
+        for n,name,filename in [(ntags_rep1, 'replicate 1', rep1_ta_file.name),
+                                                        (ntags_rep2, 'replicate 2', rep2_ta_file.name),
+                                                        (ntags_ctl1, 'control 1', ctl1_ta_file.name),
+                                                        (ntags_ctl2, 'control 2', ctl2_ta_file.name)]:
+                print "Found %d tags in %s file %s" %(n,name,filename)
 
         pool_applet = dxpy.find_one_data_object(
                 classname='applet', name='pool', project=dxpy.PROJECT_CONTEXT_ID,
@@ -11,10 +11,14 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time
+import os, subprocess, shlex, time, re, logging
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
+import common
+from common import run_pipe
+
+common.instrument()
 
 logger = logging.getLogger(__name__)
 
@@ -70,38 +74,103 @@ def pbc_parse(fname):
     return pbc_qc
 
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+
+
+def alignment_end(start, cigar):
+    # 0-based, half-open end coordinate as reported by bamToBed
+    # M, D, N, = and X are the CIGAR operations that consume the reference
+    return start + sum(int(n) for n, op in CIGAR_RE.findall(cigar) if op in 'MDN=X')
+
+
+def pbc_ratio(numerator, denominator):
+    if not denominator:
+        return float('nan')
+    return float(numerator)/float(denominator)
+
+
+def library_complexity(reads, paired_end, pbc_filename, exclude_chroms=['chrM'], flush_interval=100000):
+    # Single pass over the SAM lines of a position-sorted BAM.  Fragments are keyed by
+    # (chrom, start, end, strand) for SE and by
+    # (chrom1, start1, chrom2, end2, strand1, strand2) for PE, with read1 (flag
+    # 0x40) first whichever mate is leftmost, as bamToBed -bedpe reports it on a
+    # name-sorted BAM.
+    # Because the input is position-sorted, once the stream has moved past a
+    # fragment start (and past every pair still waiting for its mate) no more
+    # copies of that fragment can arrive, so its count is folded into the
+    # histogram and dropped.  Memory is bounded by the reads around the current
+    # position rather than by the size of the library.
+    histogram = {'mt': 0, 'm0': 0, 'm1': 0, 'm2': 0}
+    counts = {}
+    pending = {}
+    chrom_rank = {}
+    end_of_stream = (float('inf'),)
+
+    def rank(chrom):
+        if chrom not in chrom_rank:
+            chrom_rank[chrom] = len(chrom_rank)
+        return chrom_rank[chrom]
+
+    def flush(watermark):
+        for key in [k for k in counts if k[0] < watermark]:
+            n = counts.pop(key)
+            histogram['mt'] += n
+            histogram['m0'] += 1
+            if n == 1:
+                histogram['m1'] += 1
+            elif n == 2:
+                histogram['m2'] += 1
+
+    n_reads = 0
+    here = None
+    for line in reads:
+        if line.startswith('@'):
+            continue
+        qname, flag, chrom, pos, mapq, cigar, mate_chrom, mate_pos = line.split('\t', 8)[:8]
+        flag = int(flag)
+        if flag & 4: #bamToBed skips unmapped reads
+            continue
+        start = int(pos) - 1
+        here = (rank(chrom), start)
+        read = (here, chrom, start, alignment_end(start, cigar), '-' if flag & 16 else '+', bool(flag & 64))
+        n_reads += 1
+        if paired_end:
+            mate = pending.pop(qname, None)
+            if mate is None:
+                if mate_chrom == '=':
+                    mate_chrom = chrom
+                if mate_chrom in chrom_rank:
+                    mate_here = (chrom_rank[mate_chrom], int(mate_pos) - 1)
+                else:
+                    mate_here = end_of_stream
+                pending[qname] = read + (mate_here,)
+            else:
+                #read1 goes first; fall back to stream order if the flags don't say
+                if read[5] and not mate[5]:
+                    first, second = read, mate
+                else:
+                    first, second = mate, read
+                if first[1] not in exclude_chroms and second[1] not in exclude_chroms:
+                    key = (first[0], second[1], second[3], first[4], second[4])
+                    counts[key] = counts.get(key, 0) + 1
+        elif chrom not in exclude_chroms:
+            key = (here, read[3], read[4])
+            counts[key] = counts.get(key, 0) + 1
+        if n_reads % flush_interval == 0:
+            #reads whose mate position is already behind us are orphans and will never be completed
+            for orphan in [k for k, v in pending.iteritems() if v[6] < here]:
+                del pending[orphan]
+            watermark = min([here] + [v[0] for v in pending.itervalues()])
+            flush(watermark)
+    if pending:
+        print "Skipped %d reads whose mates were not found" %(len(pending))
+    flush(end_of_stream)
+
+    mt, m0, m1, m2 = [histogram[k] for k in ['mt', 'm0', 'm1', 'm2']]
+    with open(pbc_filename, 'w') as fh:
+        fh.write("%d\t%d\t%d\t%d\t%f\t%f\t%f\n" %(mt, m0, m1, m2, pbc_ratio(m0, mt), pbc_ratio(m1, m0), pbc_ratio(m1, m2)))
+    return pbc_filename
+
 
 @dxpy.entry_point('main')
 def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None, debug=False): #
@@ -146,6 +215,17 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
 
     filt_bam_prefix = raw_bam_basename + ".filt.srt" 
     filt_bam_filename = filt_bam_prefix + ".bam"
+    if paired_end:
+        final_bam_prefix = raw_bam_basename + ".filt.srt.nodup"
+    else:
+        final_bam_prefix = raw_bam_basename + ".filt.nodup.srt"
+    final_bam_filename = final_bam_prefix + ".bam" # To be stored
+    final_bam_index_filename = final_bam_prefix + ".bai" # To be stored
+    final_bam_file_mapstats_filename = final_bam_prefix + ".flagstat.qc" # QC file
+
+    dup_file_qc_filename = raw_bam_basename + ".dup.qc"
+    pbc_file_qc_filename = final_bam_prefix + ".pbc.qc"
+
     if paired_end:
         # =============================
         # Remove  unmapped, mate unmapped
@@ -194,21 +274,12 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
     # Mark duplicates
     # ======================
     tmp_filt_bam_filename = raw_bam_basename + ".dupmark.bam"
-    dup_file_qc_filename = raw_bam_basename + ".dup.qc"
     subprocess.check_call(shlex.split(
         "java -Xmx4G -jar /picard/MarkDuplicates.jar INPUT=%s OUTPUT=%s METRICS_FILE=%s \
          VALIDATION_STRINGENCY=LENIENT ASSUME_SORTED=true REMOVE_DUPLICATES=false"
          %(filt_bam_filename, tmp_filt_bam_filename, dup_file_qc_filename)))
     os.rename(tmp_filt_bam_filename,filt_bam_filename)
 
-    if paired_end:
-        final_bam_prefix = raw_bam_basename + ".filt.srt.nodup"
-    else:
-        final_bam_prefix = raw_bam_basename + ".filt.nodup.srt"
-    final_bam_filename = final_bam_prefix + ".bam" # To be stored
-    final_bam_index_filename = final_bam_prefix + ".bai" # To be stored
-    final_bam_file_mapstats_filename = final_bam_prefix + ".flagstat.qc" # QC file
-
     if paired_end:
         # ============================
         # Remove duplicates
@@ -230,42 +301,24 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
         with open(final_bam_filename, 'w') as fh:
             subprocess.check_call(shlex.split("samtools view -F 1804 -b %s"
                 %(filt_bam_filename)), stdout=fh)
-    # Index final bam file
-    subprocess.check_call(shlex.split("samtools index %s %s" %(final_bam_filename, final_bam_index_filename)))
-    # Generate mapping statistics
-    with open(final_bam_file_mapstats_filename, 'w') as fh:
-        subprocess.check_call(shlex.split("samtools flagstat %s"
-            %(final_bam_filename)), stdout=fh)
-
     # =============================
     # Compute library complexity
     # =============================
-    # Sort by name
-    # convert to bedPE and obtain fragment coordinates
-    # sort by position and strand
+    # Stream the position-sorted BAM once and count reads (or read pairs) by
+    # fragment coordinates and strand
     # Obtain unique count statistics
-    pbc_file_qc_filename = final_bam_prefix + ".pbc.qc"
     # PBC File output
     # TotalReadPairs [tab] DistinctReadPairs [tab] OneReadPair [tab] TwoReadPairs [tab] NRF=Distinct/Total [tab] PBC1=OnePair/Distinct [tab] PBC2=OnePair/TwoPair
-    if paired_end:
-        steps = [
-            "samtools sort -no %s -" %(filt_bam_filename),
-            "bamToBed -bedpe -i stdin",
-            r"""awk 'BEGIN{OFS="\t"}{print $1,$2,$4,$6,$9,$10}'"""]
-    else:
-        steps = [
-            "bamToBed -i %s" %(filt_bam_filename), #for some reason 'bedtools bamtobed' does not work but bamToBed does
-            r"""awk 'BEGIN{OFS="\t"}{print $1,$2,$3,$6}'"""]
-    # these st
-    steps.extend([
-        "grep -v 'chrM'", #TODO this should be implemented as an explicit list of allowable names, so that mapping can be done to a complete reference
-        "sort",
-        "uniq -c",
-        r"""awk 'BEGIN{mt=0;m0=0;m1=0;m2=0} ($1==1){m1=m1+1} ($1==2){m2=m2+1} {m0=m0+1} {mt=mt+$1} END{printf "%d\t%d\t%d\t%d\t%f\t%f\t%f\n",mt,m0,m1,m2,m0/mt,m1/m0,m1/m2}'"""
-        ])
-    out,err = run_pipe(steps,pbc_file_qc_filename)
-    if err:
-        print "PBC file error: %s" %(err)
+    #TODO the excluded chromosomes should be an explicit list of allowable names, so that mapping can be done to a complete reference
+    with common.Pipeline(["samtools view %s" %(filt_bam_filename)]) as view:
+        library_complexity(view.stdout, paired_end, pbc_file_qc_filename, exclude_chroms=['chrM'])
+
+    # Index final bam file
+    subprocess.check_call(shlex.split("samtools index %s %s" %(final_bam_filename, final_bam_index_filename)))
+    # Generate mapping statistics
+    with open(final_bam_file_mapstats_filename, 'w') as fh:
+        subprocess.check_call(shlex.split("samtools flagstat %s"
+            %(final_bam_filename)), stdout=fh)
 
     print "Uploading results files to the project"
     # Use the Python bindings to upload the file outputs to the project.
@@ -292,6 +345,8 @@ def main(input_bam=None, paired_end=None, samtools_params=None, input_JSON=None,
         "PBC2": pbc_qc.get('PBC2'),
         "duplicate_fraction": dup_qc.get('percent_duplication')
     }
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     output.update({'output_JSON': output.copy()})
 
     print "Exiting with output: %s" % (output)
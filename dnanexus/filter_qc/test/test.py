@@ -2,7 +2,7 @@
 # filter_qc 0.0.1 test suite
 # Generated by dx-app-wizard.
 
-import json, os, time, unittest
+import json, os, sys, tempfile, shutil, time, unittest
 
 import dxpy
 import dxpy.app_builder
@@ -11,6 +11,8 @@ from dxpy.exceptions import DXAPIError
 
 src_dir = os.path.join(os.path.dirname(__file__), "..")
 test_resources_dir = os.path.join(src_dir, "test", "resources")
+sys.path.insert(0, os.path.join(src_dir, "src"))
+sys.path.insert(0, os.path.join(src_dir, "resources", "home", "dnanexus"))
 
 def makeInputs():
     # Please fill in this method to generate default inputs for your app.
@@ -53,5 +55,55 @@ class Testfilter_qc(unittest.TestCase):
         job.wait_on_done()
         print json.dumps(job.describe()["output"])
 
+def sam_line(qname, flag, chrom, pos, cigar='50M', mate_pos=0):
+    return '\t'.join([qname, str(flag), chrom, str(pos), '60', cigar, '=', str(mate_pos), '0', '*', '*']) + '\n'
+
+class TestLibraryComplexity(unittest.TestCase):
+    # Runs locally against filter_qc.library_complexity; no platform needed.
+    # Expected values are what samtools sort -n | bamToBed -bedpe | awk
+    # '{print $1,$2,$4,$6,$9,$10}' | sort | uniq -c gives for the same reads.
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pbc(self, reads, paired_end):
+        import filter_qc
+        fn = os.path.join(self.tmpdir, 'pbc.qc')
+        filter_qc.library_complexity(reads, paired_end, fn, flush_interval=2)
+        with open(fn) as fh:
+            return [int(x) for x in fh.read().split('\t')[:4]]
+
+    def test_paired_end_keys_on_read1(self):
+        reads = [
+            '@HD\tVN:1.0\tSO:coordinate\n',
+            sam_line('A', 99, 'chr1', 101, mate_pos=301),
+            sam_line('B', 163, 'chr1', 101, mate_pos=301),
+            sam_line('C', 99, 'chr1', 101, mate_pos=301),
+            sam_line('A', 147, 'chr1', 301, mate_pos=101),
+            sam_line('B', 83, 'chr1', 301, mate_pos=101),
+            sam_line('C', 147, 'chr1', 301, mate_pos=101),
+            sam_line('D', 99, 'chr1', 401, cigar='10M5D40M', mate_pos=501),
+            sam_line('D', 147, 'chr1', 501, mate_pos=401),
+            sam_line('M', 99, 'chrM', 11, mate_pos=201),
+            sam_line('M', 147, 'chrM', 201, mate_pos=11),
+        ]
+        # A and C are copies of one fragment; B covers the same span with
+        # read1 on the right, so bamToBed -bedpe gives it its own key
+        self.assertEqual(self.pbc(reads, True), [4, 3, 2, 1])
+
+    def test_single_end(self):
+        reads = [
+            sam_line('A', 0, 'chr1', 101),
+            sam_line('B', 0, 'chr1', 101),
+            sam_line('C', 16, 'chr1', 101),
+            sam_line('D', 16, 'chr1', 101, cigar='40M'),
+            sam_line('E', 4, 'chr1', 101),
+            sam_line('F', 0, 'chrM', 101),
+        ]
+        self.assertEqual(self.pbc(reads, False), [4, 3, 2, 1])
+
 if __name__ == '__main__':
     unittest.main()
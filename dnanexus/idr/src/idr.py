@@ -13,75 +13,57 @@
 
 import os, re, logging, subprocess, shlex, sys, time, math
 import dxpy
-
-def run_pipe(steps, outfile=None, debug=True):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-
-    if debug:
-        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-    else: # use the defaulf logging level
-        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
-
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        #logging.info("step %d: %s" %(n,step))
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    logging.info("one step shlex: %s to file: %s" %(shlex.split(step), outfile))
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            #logging.info("first step shlex to stdout: %s" %(shlex.split(step)))
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                #logging.info("last step shlex: %s to file: %s" %(shlex.split(step), outfile))
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            #logging.info("intermediate step %d shlex to stdout: %s" %(n,shlex.split(step)))
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    if err:
-        #logging.warning(err)
-        print "stderr: %s" %(err)
-    return out,err
-
-def common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename):
-    print pooled_peaks_filename
-    print rep1_peaks_filename
-    print rep2_peaks_filename
-    print pooled_common_peaks_filename
-    return run_pipe([
-        'intersectBed -u -a %s -b %s' %(pooled_peaks_filename, rep1_peaks_filename),
-        'intersectBed -u -a - -b %s' %(rep2_peaks_filename),
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n'
-        #'gzip -c'
-    ], pooled_common_peaks_filename)
-
-def common_peaks_recalibrated(pooled_common_peaks_filename, rep_peaks_filename, common_match_filename):
-    #time.sleep(3600)
-    return run_pipe([
-        'intersectBed -wa -wb -a %s -b %s' %(pooled_common_peaks_filename, rep_peaks_filename),
-        r"""awk 'BEGIN{OFS="\t"}{d=$2+$10-$12-$20;$21=sqrt(d^2);print $0}'""",
-        'groupBy -i - -g 1,2,3,10 -c 21 -o min -full',
-        'sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n',
-        r"""awk 'BEGIN{OFS="\t"}{print $1,$2+$10-2,$2+$10+2,$4,$5,$6,$17,$18,$19,2}'"""
-        #'qzip -c'
-    ], common_match_filename)
+import common
+from common import run_pipe
+
+common.instrument()
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+
+def _peak_sort_key(row):
+    # sort -k7n,7n -k1,1 -k2n,2n -k3n,3n -k10n,10n, whole line last
+    return (float(row[6]), row[0], float(row[1]), float(row[2]), float(row[9]), '\t'.join(row))
+
+def common_peaks_matched(pooled_peaks_filename, rep_peaks_filenames, pooled_common_peaks_filename, common_match_filenames):
+    # Pooled peaks that overlap a peak in every replicate go to
+    # pooled_common_peaks_filename, ordered by signal.  Then for each
+    # replicate, each of those pooled peaks is matched to the overlapping
+    # replicate peak with the nearest summit and written to that
+    # replicate's common_match file as the pooled summit +/- 2 bp carrying
+    # the replicate peak's signal, p and q values.  The pooled and
+    # replicate peaks are each read once.
+    import numpy
+
+    pooled = common.read_bed(pooled_peaks_filename)
+    reps = [common.read_bed(fn) for fn in rep_peaks_filenames]
+    indexes = [common.IntervalIndex(rep) for rep in reps]
+
+    found = numpy.ones(len(pooled), dtype=bool)
+    for index in indexes:
+        found &= index.overlaps_any(pooled)
+    pooled_common = sorted([pooled[i] for i in numpy.flatnonzero(found)], key=_peak_sort_key)
+    with open(pooled_common_peaks_filename, 'w') as fh:
+        fh.writelines('\t'.join(row) + '\n' for row in pooled_common)
+
+    pooled_summits = numpy.array([int(row[1]) + int(row[9]) for row in pooled_common], dtype=numpy.int64)
+    for rep, index, common_match_filename in zip(reps, indexes, common_match_filenames):
+        rep_summits = numpy.array([int(row[1]) + int(row[9]) for row in rep], dtype=numpy.int64)
+        query, matched = index.overlap_pairs(pooled_common)
+        distance = numpy.abs(pooled_summits[query] - rep_summits[matched])
+        # nearest summit for each pooled peak, the first in the replicate
+        # file if there is a tie
+        order = numpy.lexsort((matched, distance, query))
+        query, matched = query[order], matched[order]
+        nearest = numpy.ones(len(query), dtype=bool)
+        nearest[1:] = query[1:] != query[:-1]
+        match = numpy.empty(len(pooled_common), dtype=numpy.int64)
+        match[query[nearest]] = matched[nearest]
+        with open(common_match_filename, 'w') as fh:
+            for row, summit, m in zip(pooled_common, pooled_summits, match):
+                rep_row = rep[m]
+                fh.write('\t'.join([row[0], str(summit-2), str(summit+2), row[3], row[4], row[5],
+                                     rep_row[6], rep_row[7], rep_row[8], '2']) + '\n')
+    return pooled_common_peaks_filename, common_match_filenames
 
 def uncompress(filename):
     m = re.match('(.*)(\.((gz)|(Z)|(bz)|(bz2)))',filename)
@@ -113,7 +95,6 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         # Find peaks in pooled set common to both replicates
         # =============================
         pooled_common_peaks_filename = '%s_pool_common.narrowPeak' %(os.path.basename(pooled_peaks_filename))
-        common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename)
 
         # =============================
         # Create 2 new peak file per replicate with coordinates from common pooled set
@@ -123,8 +104,9 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
         common_rep1_match_filename = '%s_common_match.narrowPeak' %(os.path.basename(rep1_peaks_filename))
         common_rep2_match_filename = '%s_common_match.narrowPeak' %(os.path.basename(rep2_peaks_filename))
 
-        common_peaks_recalibrated(pooled_common_peaks_filename, rep1_peaks_filename, common_rep1_match_filename)
-        common_peaks_recalibrated(pooled_common_peaks_filename, rep2_peaks_filename, common_rep2_match_filename)
+        with common.timed(pooled_common_peaks_filename, 'common peaks'):
+            common_peaks_matched(pooled_peaks_filename, [rep1_peaks_filename, rep2_peaks_filename],
+                                 pooled_common_peaks_filename, [common_rep1_match_filename, common_rep2_match_filename])
 
         # =============================
         # Pass recalibrated peak files to IDR
@@ -247,7 +229,7 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
 
 
 @dxpy.entry_point('main')
-def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive):
+def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive, extra_idr_thresholds=None):
 
     # Initialize the data object inputs on the platform into
     # dxpy.DXDataObject instances.
@@ -264,10 +246,11 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
 
     # Download the file inputs to the local file system.
 
-    dxpy.download_dxfile(rep1_peaks_file.get_id(), rep1_peaks_filename)
-    dxpy.download_dxfile(rep2_peaks_file.get_id(), rep2_peaks_filename)
-    dxpy.download_dxfile(pooled_peaks_file.get_id(), pooled_peaks_filename)    
-
+    # .gz peaks are inflated as they download; uncompress handles the rest
+    rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename = common.download_many([
+        (rep1_peaks_file, rep1_peaks_filename, True),
+        (rep2_peaks_file, rep2_peaks_filename, True),
+        (pooled_peaks_file, pooled_peaks_filename, True)])
 
     rep1_peaks_filename = uncompress(rep1_peaks_filename)
     rep2_peaks_filename = uncompress(rep2_peaks_filename)
@@ -288,26 +271,21 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
         interactive=interactive)
 
     # =============================
-    # Get peaks passing the IDR threshold
+    # Get peaks passing the IDR threshold, and any extra thresholds, in one
+    # pass over the IDR output
     # =============================
     if idr_version == 1:
-        awk_string = r"""awk 'BEGIN{OFS="\t"} $14<=%2.2f {print $1,$2,$3,$4,$5,$6,$7,$8,$9,$10}'""" %(idr_threshold)
+        column, minus_log10 = 14, False
     elif idr_version ==2:
-        awk_string = r"""awk 'BEGIN{OFS="\t"} $12>=%2.2f {print $1,$2,$3,$4,$5,$6,$7,$8,$9,$10}'""" %(-math.log10(idr_threshold))
-    final_IDR_thresholded_filename = rep1_vs_rep2_prefix + '.IDR%2.2f.narrowPeak' %(idr_threshold)
-    run_pipe([
-        'cat %s' %(pooled_common_peaks_IDR_filename),
-        awk_string,
-        'sort -k7n,7n'
-        #'gzip -c'
-    ], final_IDR_thresholded_filename)
+        column, minus_log10 = 12, True
+    thresholded = common.threshold_idr_peaks(
+        pooled_common_peaks_IDR_filename, [idr_threshold] + (extra_idr_thresholds or []),
+        column, rep1_vs_rep2_prefix, minus_log10=minus_log10)
+    final_IDR_thresholded_filename, n_peaks = thresholded[0]
 
     npeaks_pass_filename = rep1_vs_rep2_prefix + '-npeaks-aboveIDR.txt'
-    wc_output = subprocess.check_output(shlex.split('wc -l %s' %(final_IDR_thresholded_filename)))
     with open(npeaks_pass_filename, 'w') as fh:
-        fh.write(wc_output)
-    line_count = wc_output.split()[0]
-    n_peaks = int(line_count)
+        fh.write('%d %s\n' %(n_peaks, common.rstrips(final_IDR_thresholded_filename, '.gz')))
 
     #TODO batch consistency plot
 
@@ -320,10 +298,11 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
 
     if idr_version == 1:
         IDR_overlap_narrowpeak_filename = compress(IDR_overlap_narrowpeak_filename)
-        overlapped_peaks = dxpy.upload_local_file(IDR_overlap_narrowpeak_filename)
-        EM_fit_output = dxpy.upload_local_file(rep1_vs_rep2_prefix + '-em.sav')
-        empirical_curves_output = dxpy.upload_local_file(rep1_vs_rep2_prefix + '-uri.sav')
-        EM_parameters_log = dxpy.upload_local_file(rep1_vs_rep2_prefix + '-Rout.txt')
+        overlapped_peaks, EM_fit_output, empirical_curves_output, EM_parameters_log = common.upload_many([
+            IDR_overlap_narrowpeak_filename,
+            rep1_vs_rep2_prefix + '-em.sav',
+            rep1_vs_rep2_prefix + '-uri.sav',
+            rep1_vs_rep2_prefix + '-Rout.txt'])
         output.update({
             "EM_fit_output": dxpy.dxlink(EM_fit_output),
             "empirical_curves_output": dxpy.dxlink(empirical_curves_output),
@@ -333,15 +312,21 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
         EM_fit_output = None
         empirical_curves_output = None
         overlapped_peaks = None
-        EM_parameters_log = dxpy.upload_local_file(rep1_vs_rep2_prefix + '.log.txt')
-        IDR2_plot = dxpy.upload_local_file(pooled_common_peaks_IDR_filename + '.png')
+        EM_parameters_log, IDR2_plot = common.upload_many([
+            rep1_vs_rep2_prefix + '.log.txt',
+            pooled_common_peaks_IDR_filename + '.png'])
         output.update({
             "IDR2_plot": dxpy.dxlink(IDR2_plot)
             })
 
-    npeaks_pass = dxpy.upload_local_file(npeaks_pass_filename)
-    IDR_output = dxpy.upload_local_file(compress(pooled_common_peaks_IDR_filename))
-    IDR_peaks = dxpy.upload_local_file(compress(final_IDR_thresholded_filename))
+    uploaded = common.upload_many([
+        npeaks_pass_filename,
+        compress(pooled_common_peaks_IDR_filename)] +
+        [filename for filename, n in thresholded])
+    npeaks_pass, IDR_output, IDR_peaks = uploaded[:3]
+    if extra_idr_thresholds:
+        output.update({"extra_IDR_peaks": [dxpy.dxlink(f) for f in uploaded[3:]],
+                       "extra_N": [n for filename, n in thresholded[1:]]})
 
     #
     # return { "app_output_field": postprocess_job.get_output_ref("answer"), ...}
@@ -357,6 +342,8 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, interactive)
         "N": n_peaks
     })
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     logging.info("Exiting with output: %s", output)
     return output
 
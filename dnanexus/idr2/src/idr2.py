@@ -13,52 +13,12 @@
 
 import os, re, logging, subprocess, shlex, sys, time, math
 import dxpy
+import common
+from common import run_pipe
 
-def run_pipe(steps, outfile=None, debug=True):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-
-    if debug:
-        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-    else: # use the defaulf logging level
-        logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
-
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        #logging.info("step %d: %s" %(n,step))
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    logging.info("one step shlex: %s to file: %s" %(shlex.split(step), outfile))
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            #logging.info("first step shlex to stdout: %s" %(shlex.split(step)))
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                #logging.info("last step shlex: %s to file: %s" %(shlex.split(step), outfile))
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            #logging.info("intermediate step %d shlex to stdout: %s" %(n,shlex.split(step)))
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    if err:
-        #logging.warning(err)
-        print "stderr: %s" %(err)
-    return out,err
+common.instrument()
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 
 def common_peaks(pooled_peaks_filename, rep1_peaks_filename, rep2_peaks_filename, pooled_common_peaks_filename):
     print pooled_peaks_filename
@@ -146,7 +106,7 @@ def run_idr(rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename, rep
     return pooled_common_peaks_IDR_filename, None
 
 @dxpy.entry_point('main')
-def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
+def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank, extra_idr_thresholds=None):
 
     # Initialize the data object inputs on the platform into
     # dxpy.DXDataObject instances.
@@ -161,10 +121,11 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
 
     # Download the file inputs to the local file system.
 
-    dxpy.download_dxfile(rep1_peaks_file.get_id(), rep1_peaks_filename)
-    dxpy.download_dxfile(rep2_peaks_file.get_id(), rep2_peaks_filename)
-    dxpy.download_dxfile(pooled_peaks_file.get_id(), pooled_peaks_filename)    
-
+    # .gz peaks are inflated as they download; uncompress handles the rest
+    rep1_peaks_filename, rep2_peaks_filename, pooled_peaks_filename = common.download_many([
+        (rep1_peaks_file, rep1_peaks_filename, True),
+        (rep2_peaks_file, rep2_peaks_filename, True),
+        (pooled_peaks_file, pooled_peaks_filename, True)])
 
     rep1_peaks_filename = uncompress(rep1_peaks_filename)
     rep2_peaks_filename = uncompress(rep2_peaks_filename)
@@ -184,25 +145,19 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
         rank=rank)
 
     # =============================
-    # Get peaks passing the IDR threshold
+    # Get peaks passing the IDR threshold, and any extra thresholds, in one
+    # pass over the IDR output
     # =============================
     # Due to rounding, filtering in this way will produce a different number of peaks than if IDR were passed a cutoff directly
     # but the difference is relatively very small in comparison to the total number of peaks
-    awk_string = r"""awk 'BEGIN{OFS="\t"} $12>=%2.2f {print $1,$2,$3,$4,$5,$6,$7,$8,$9,$10}'""" %(-math.log10(idr_threshold))
-    final_IDR_thresholded_filename = rep1_vs_rep2_prefix + '.IDR%2.2f.narrowPeak' %(idr_threshold)
-    run_pipe([
-        'cat %s' %(pooled_common_peaks_IDR_filename),
-        awk_string,
-        'sort -k7n,7n'
-        #'gzip -c'
-    ], final_IDR_thresholded_filename)
+    thresholded = common.threshold_idr_peaks(
+        pooled_common_peaks_IDR_filename, [idr_threshold] + (extra_idr_thresholds or []),
+        12, rep1_vs_rep2_prefix, minus_log10=True)
+    final_IDR_thresholded_filename, n_peaks = thresholded[0]
 
     npeaks_pass_filename = rep1_vs_rep2_prefix + '-npeaks-aboveIDR.txt'
-    wc_output = subprocess.check_output(shlex.split('wc -l %s' %(final_IDR_thresholded_filename)))
     with open(npeaks_pass_filename, 'w') as fh:
-        fh.write(wc_output)
-    line_count = wc_output.split()[0]
-    n_peaks = int(line_count)
+        fh.write('%d %s\n' %(n_peaks, common.rstrips(final_IDR_thresholded_filename, '.gz')))
 
     #TODO batch consistency plot
 
@@ -216,15 +171,21 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
     EM_fit_output = None
     empirical_curves_output = None
     overlapped_peaks = None
-    EM_parameters_log = dxpy.upload_local_file(rep1_vs_rep2_prefix + '.log.txt')
-    IDR2_plot = dxpy.upload_local_file(pooled_common_peaks_IDR_filename + '.png')
+    EM_parameters_log, IDR2_plot = common.upload_many([
+        rep1_vs_rep2_prefix + '.log.txt',
+        pooled_common_peaks_IDR_filename + '.png'])
     output.update({
         "IDR2_plot": dxpy.dxlink(IDR2_plot)
         })
 
-    npeaks_pass = dxpy.upload_local_file(npeaks_pass_filename)
-    IDR_output = dxpy.upload_local_file(compress(pooled_common_peaks_IDR_filename))
-    IDR_peaks = dxpy.upload_local_file(compress(final_IDR_thresholded_filename))
+    uploaded = common.upload_many([
+        npeaks_pass_filename,
+        compress(pooled_common_peaks_IDR_filename)] +
+        [filename for filename, n in thresholded])
+    npeaks_pass, IDR_output, IDR_peaks = uploaded[:3]
+    if extra_idr_thresholds:
+        output.update({"extra_IDR_peaks": [dxpy.dxlink(f) for f in uploaded[3:]],
+                       "extra_N": [n for filename, n in thresholded[1:]]})
 
     #
     # return { "app_output_field": postprocess_job.get_output_ref("answer"), ...}
@@ -240,6 +201,8 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, idr_threshold, rank):
         "N": n_peaks
     })
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     logging.info("Exiting with output: %s", output)
     return output
 
@@ -14,8 +14,43 @@
 import os, time, common
 import dxpy
 
+common.instrument()
+
+def separate_callpeaks(callpeak_args, experiment_fn, control_fn, peaks_dirname, prefix):
+    # The original two callpeak runs and two bdgcmp runs.  Still the default:
+    # macs2_callpeak_combined relies on the internals of the installed MACS2
+    # and its output has not been compared with these runs'
+
+    for command in ['macs2 callpeak %s -B --SPMR' %(callpeak_args),
+                    'macs2 callpeak %s --broad' %(callpeak_args),
+                    'macs2 bdgcmp ' + \
+                    '-t %s/%s_treat_pileup.bdg ' %(peaks_dirname, prefix) + \
+                    '-c %s/%s_control_lambda.bdg ' %(peaks_dirname, prefix) + \
+                    '--outdir %s -o %s_FE.bdg ' %(peaks_dirname, prefix) + \
+                    '-m FE']:
+        print command
+        returncode = common.block_on(command)
+        print "MACS2 exited with returncode %d" %(returncode)
+        assert returncode == 0, "MACS2 non-zero return"
+
+    # Compute sval = min(no. of reads in ChIP, no. of reads in control) / 1,000,000
+
+    chipReads, controlReads = common.count_lines_many([experiment_fn, control_fn])
+    sval=str(min(float(chipReads), float(controlReads))/1000000)
+
+    print "chipReads = %s, controlReads = %s, sval = %s" %(chipReads, controlReads, sval)
+
+    returncode = common.block_on(
+        'macs2 bdgcmp ' + \
+        '-t %s/%s_treat_pileup.bdg ' %(peaks_dirname, prefix) + \
+        '-c %s/%s_control_lambda.bdg ' %(peaks_dirname, prefix) + \
+        '--outdir %s -o %s_ppois.bdg ' %(peaks_dirname, prefix) + \
+        '-m ppois -S %s' %(sval))
+    print "MACS2 exited with returncode %d" %(returncode)
+    assert returncode == 0, "MACS2 non-zero return"
+
 @dxpy.entry_point('main')
-def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gappedpeak_as, broadpeak_as, genomesize, prefix=None):
+def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gappedpeak_as, broadpeak_as, genomesize, prefix=None, combined=False):
 
     # Initialize data object inputs on the platform
     # into dxpy.DXDataObject instances.
@@ -31,13 +66,14 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
     # Download the file inputs to the local file system
     # and use their own filenames.
 
-    dxpy.download_dxfile(experiment.get_id(),        experiment.name)
-    dxpy.download_dxfile(control.get_id(),           control.name)
-    dxpy.download_dxfile(xcor_scores_input.get_id(), xcor_scores_input.name)
-    dxpy.download_dxfile(chrom_sizes.get_id(),       chrom_sizes.name)
-    dxpy.download_dxfile(narrowPeak_as.get_id(),     narrowPeak_as.name)
-    dxpy.download_dxfile(gappedPeak_as.get_id(),     gappedPeak_as.name)
-    dxpy.download_dxfile(broadPeak_as.get_id(),      broadPeak_as.name)
+    common.download_many([
+        (experiment,        experiment.name),
+        (control,           control.name),
+        (xcor_scores_input, xcor_scores_input.name),
+        (chrom_sizes,       chrom_sizes.name),
+        (narrowPeak_as,     narrowPeak_as.name),
+        (gappedPeak_as,     gappedPeak_as.name),
+        (broadPeak_as,      broadPeak_as.name)])
 
     #Define the output filenames
 
@@ -68,168 +104,80 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
         print "Fraglen %s" %(fraglen)
 
     #===========================================
-    # Generate narrow peaks and preliminary signal tracks
+    # Generate narrow, broad and gapped peaks and the FE and ppois bedGraphs
     #============================================
 
-    command = 'macs2 callpeak ' + \
-              '-t %s -c %s ' %(experiment.name, control.name) + \
-              '-f BED -n %s/%s ' %(peaks_dirname, prefix) + \
-              '-g %s -p 1e-2 --nomodel --shift 0 --extsize %s --keep-dup all -B --SPMR' %(genomesize, fraglen)
-    print command
-    returncode = common.block_on(command)
-    print "MACS2 exited with returncode %d" %(returncode)
-    assert returncode == 0, "MACS2 non-zero return"
-
-    # MACS2 sometimes calls features off the end of chromosomes.  Fix that.
-    clipped_narrowpeak_fn = common.slop_clip('%s/%s_peaks.narrowPeak' %(peaks_dirname, prefix), chrom_sizes.name)
-
-    # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_narrowpeak_fn = common.rescale_scores(clipped_narrowpeak_fn, scores_col=5)
-
-    # Sort by Col8 in descending order and replace long peak names in Column 4 with Peak_<peakRank>
-    pipe = ['sort -k 8gr,8gr %s' %(rescaled_narrowpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(narrowPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(narrowPeak_gz_fn))
-
-    # remove additional files
-    #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.xls ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.bed ${peakFile}_summits.bed
-
-    #===========================================
-    # Generate Broad and Gapped Peaks
-    #============================================
-
-    command = 'macs2 callpeak ' + \
-              '-t %s -c %s ' %(experiment.name, control.name) + \
-              '-f BED -n %s/%s ' %(peaks_dirname, prefix) + \
-              '-g %s -p 1e-2 --broad --nomodel --shift 0 --extsize %s --keep-dup all' %(genomesize, fraglen)
-    print command
-    returncode = common.block_on(command)
-    print "MACS2 exited with returncode %d" %(returncode)
-    assert returncode == 0, "MACS2 non-zero return"
-
-    # MACS2 sometimes calls features off the end of chromosomes.  Fix that.
-    clipped_broadpeak_fn = common.slop_clip('%s/%s_peaks.broadPeak' %(peaks_dirname, prefix), chrom_sizes.name)
-
-    # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_broadpeak_fn = common.rescale_scores(clipped_broadpeak_fn, scores_col=5)
-
-    # Sort by Col8 (for broadPeak) or Col 14(for gappedPeak)  in descending order and replace long peak names in Column 4 with Peak_<peakRank>
-    pipe = ['sort -k 8gr,8gr %s' %(rescaled_broadpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(broadPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(broadPeak_gz_fn))
-
-    # MACS2 sometimes calls features off the end of chromosomes.  Fix that.
-    clipped_gappedpeaks_fn = common.slop_clip('%s/%s_peaks.gappedPeak' %(peaks_dirname, prefix), chrom_sizes.name)
-
-    # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000)
-    rescaled_gappedpeak_fn = common.rescale_scores(clipped_gappedpeaks_fn, scores_col=5)
-
-    pipe = ['sort -k 14gr,14gr %s' %(rescaled_gappedpeak_fn),
-            r"""awk 'BEGIN{OFS="\t"}{$4="Peak_"NR ; print $0}'""",
-            'tee %s' %(gappedPeak_fn),
-            'gzip -c']
-    print pipe
-    out,err = common.run_pipe(pipe,'%s' %(gappedPeak_gz_fn))
+    callpeak_args = \
+        '-t %s -c %s ' %(experiment.name, control.name) + \
+        '-f BED -n %s/%s ' %(peaks_dirname, prefix) + \
+        '-g %s -p 1e-2 --nomodel --shift 0 --extsize %s --keep-dup all' %(genomesize, fraglen)
+    fc_bedgraph_fn   = '%s/%s.fc.signal.bedgraph'   %(peaks_dirname, prefix)
+    pval_bedgraph_fn = '%s/%s.pval.signal.bedgraph' %(peaks_dirname, prefix)
+
+    if combined:
+        # Read and pile up the tags once for all three peak sets and both tracks,
+        # which are clipped to chrom_sizes as they are written
+        command = 'macs2_callpeak_combined %s -B --SPMR ' %(callpeak_args) + \
+                  '--fe-bdg %s --ppois-bdg %s ' %(fc_bedgraph_fn, pval_bedgraph_fn) + \
+                  '--chrom-sizes %s' %(chrom_sizes.name)
+        print command
+        returncode = common.block_on(command)
+        print "MACS2 exited with returncode %d" %(returncode)
+        assert returncode == 0, "MACS2 non-zero return"
+    else:
+        separate_callpeaks(callpeak_args, experiment.name, control.name, peaks_dirname, prefix)
+        # Remove coordinates outside chromosome sizes (stupid MACS2 bug)
+        for bdg_fn, bedgraph_fn in [('%s/%s_FE.bdg' %(peaks_dirname, prefix), fc_bedgraph_fn),
+                                    ('%s/%s_ppois.bdg' %(peaks_dirname, prefix), pval_bedgraph_fn)]:
+            pipe = ['slopBed -i %s -g %s -b 0' %(bdg_fn, chrom_sizes.name),
+                    'bedClip stdin %s %s' %(chrom_sizes.name, bedgraph_fn)]
+            print pipe
+            out, err = common.run_pipe(pipe)
+            os.remove(bdg_fn)
+
+    # The pileups are only needed for the signal tracks
+    for bdg_fn in ['%s/%s_treat_pileup.bdg' %(peaks_dirname, prefix),
+                   '%s/%s_control_lambda.bdg' %(peaks_dirname, prefix)]:
+        os.remove(bdg_fn)
+
+    # Sort by Col8 (for narrowPeak and broadPeak) or Col 14(for gappedPeak) in descending order
+    for macs2_peaks_fn, peaks_fn, peaks_gz_fn, sort_col in [
+            ('%s/%s_peaks.narrowPeak' %(peaks_dirname, prefix), narrowPeak_fn, narrowPeak_gz_fn, 8),
+            ('%s/%s_peaks.broadPeak'  %(peaks_dirname, prefix), broadPeak_fn,  broadPeak_gz_fn,  8),
+            ('%s/%s_peaks.gappedPeak' %(peaks_dirname, prefix), gappedPeak_fn, gappedPeak_gz_fn, 14)]:
+
+        # MACS2 sometimes calls features off the end of chromosomes.  Fix that.
+        clipped_peaks_fn = common.slop_clip(macs2_peaks_fn, chrom_sizes.name)
+
+        # Rescale Col5 scores to range 10-1000 to conform to narrowPeak.as format (score must be <1000),
+        # sort and replace long peak names in Column 4 with Peak_<peakRank>
+        common.rescale_scores(clipped_peaks_fn, scores_col=5, sort_col=sort_col, rename_peaks=True, out_fn=peaks_fn)
+
+        out,err = common.run_pipe(['gzip -c %s' %(peaks_fn)], peaks_gz_fn)
 
     # remove additional files
     #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.xls ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_peaks.bed ${peakFile}_summits.bed
 
     #===========================================
-    # For Fold enrichment signal tracks
+    # Fold enrichment and -log10(p-value) signal tracks
     #============================================
 
-    # This file is a tab delimited file with 2 columns Col1 (chromosome name), Col2 (chromosome size in bp).
-
-    command = 'macs2 bdgcmp ' + \
-              '-t %s/%s_treat_pileup.bdg ' %(peaks_dirname, prefix) + \
-              '-c %s/%s_control_lambda.bdg ' %(peaks_dirname, prefix) + \
-              '--outdir %s -o %s_FE.bdg ' %(peaks_dirname, prefix) + \
-              '-m FE'
-    print command
-    returncode = common.block_on(command)
-    print "MACS2 exited with returncode %d" %(returncode)
-    assert returncode == 0, "MACS2 non-zero return"
-    
-    # Remove coordinates outside chromosome sizes (stupid MACS2 bug)
-    pipe = ['slopBed -i %s/%s_FE.bdg -g %s -b 0' %(peaks_dirname, prefix, chrom_sizes.name),
-            'bedClip stdin %s %s/%s.fc.signal.bedgraph' %(chrom_sizes.name, peaks_dirname, prefix)]
-    print pipe
-    out, err = common.run_pipe(pipe)
-
-    #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_FE.bdg
-
-    # Convert bedgraph to bigwig
-    command = 'bedGraphToBigWig ' + \
-              '%s/%s.fc.signal.bedgraph ' %(peaks_dirname, prefix) + \
-              '%s ' %(chrom_sizes.name) + \
-              '%s' %(fc_signal_fn)
-    print command
-    returncode = common.block_on(command)
-    print "bedGraphToBigWig exited with returncode %d" %(returncode)
-    assert returncode == 0, "bedGraphToBigWig non-zero return"
-    #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}.fc.signal.bedgraph
-    
-    #===========================================
-    # For -log10(p-value) signal tracks
-    #============================================
-
-    # Compute sval = min(no. of reads in ChIP, no. of reads in control) / 1,000,000
-
-    out, err = common.run_pipe([
-        'gzip -dc %s' %(experiment.name),
-        'wc -l'])
-    chipReads = out.strip()
-    out, err = common.run_pipe([
-        'gzip -dc %s' %(control.name),
-        'wc -l'])
-    controlReads = out.strip()
-    sval=str(min(float(chipReads), float(controlReads))/1000000)
-
-    print "chipReads = %s, controlReads = %s, sval = %s" %(chipReads, controlReads, sval)
-
-    returncode = common.block_on(
-        'macs2 bdgcmp ' + \
-        '-t %s/%s_treat_pileup.bdg ' %(peaks_dirname, prefix) + \
-        '-c %s/%s_control_lambda.bdg ' %(peaks_dirname, prefix) + \
-        '--outdir %s -o %s_ppois.bdg ' %(peaks_dirname, prefix) + \
-        '-m ppois -S %s' %(sval))
-    print "MACS2 exited with returncode %d" %(returncode)
-    assert returncode == 0, "MACS2 non-zero return"
-
-    # Remove coordinates outside chromosome sizes (stupid MACS2 bug)
-    pipe = ['slopBed -i %s/%s_ppois.bdg -g %s -b 0' %(peaks_dirname, prefix, chrom_sizes.name),
-            'bedClip stdin %s %s/%s.pval.signal.bedgraph' %(chrom_sizes.name, peaks_dirname, prefix)]
-    print pipe
-    out, err = common.run_pipe(pipe)
-
-    #rm -rf ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_ppois.bdg
-
-    # Convert bedgraph to bigwig
-    command = 'bedGraphToBigWig ' + \
-              '%s/%s.pval.signal.bedgraph ' %(peaks_dirname, prefix) + \
-              '%s ' %(chrom_sizes.name) + \
-              '%s' %(pvalue_signal_fn)
-    print command
-    returncode = common.block_on(command)
-    print "bedGraphToBigWig exited with returncode %d" %(returncode)
-    assert returncode == 0, "bedGraphToBigWig non-zero return"
-
-    #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}.pval.signal.bedgraph
-    #rm -f ${PEAK_OUTPUT_DIR}/${CHIP_TA_PREFIX}_treat_pileup.bdg ${peakFile}_control_lambda.bdg
+    for bedgraph_fn, bw_fn in [(fc_bedgraph_fn, fc_signal_fn), (pval_bedgraph_fn, pvalue_signal_fn)]:
+        command = 'bedGraphToBigWig %s %s %s' %(bedgraph_fn, chrom_sizes.name, bw_fn)
+        print command
+        returncode = common.block_on(command)
+        print "bedGraphToBigWig exited with returncode %d" %(returncode)
+        assert returncode == 0, "bedGraphToBigWig non-zero return"
+        os.remove(bedgraph_fn)
 
     #===========================================
     # Generate bigWigs from beds to support trackhub visualization of peak files
     #============================================
 
-    narrowPeak_bb_fname = common.bed2bb('%s' %(narrowPeak_fn), chrom_sizes.name, narrowPeak_as.name, bed_type='bed6+4')
-    gappedPeak_bb_fname = common.bed2bb('%s' %(gappedPeak_fn), chrom_sizes.name, gappedPeak_as.name, bed_type='bed12+3')
-    broadPeak_bb_fname =  common.bed2bb('%s' %(broadPeak_fn),  chrom_sizes.name, broadPeak_as.name,  bed_type='bed6+3')
+    narrowPeak_bb_fname, gappedPeak_bb_fname, broadPeak_bb_fname = common.bed2bb_many([
+        (narrowPeak_fn, chrom_sizes.name, narrowPeak_as.name, 'bed6+4'),
+        (gappedPeak_fn, chrom_sizes.name, gappedPeak_as.name, 'bed12+3'),
+        (broadPeak_fn,  chrom_sizes.name, broadPeak_as.name,  'bed6+3')])
 
     #Temporary during development to create empty files just to get the applet to exit 
     # for fn in [narrowPeak_fn, gappedPeak_fn, broadPeak_fn, narrowPeak_bb_fn, gappedPeak_bb_fn, broadPeak_bb_fn, fc_signal_fn, pvalue_signal_fn]:
@@ -237,14 +185,10 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
 
     # Upload the file outputs
 
-    narrowPeak    = dxpy.upload_local_file(narrowPeak_gz_fn)
-    gappedPeak    = dxpy.upload_local_file(gappedPeak_gz_fn)
-    broadPeak     = dxpy.upload_local_file(broadPeak_gz_fn)
-    narrowPeak_bb = dxpy.upload_local_file(narrowPeak_bb_fn)
-    gappedPeak_bb = dxpy.upload_local_file(gappedPeak_bb_fn)
-    broadPeak_bb  = dxpy.upload_local_file(broadPeak_bb_fn)
-    fc_signal     = dxpy.upload_local_file(fc_signal_fn)
-    pvalue_signal = dxpy.upload_local_file(pvalue_signal_fn)
+    narrowPeak, gappedPeak, broadPeak, narrowPeak_bb, gappedPeak_bb, broadPeak_bb, fc_signal, pvalue_signal = \
+        common.upload_many([narrowPeak_gz_fn, gappedPeak_gz_fn, broadPeak_gz_fn,
+                            narrowPeak_bb_fn, gappedPeak_bb_fn, broadPeak_bb_fn,
+                            fc_signal_fn, pvalue_signal_fn])
 
     # Build the output structure.
 
@@ -259,6 +203,8 @@ def main(experiment, control, xcor_scores_input, chrom_sizes, narrowpeak_as, gap
         "pvalue_signal": dxpy.dxlink(pvalue_signal)
     }
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
@@ -15,6 +15,8 @@ import sys, os, re
 import dxpy
 import common
 
+common.instrument()
+
 @dxpy.entry_point('main')
 def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
          chrom_sizes, as_file, peak_type, prefix=None,
@@ -56,19 +58,16 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
     rejected_peaks_fn       = '%s.rejected.%s' %(basename, peak_type)
     rejected_peaks_bb_fn    = rejected_peaks_fn + '.bb'
 
-    # Intermediate filenames
-    overlap_tr_fn   = 'replicated_tr.%s' %(peak_type)
-    overlap_pr_fn   = 'replicated_pr.%s' %(peak_type)
-
     # Download file inputs to the local file system with local filenames
 
-    dxpy.download_dxfile(rep1_peaks.get_id(), rep1_peaks_fn)
-    dxpy.download_dxfile(rep2_peaks.get_id(), rep2_peaks_fn)
-    dxpy.download_dxfile(pooled_peaks.get_id(), pooled_peaks_fn)
-    dxpy.download_dxfile(pooledpr1_peaks.get_id(), pooledpr1_peaks_fn)
-    dxpy.download_dxfile(pooledpr2_peaks.get_id(), pooledpr2_peaks_fn)
-    dxpy.download_dxfile(chrom_sizes.get_id(), chrom_sizes_fn)
-    dxpy.download_dxfile(as_file.get_id(), as_file_fn)
+    common.download_many([
+        (rep1_peaks, rep1_peaks_fn),
+        (rep2_peaks, rep2_peaks_fn),
+        (pooled_peaks, pooled_peaks_fn),
+        (pooledpr1_peaks, pooledpr1_peaks_fn),
+        (pooledpr2_peaks, pooledpr2_peaks_fn),
+        (chrom_sizes, chrom_sizes_fn),
+        (as_file, as_file_fn)])
 
     '''
     #find pooled peaks that are in (rep1 AND rep2)
@@ -92,76 +91,67 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
         ], overlapping_peaks_fn)
     print "%d peaks overall with true replicates or with pooled pseudorepliates" %(common.count_lines(overlapping_peaks_fn))
     '''
-    #the only difference between the peak_types is how the extra columns are handled
+    #the only difference between the peak_types is how many columns the peaks have
     if peak_type == "narrowPeak":
-        awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$13-$12; if (($21/s1 >= 0.5) || ($21/s2 >= 0.5)) {print $0}}'"""
-        cut_command = 'cut -f 1-10'
+        ncols = 10
         bed_type = 'bed6+4'
     elif peak_type == "gappedPeak":
-        awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$18-$17; if (($31/s1 >= 0.5) || ($31/s2 >= 0.5)) {print $0}}'"""
-        cut_command = 'cut -f 1-15'
+        ncols = 15
         bed_type = 'bed12+3'
     elif peak_type == "broadPeak":
-        awk_command = r"""awk 'BEGIN{FS="\t";OFS="\t"}{s1=$3-$2; s2=$12-$11; if (($19/s1 >= 0.5) || ($19/s2 >= 0.5)) {print $0}}'"""
-        cut_command = 'cut -f 1-9'
+        ncols = 9
         bed_type = 'bed6+3'
     else:
         print "%s is unrecognized.  peak_type should be narrowPeak, gappedPeak or broadPeak."
         sys.exit()
 
-    # Find pooled peaks that overlap Rep1 and Rep2 where overlap is defined as the fractional overlap wrt any one of the overlapping peak pairs  > 0.5
-    out, err = common.run_pipe([
-        'intersectBed -wo -a %s -b %s' %(pooled_peaks_fn, rep1_peaks_fn),
-        awk_command,
-        cut_command,
-        'sort -u',
-        'intersectBed -wo -a stdin -b %s' %(rep2_peaks_fn),
-        awk_command,
-        cut_command,
-        'sort -u'
-        ], overlap_tr_fn)
-    print "%d peaks overlap with both true replicates" %(common.count_lines(overlap_tr_fn))
+    pooled = common.read_bed(pooled_peaks_fn)
+    pooled_lines = ['\t'.join(row[:ncols]) for row in pooled]
 
-    # Find pooled peaks that overlap PseudoRep1 and PseudoRep2 where overlap is defined as the fractional overlap wrt any one of the overlapping peak pairs  > 0.5
-    out, err = common.run_pipe([
-        'intersectBed -wo -a %s -b %s' %(pooled_peaks_fn, pooledpr1_peaks_fn),
-        awk_command,
-        cut_command,
-        'sort -u',
-        'intersectBed -wo -a stdin -b %s' %(pooledpr2_peaks_fn),
-        awk_command,
-        cut_command,
-        'sort -u'
-        ], overlap_pr_fn)
-    print "%d peaks overlap with both pooled pseudoreplicates" %(common.count_lines(overlap_pr_fn))
+    def replicated_in(peaks_fn1, peaks_fn2):
+        # Pooled peaks that overlap a peak in each of peaks_fn1 and peaks_fn2, where overlap
+        # is defined as the fractional overlap wrt any one of the overlapping peak pairs >= 0.5
+        found = common.IntervalIndex(common.read_bed(peaks_fn1)).overlaps_any(pooled, min_fraction=0.5)
+        found &= common.IntervalIndex(common.read_bed(peaks_fn2)).overlaps_any(pooled, min_fraction=0.5)
+        return set(line for line, hit in zip(pooled_lines, found) if hit)
 
-    # Combine peak lists
-    out, err = common.run_pipe([
-        'cat %s %s' %(overlap_tr_fn, overlap_pr_fn),
-        'sort -u'
-        ], overlapping_peaks_fn)
-    print "%d peaks overlap with true replicates or with pooled pseudorepliates" %(common.count_lines(overlapping_peaks_fn))
+    # Find pooled peaks that overlap Rep1 and Rep2
+    overlap_tr = replicated_in(rep1_peaks_fn, rep2_peaks_fn)
+    print "%d peaks overlap with both true replicates" %(len(overlap_tr))
 
-    #rejected peaks
-    out, err = common.run_pipe([
-        'intersectBed -wa -v -a %s -b %s' %(pooled_peaks_fn, overlapping_peaks_fn)
-        ], rejected_peaks_fn)
-    print "%d peaks were rejected" %(common.count_lines(rejected_peaks_fn))
+    # Find pooled peaks that overlap PseudoRep1 and PseudoRep2
+    overlap_pr = replicated_in(pooledpr1_peaks_fn, pooledpr2_peaks_fn)
+    print "%d peaks overlap with both pooled pseudoreplicates" %(len(overlap_pr))
 
-    npeaks_in       = common.count_lines(common.uncompress(pooled_peaks_fn))
-    npeaks_out      = common.count_lines(overlapping_peaks_fn)
-    npeaks_rejected = common.count_lines(rejected_peaks_fn)
+    # Combine peak lists
+    overlapping = sorted(overlap_tr | overlap_pr)
+    with open(overlapping_peaks_fn, 'w') as fh:
+        fh.writelines(line + '\n' for line in overlapping)
+    print "%d peaks overlap with true replicates or with pooled pseudorepliates" %(len(overlapping))
+
+    #rejected peaks are those that do not overlap any replicated peak at all
+    replicated_index = common.IntervalIndex([line.split('\t') for line in overlapping])
+    rejected = [row for row, hit in zip(pooled, replicated_index.overlaps_any(pooled)) if not hit]
+    with open(rejected_peaks_fn, 'w') as fh:
+        fh.writelines('\t'.join(row) + '\n' for row in rejected)
+    print "%d peaks were rejected" %(len(rejected))
+
+    npeaks_in       = len(pooled)
+    npeaks_out      = len(overlapping)
+    npeaks_rejected = len(rejected)
 
     #make bigBed files for visualization
-    overlapping_peaks_bb_fn = common.bed2bb(overlapping_peaks_fn, chrom_sizes_fn, as_file_fn, bed_type=bed_type)
-    rejected_peaks_bb_fn    = common.bed2bb(rejected_peaks_fn, chrom_sizes_fn, as_file_fn, bed_type=bed_type)
+    overlapping_peaks_bb_fn, rejected_peaks_bb_fn = common.bed2bb_many([
+        (overlapping_peaks_fn, chrom_sizes_fn, as_file_fn, bed_type),
+        (rejected_peaks_fn,    chrom_sizes_fn, as_file_fn, bed_type)])
 
     # Upload file outputs from the local file system.
 
-    overlapping_peaks       = dxpy.upload_local_file(common.compress(overlapping_peaks_fn))
-    overlapping_peaks_bb    = dxpy.upload_local_file(overlapping_peaks_bb_fn)
-    rejected_peaks          = dxpy.upload_local_file(common.compress(rejected_peaks_fn))
-    rejected_peaks_bb       = dxpy.upload_local_file(rejected_peaks_bb_fn)
+    overlapping_peaks, overlapping_peaks_bb, rejected_peaks, rejected_peaks_bb = common.upload_many([
+        common.compress(overlapping_peaks_fn),
+        overlapping_peaks_bb_fn,
+        common.compress(rejected_peaks_fn),
+        rejected_peaks_bb_fn])
 
     # The following line fills in some basic dummy output and assumes
     # that you have created variables to represent your output with
@@ -186,6 +176,8 @@ def main(rep1_peaks, rep2_peaks, pooled_peaks, pooledpr1_peaks, pooledpr2_peaks,
     if pooled_signal:
         output.update({"pooled_signal": pooled_signal})
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
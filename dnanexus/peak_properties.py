@@ -48,11 +48,12 @@ def after(date1, date2):
 
 def get_rep_bams(experiment, keypair, server):
 
-	original_files = [common.encoded_get(urlparse.urljoin(server,'%s' %(uri)), keypair) for uri in experiment.get('original_files')]
+	original_files = common.encoded_get_many([urlparse.urljoin(server,'%s' %(uri)) for uri in experiment.get('original_files')], keypair)
 
 	#resolve the biorep_n for each fastq
-	for fastq in [f for f in original_files if f.get('file_format') == 'fastq']:
-		replicate = common.encoded_get(urlparse.urljoin(server,'%s' %(fastq.get('replicate'))), keypair)
+	fastqs = [f for f in original_files if f.get('file_format') == 'fastq']
+	replicates = common.encoded_get_many([urlparse.urljoin(server,'%s' %(f.get('replicate'))) for f in fastqs], keypair)
+	for fastq, replicate in zip(fastqs, replicates):
 		fastq.update({'biorep_n' : replicate.get('biological_replicate_number')})
 	#resolve the biorep_n's from derived_from for each bam
 	for bam in [f for f in original_files if f.get('file_format') == 'bam']:
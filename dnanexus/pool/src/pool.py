@@ -11,65 +11,148 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time, re, gzip
+import os, subprocess, shlex, time, re, gzip, shutil, tempfile, threading, errno
 from os.path import splitext
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
+import common
+from common import run_pipe
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+common.instrument()
+
+GZIP_MAGIC = '\x1f\x8b'
+
+def is_gzipped(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+def concatenate(input_filenames, pooled_filename):
+    # A gzip file may hold several members one after the other, and gzip -dc,
+    # zlib and the gzip module read them back as one stream, so gzipped
+    # inputs are copied byte for byte.  Only inputs that are not gzipped are
+    # compressed, with pigz on all the cores.
+    with common.timed(pooled_filename, 'concatenate'):
+        with open(pooled_filename, 'wb') as out:
+            for fn in input_filenames:
+                if is_gzipped(fn):
+                    with open(fn, 'rb') as fh:
+                        shutil.copyfileobj(fh, out, 16*1024*1024)
+                else:
+                    out.flush()
+                    subprocess.check_call(['pigz', '-p', str(cpu_count()), '-c', fn], stdout=out)
+
+def recompress(input_filenames, pooled_filename):
+    # One gzip member, for consumers that only read the first; pigz compresses
+    # in blocks on all the cores.
+    out,err = run_pipe([
+        'pigz -dc %s' %(' '.join(input_filenames)),
+        'pigz -p %d -c' %(cpu_count())],
+        outfile=pooled_filename)
+
+def release_fifo_reader(fifo, merged):
+    # Open and close fifo for writing, so that a reader blocked opening it
+    # (or waiting for data) gets end of file instead of waiting forever for
+    # a feeder that failed.  The reader may not have got to this fifo yet,
+    # so keep trying until it does or the merge is over.
+    while not merged.is_set():
+        try:
+            os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            return
+        except OSError as e:
+            if e.errno != errno.ENXIO: # ENXIO: no reader yet
+                return
+        merged.wait(0.1)
+
+def release_fifo_writer(fifo, feeder):
+    # Open and close fifo for reading until feeder is done, so that a feeder
+    # blocked opening it for writing gets going (and then a broken pipe)
+    # when the merge stopped before reading it.
+    while feeder.is_alive():
+        try:
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+        feeder.join(0.1)
+
+def sorted_merge(input_filenames, inputs_sorted, pooled_filename):
+    # k-way merge of the inputs into LC_ALL=C sort -k1,1 -k2,2n order.  Each
+    # input is inflated into a named pipe, going through sort first unless
+    # it is already in that order, and sort -m merges the pipes, holding one
+    # line per input.
+    fifo_dir = tempfile.mkdtemp(dir='.')
+    fifos = []
+    feeders = []
+    errors = []
+    merged = threading.Event()
+    n_unsorted = max(inputs_sorted.count(False), 1)
+    for i, (fn, input_sorted) in enumerate(zip(input_filenames, inputs_sorted)):
+        fifo = os.path.join(fifo_dir, '%d.bed' %(i))
+        os.mkfifo(fifo)
+        fifos.append(fifo)
+        steps = ['pigz -dc %s' %(fn)]
+        if not input_sorted:
+            steps.append('env LC_ALL=C sort -k1,1 -k2,2n -T . -S %d%% --parallel=%d'
+                         %(max(50/n_unsorted, 1), max(cpu_count()/n_unsorted, 1)))
+        def feed(steps=steps, fifo=fifo):
+            try:
+                common.pipeline(steps, outfile=fifo)
+            except Exception as e:
+                errors.append(e)
+                release_fifo_reader(fifo, merged)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        feeders.append(feeder)
+
+    try:
+        out,err = run_pipe([
+            'env LC_ALL=C sort -m -k1,1 -k2,2n --batch-size=%d %s' %(max(len(fifos), 2), ' '.join(fifos)),
+            'pigz -p %d -c' %(cpu_count())],
+            outfile=pooled_filename)
+    finally:
+        merged.set()
+        for fifo, feeder in zip(fifos, feeders):
+            release_fifo_writer(fifo, feeder)
+        shutil.rmtree(fifo_dir)
+    if errors:
+        raise errors[0]
 
 @dxpy.entry_point('main')
-def main(inputs):
+def main(inputs, single_member=False, sort=False):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
 
     input_filenames = []
+    input_tag_counts = []
+    inputs_sorted = []
     for input_file in inputs:
         dxf = dxpy.DXFile(input_file)
+        properties = dxf.get_properties()
         input_filenames.append(dxf.name)
+        input_tag_counts.append(properties.get(common.TAG_COUNT_PROPERTY))
+        inputs_sorted.append(properties.get(common.SORTED_PROPERTY) == common.BED_SORT_ORDER)
         dxpy.download_dxfile(dxf.get_id(), dxf.name)
 
     extension = splitext(splitext(input_filenames[-1])[0])[1] #uses last extension - presumably they are all the same
     pooled_filename = '-'.join([splitext(splitext(fn)[0])[0] for fn in input_filenames]) + "_pooled%s.gz" %(extension)
-    out,err = run_pipe([
-        'gzip -dc %s' %(' '.join(input_filenames)),
-        'gzip -c'],
-        outfile=pooled_filename)
+    if sort:
+        sorted_merge(input_filenames, inputs_sorted, pooled_filename)
+    elif single_member:
+        recompress(input_filenames, pooled_filename)
+    else:
+        concatenate(input_filenames, pooled_filename)
 
-    pooled = dxpy.upload_local_file(pooled_filename)
+    # the pool has as many tags as its inputs together, if they all say
+    if None in input_tag_counts:
+        pooled_tag_count = None
+    else:
+        pooled_tag_count = sum(int(n) for n in input_tag_counts)
+    properties = common.tag_count_properties(pooled_filename, pooled_tag_count)
+    if sort:
+        properties[common.SORTED_PROPERTY] = common.BED_SORT_ORDER
+    pooled = dxpy.upload_local_file(pooled_filename, properties=properties)
 
     # The following line fills in some basic dummy output and assumes
     # that you have created variables to represent your output with
@@ -78,6 +161,8 @@ def main(inputs):
     output = {}
     output["pooled"] = dxpy.dxlink(pooled)
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
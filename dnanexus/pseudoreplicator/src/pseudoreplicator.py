@@ -11,46 +11,46 @@
 # DNAnexus Python Bindings (dxpy) documentation:
 #   http://autodoc.dnanexus.com/bindings/python/current/
 
-import os, subprocess, shlex, time, re, gzip
+import os, subprocess, shlex, time, re, gzip, random
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
-
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" %(n,step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
+import common
+from common import run_pipe
+
+common.instrument()
+
+def split_pseudoreplicates(input_tags_filename, pr_ta_filenames, paired_end, seed=0, batch_size=10000):
+    # One pass over the gzipped tagAlign/BEDPE.  Each record goes to pr1 or
+    # pr2 on a seeded coin flip, BEDPE pairs are written out as their two
+    # tagAlign reads, and the two outputs are compressed by their own gzip
+    # processes so both compress at the same time.
+    rng = random.Random(seed)
+    batches = [[], []]
+    counts = [0, 0]
+    with common.Pipeline(['gzip -dc %s' %(input_tags_filename)]) as reader, \
+         common.Pipeline(['gzip -c'], outfile=pr_ta_filenames[0], stdin=True) as pr1_writer, \
+         common.Pipeline(['gzip -c'], outfile=pr_ta_filenames[1], stdin=True) as pr2_writer:
+        writers = [pr1_writer, pr2_writer]
+        for line in reader.stdout:
+            i = 0 if rng.random() < 0.5 else 1
+            if paired_end:
+                fields = line.rstrip('\n').split('\t')
+                batches[i].append('%s\t%s\t%s\tN\t1000\t%s\n%s\t%s\t%s\tN\t1000\t%s\n'
+                    %(fields[0], fields[1], fields[2], fields[8], fields[3], fields[4], fields[5], fields[9]))
+            else:
+                batches[i].append(line)
+            counts[i] += 1
+            if len(batches[i]) >= batch_size:
+                writers[i].stdin.write(''.join(batches[i]))
+                batches[i] = []
+        for i, writer in enumerate(writers):
+            writer.stdin.write(''.join(batches[i]))
+    print "Split %d records into %d and %d" %(sum(counts), counts[0], counts[1])
+    return counts
 
 @dxpy.entry_point('main')
-def main(input_tags):
+def main(input_tags, seed=0):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
@@ -92,28 +92,14 @@ def main(input_tags):
     pr_ta_filenames = [input_tags_basename + ".%s.pr1.tagAlign.gz" %(filename_infix),
                        input_tags_filename + ".%s.pr2.tagAlign.gz" %(filename_infix)]
 
-    #count lines in the file
-    out,err = run_pipe([
-        'gzip -dc %s' %(input_tags_filename),
-        'wc -l'])
-    #number of lines in each split   
-    nlines = (int(out)+1)/2
-    # Shuffle and split BEDPE file into 2 equal parts
-    splits_prefix = 'temp_split'
-    out,err = run_pipe([
-        'gzip -dc %s' %(input_tags_filename),
-        'shuf',
-        'split -a 2 -d -l %d - %s' %(nlines, splits_prefix)]) # gives two files named splits_prefix0n, n=1,2
-    # Convert read pairs to reads into standard tagAlign file
-    for i,index in enumerate(['00', '01']): #this should be made multi-threaded
-        steps = ['cat %s' %(splits_prefix+index)]
-        if paired_end:
-            steps.extend([r"""awk 'BEGIN{OFS="\t"}{printf "%s\t%s\t%s\tN\t1000\t%s\n%s\t%s\t%s\tN\t1000\t%s\n",$1,$2,$3,$9,$4,$5,$6,$10}'"""])
-        steps.extend(['gzip -c'])
-        out,err = run_pipe(steps, outfile=pr_ta_filenames[i])
-
-    pseudoreplicate1_file = dxpy.upload_local_file(pr_ta_filenames[0])
-    pseudoreplicate2_file = dxpy.upload_local_file(pr_ta_filenames[1])
+    counts = split_pseudoreplicates(input_tags_filename, pr_ta_filenames, paired_end, seed=seed)
+    if paired_end: # each BEDPE record became two tags
+        counts = [2*n for n in counts]
+
+    pseudoreplicate1_file = dxpy.upload_local_file(pr_ta_filenames[0],
+        properties=common.tag_count_properties(pr_ta_filenames[0], counts[0]))
+    pseudoreplicate2_file = dxpy.upload_local_file(pr_ta_filenames[1],
+        properties=common.tag_count_properties(pr_ta_filenames[1], counts[1]))
 
     # Return the outputs.
 
@@ -121,6 +107,8 @@ def main(input_tags):
     output["pseudoreplicate1"] = dxpy.dxlink(pseudoreplicate1_file)
     output["pseudoreplicate2"] = dxpy.dxlink(pseudoreplicate2_file)
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
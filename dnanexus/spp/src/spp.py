@@ -17,6 +17,8 @@ from subprocess import Popen, PIPE #debug only this should only need to be impor
 import dxpy
 import common
 
+common.instrument()
+
 
 @dxpy.entry_point('main')
 def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_sizes, as_file=None, prefix=None):
@@ -29,21 +31,23 @@ def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_s
     xcor_scores_input_file = dxpy.DXFile(xcor_scores_input)
     chrom_sizes_file = dxpy.DXFile(chrom_sizes)
     chrom_sizes_filename = chrom_sizes_file.name
-    dxpy.download_dxfile(chrom_sizes_file.get_id(), chrom_sizes_filename)
-    if bigbed:
-        as_file_file = dxpy.DXFile(as_file)
-        as_file_filename = as_file_file.name
-        dxpy.download_dxfile(as_file_file.get_id(), as_file_filename)
 
     # The following line(s) download your file inputs to the local file system
     # using variable names for the filenames.
 
     experiment_filename = experiment_file.name
-    dxpy.download_dxfile(experiment_file.get_id(), experiment_filename)
     control_filename = control_file.name
-    dxpy.download_dxfile(control_file.get_id(), control_filename)
     xcor_scores_input_filename = xcor_scores_input_file.name
-    dxpy.download_dxfile(xcor_scores_input_file.get_id(), xcor_scores_input_filename)
+    downloads = [
+        (chrom_sizes_file, chrom_sizes_filename),
+        (experiment_file, experiment_filename),
+        (control_file, control_filename),
+        (xcor_scores_input_file, xcor_scores_input_filename)]
+    if bigbed:
+        as_file_file = dxpy.DXFile(as_file)
+        as_file_filename = as_file_file.name
+        downloads.append((as_file_file, as_file_filename))
+    common.download_many(downloads)
 
     if not prefix:
         output_filename_prefix = experiment_filename.rstrip('.gz').rstrip('.tagAlign')
@@ -118,9 +122,7 @@ def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_s
     #print subprocess.check_output('head %s' %(final_peaks_filename), shell=True, stderr=subprocess.STDOUT)
     #print subprocess.check_output('head %s' %(xcor_scores_filename), shell=True, stderr=subprocess.STDOUT)
 
-    peaks = dxpy.upload_local_file(final_peaks_filename)
-    xcor_plot = dxpy.upload_local_file(xcor_plot_filename)
-    xcor_scores = dxpy.upload_local_file(xcor_scores_filename)
+    peaks, xcor_plot, xcor_scores = common.upload_many([final_peaks_filename, xcor_plot_filename, xcor_scores_filename])
 
     output = {}
     output["peaks"] = dxpy.dxlink(peaks)
@@ -129,6 +131,8 @@ def main(experiment, control, xcor_scores_input, npeaks, nodups, bigbed, chrom_s
     if bigbed and peaks_bb_filename:
         output["peaks_bb"] = dxpy.dxlink(peaks_bb)
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()
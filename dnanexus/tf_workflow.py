@@ -77,6 +77,7 @@ def get_args():
     parser.add_argument('--blacklist', help="Blacklist to filter IDR peaks")
     parser.add_argument('--idr',     help='Report peaks with and without IDR analysis',                 default=False, action='store_true')
     parser.add_argument('--idronly',  help='Only report IDR peaks', default=None, action='store_true')
+    parser.add_argument('--idrinprocess', help='Run the four IDR comparisons together in the final IDR stage instead of as four idr2 stages', default=False, action='store_true')
     # parser.add_argument('--idrversion', help='Version of IDR to use (1 or 2)', default="2")
     parser.add_argument('--yes',     help='Run the workflow',                   default=False, action='store_true')
 
@@ -483,93 +484,103 @@ def main():
         idr_stages = []
         idr_output_folder = resolve_folder(output_project, output_folder + '/' + idr_applet.name)
         if (args.rep1 and args.ctl1 and args.rep2) or blank_workflow:
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR True Replicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
+            if args.idrinprocess:
+                # encode_idr runs IDR itself, on the peaks straight from encode_spp
+                stage_input = dict(
+                    (field, dxpy.dxlink(
                         {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooled_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR True Replicates', 'stage_id': idr_stage_id})
+                         'outputField': field}))
+                    for field in ['rep1_peaks', 'rep2_peaks', 'pooled_peaks',
+                                  'rep1pr1_peaks', 'rep1pr2_peaks', 'rep2pr1_peaks', 'rep2pr2_peaks',
+                                  'pooledpr1_peaks', 'pooledpr2_peaks'])
+            else:
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR True Replicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooled_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR True Replicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Rep 1 Self-pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1pr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1pr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep1_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Rep 1 Self-pseudoreplicates', 'stage_id': idr_stage_id})
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Rep 1 Self-pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1pr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1pr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep1_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Rep 1 Self-pseudoreplicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Rep 2 Self-pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2pr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2pr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'rep2_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Rep 2 Self-pseudoreplicates', 'stage_id': idr_stage_id})
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Rep 2 Self-pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2pr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2pr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'rep2_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Rep 2 Self-pseudoreplicates', 'stage_id': idr_stage_id})
 
-            idr_stage_id = workflow.add_stage(
-                idr_applet,
-                name='IDR Pooled Pseudoreplicates',
-                folder=idr_output_folder,
-                stage_input={
-                    'rep1_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooledpr1_peaks'}),
-                    'rep2_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooledpr2_peaks'}),
-                    'pooled_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
-                         'outputField': 'pooled_peaks'})
-                }
-            )
-            idr_stages.append({'name': 'IDR Pooled Pseudoreplicates', 'stage_id': idr_stage_id})
-
-            stage_input = {
-                    'reps_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR True Replicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'r1pr_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 1 Self-pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'r2pr_peaks' : dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 2 Self-pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'pooledpr_peaks': dxpy.dxlink(
-                        {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Pooled Pseudoreplicates'),
-                         'outputField': 'IDR_peaks'}),
-                    'as_file': dxpy.dxlink(resolve_file(args.narrowpeak_as))
-                }
+                idr_stage_id = workflow.add_stage(
+                    idr_applet,
+                    name='IDR Pooled Pseudoreplicates',
+                    folder=idr_output_folder,
+                    stage_input={
+                        'rep1_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooledpr1_peaks'}),
+                        'rep2_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooledpr2_peaks'}),
+                        'pooled_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in encode_spp_stages if ss['name'] == PEAKS_STAGE_NAME),
+                             'outputField': 'pooled_peaks'})
+                    }
+                )
+                idr_stages.append({'name': 'IDR Pooled Pseudoreplicates', 'stage_id': idr_stage_id})
+
+                stage_input = {
+                        'reps_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR True Replicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'r1pr_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 1 Self-pseudoreplicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'r2pr_peaks' : dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Rep 2 Self-pseudoreplicates'),
+                             'outputField': 'IDR_peaks'}),
+                        'pooledpr_peaks': dxpy.dxlink(
+                            {'stage': next(ss.get('stage_id') for ss in idr_stages if ss['name'] == 'IDR Pooled Pseudoreplicates'),
+                             'outputField': 'IDR_peaks'})
+                    }
+            stage_input.update({'as_file': dxpy.dxlink(resolve_file(args.narrowpeak_as))})
             if blacklist:
                 stage_input.update({'blacklist': blacklist})
             if chrom_sizes:
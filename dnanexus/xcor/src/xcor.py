@@ -15,6 +15,10 @@ import os, subprocess, shlex, time
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE #debug only this should only need to be imported into run_pipe
 import dxpy
+import common
+from common import run_pipe
+
+common.instrument()
 
 
 def xcor_parse(fname):
@@ -56,41 +60,8 @@ def xcor_parse(fname):
     return xcor_qc
 
 
-def run_pipe(steps, outfile=None):
-    #break this out into a recursive function
-    #TODO:  capture stderr
-    from subprocess import Popen, PIPE
-    p = None
-    p_next = None
-    first_step_n = 1
-    last_step_n = len(steps)
-    for n,step in enumerate(steps, start=first_step_n):
-        print "step %d: %s" % (n, step)
-        if n == first_step_n:
-            if n == last_step_n and outfile: #one-step pipeline with outfile
-                with open(outfile, 'w') as fh:
-                    print "one step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                    p = Popen(shlex.split(step), stdout=fh)
-                break
-            print "first step shlex to stdout: %s" %(shlex.split(step))
-            p = Popen(shlex.split(step), stdout=PIPE)
-            #need to close p.stdout here?
-        elif n == last_step_n and outfile: #only treat the last step specially if you're sending stdout to a file
-            with open(outfile, 'w') as fh:
-                print "last step shlex: %s to file: %s" %(shlex.split(step), outfile)
-                p_last = Popen(shlex.split(step), stdin=p.stdout, stdout=fh)
-                p.stdout.close()
-                p = p_last
-        else: #handles intermediate steps and, in the case of a pipe to stdout, the last step
-            print "intermediate step %d shlex to stdout: %s" %(n,shlex.split(step))
-            p_next = Popen(shlex.split(step), stdin=p.stdout, stdout=PIPE)
-            p.stdout.close()
-            p = p_next
-    out,err = p.communicate()
-    return out,err
-
 @dxpy.entry_point('main')
-def main(input_bam, paired_end):
+def main(input_bam, paired_end, exclude_chroms=['chrM'], subsample_seed=0):
 
     # The following line(s) initialize your data object inputs on the platform
     # into dxpy.DXDataObject instances that you can start using immediately.
@@ -104,7 +75,6 @@ def main(input_bam, paired_end):
     input_bam_basename = input_bam_file.name.rstrip('.bam')
     dxpy.download_dxfile(input_bam_file.get_id(), input_bam_filename)
 
-    intermediate_TA_filename = input_bam_basename + ".tagAlign"
     if paired_end:
         end_infix = 'PE2SE'
     else:
@@ -118,7 +88,6 @@ def main(input_bam, paired_end):
     out,err = run_pipe([
         "bamToBed -i %s" %(input_bam_filename),
         r"""awk 'BEGIN{OFS="\t"}{$4="N";$5="1000";print $0}'""",
-        "tee %s" %(intermediate_TA_filename),
         "gzip -c"],
         outfile=final_TA_filename)
     print subprocess.check_output('ls -l', shell=True)
@@ -147,13 +116,8 @@ def main(input_bam, paired_end):
     else:
         end_infix = 'SE'
     subsampled_TA_filename = input_bam_basename + ".filt.nodup.sample.%d.%s.tagAlign.gz" %(NREADS/1000000, end_infix)
-    steps = [
-        'grep -v "chrM" %s' %(intermediate_TA_filename),
-        'shuf -n %d' %(NREADS)]
-    if paired_end:
-        steps.extend([r"""awk 'BEGIN{OFS="\t"}{$4="N";$5="1000";print $0}'"""])
-    steps.extend(['gzip -c'])
-    out,err = run_pipe(steps,outfile=subsampled_TA_filename)
+    common.subsample_tagAlign(final_TA_filename, subsampled_TA_filename, NREADS,
+        exclude_chroms=exclude_chroms, seed=subsample_seed, paired_end=paired_end)
     print subprocess.check_output('ls -l', shell=True)
 
     # Calculate Cross-correlation QC scores
@@ -163,22 +127,12 @@ def main(input_bam, paired_end):
     # CC_SCORE FILE format
     # Filename <tab> numReads <tab> estFragLen <tab> corr_estFragLen <tab> PhantomPeak <tab> corr_phantomPeak <tab> argmin_corr <tab> min_corr <tab> phantomPeakCoef <tab> relPhantomPeakCoef <tab> QualityTag
 
-    #run_spp_command = subprocess.check_output('which run_spp.R', shell=True)
-    spp_tarball = '/phantompeakqualtools/spp_1.10.1.tar.gz'
-    run_spp_command = '/phantompeakqualtools/run_spp_nodups.R'
-    #install spp
-    print subprocess.check_output(shlex.split('R CMD INSTALL %s' %(spp_tarball)))
-    out,err = run_pipe([
-        "Rscript %s -c=%s -p=%d -filtchr=chrM -savp=%s -out=%s" \
-            %(run_spp_command, subsampled_TA_filename, cpu_count(), CC_plot_filename, CC_scores_filename)])
+    common.native_xcor(subsampled_TA_filename, CC_scores_filename, CC_plot_filename,
+        exclude_chroms=exclude_chroms)
     print subprocess.check_output('ls -l', shell=True)
-    out,err = run_pipe([
-        r"""sed -r  's/,[^\t]+//g' %s""" %(CC_scores_filename)],
-        outfile="temp")
-    out,err = run_pipe([
-        "mv temp %s" %(CC_scores_filename)])
 
-    tagAlign_file = dxpy.upload_local_file(final_TA_filename)
+    tagAlign_file = dxpy.upload_local_file(final_TA_filename,
+        properties=common.tag_count_properties(final_TA_filename))
     # if not paired_end:
     #     final_BEDPE_filename = 'SE_so_no_BEDPE'
     #     subprocess.check_call('touch %s' %(final_BEDPE_filename), shell=True)
@@ -202,6 +156,8 @@ def main(input_bam, paired_end):
     if paired_end:
         output.update({"BEDPE_file": dxpy.dxlink(BEDPE_file)})
 
+    timings = dxpy.upload_local_file(common.write_timings())
+    output["timings"] = dxpy.dxlink(timings)
     return output
 
 dxpy.run()